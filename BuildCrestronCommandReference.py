@@ -29,17 +29,38 @@ POSSIBILITY OF SUCH DAMAGE.
 
 from __future__ import print_function
 import argparse
+import bisect
+import collections
+import itertools
 import os
+import Queue
 import re
+import select
 import socket
-import subprocess
+import struct
 import sys
-import textwrap
+import threading
+import traceback
 import webbrowser
-from time import sleep
+from time import localtime, sleep, strftime, time
 #
 import netifaces
 import paramiko
+#
+from crestron_candidates import ABBREVIATION_PROBES, ABBREVIATIONS_SUFFIX, CANDIDATE_STORE_SUFFIX, \
+    REJECTED_SUFFIX, AbbreviationMap, AffixModel, CandidateStore, RejectedCandidates, minimum_unique_prefixes, \
+    rank_candidates
+from crestron_checkpoint import CHECKPOINT_SUFFIX, SweepCheckpoint
+from crestron_console import LatencyTracker
+from crestron_help_cache import HelpTextCache
+from crestron_inventory import TRANSPORT_STATE_FILENAME, TransportState, prioritized_batches, read_inventory
+from crestron_metrics import CommandTracer, LiveMetrics, traced_phase
+from crestron_parser import find_console_prompt, firmware_key, parse_command_help, parse_firmware_version, \
+    parse_help_listing
+from crestron_report import report_filename, report_formats_argument, write_fleet_index, write_reports
+from crestron_snapshot import CHANGELOG_SUFFIX, SNAPSHOT_SUFFIX, DeviceSnapshot, append_changelog, help_hash
+from crestron_transport import CONNECT_IN_PROGRESS, ConsoleReactor, ConsoleSession
+from crestron_watch import WATCH_STATE_FILENAME, WatchState
 #import hexdump
 #import pprint
 
@@ -47,11 +68,134 @@ SSH_PORT = 22
 CIP_PORT = 41794
 CTP_PORT = 41795
 MAX_RETRIES = 3
-BUFF_SIZE = 20000
+SOCKET_TIMEOUT = 5.0
+# Used until the response times of a device are known, see LatencyTracker
+COMMAND_TIMEOUT = 30.0
+NUDGE_INTERVAL = 1.0
+SSH_TERMINAL_WIDTH = 512
+# Help queries sent per pipelined exchange once the console has answered one in order
+PIPELINE_BATCH = 250
+# Sessions opened per device when --sessions is 0 and the device keeps accepting them
+MAX_PROBED_SESSIONS = 4
+# Inventory devices read and documented at a time, ordered by priority within each batch
+INVENTORY_BATCH = 100
+# Help queries handed to a pooled session at a time
+SESSION_POOL_CHUNK = 50
+# Attempts to reconnect to a device whose console session died, e.g. while it reboots, waiting
+#   RECONNECT_DELAY seconds after the first and twice as long after each further one
+MAX_RECONNECT_ATTEMPTS = 8
+RECONNECT_DELAY = 2.0
+MAX_RECONNECT_DELAY = 60.0
+# Reconnects allowed while testing one batch of candidate commands before giving up on the device
+MAX_BATCH_RETRIES = 3
 CR = "\r"
 BROADCAST_IP = '255.255.255.255'
 UDP_MSG = "\x14\x00\x00\x00\x01\x04\x00\x03\x00\x00\x66\x65\x65\x64" + \
     ("\x00" * 252)
+CONSOLE_PORTS = (CTP_PORT, SSH_PORT)
+DISCOVERY_REPLY_NAME = re.compile("\x00([a-zA-Z0-9-]{2,30})\x00")
+
+DiscoveredDevice = collections.namedtuple("DiscoveredDevice", ["ip_address", "hostname", "interface"])
+
+
+class SharedRunState(object):
+    """
+    State shared by every device session of a run
+    """
+
+    def __init__(self):
+        """
+        initialize internal properties
+        """
+        self.preseed_command_list = []
+        self.preseed_command_set = set()
+        self.lock = threading.RLock()
+        self.named_locks = {}
+        self.discovered_devices = {}
+        # ip address -> InventoryDevice of the inventory devices being documented
+        self.inventory = {}
+        # TransportState of an inventory run
+        self.transports = None
+        self.refreshed_models = set()
+        # (console prompt, firmware key) -> DeviceResult of the device documented for that model
+        self.documented_models = {}
+        # Instrumentation, when enabled for the run
+        self.tracer = None
+        self.metrics = None
+
+
+    def named_lock(self, name):
+        """
+        Return the lock for a device IP, console prompt, etc., creating it on first use
+        """
+        with self.lock:
+            if name not in self.named_locks:
+                self.named_locks[name] = threading.Lock()
+            return self.named_locks[name]
+
+
+class CommandPrefixIndex(object):
+    """
+    Case-insensitive index of known commands used to find the known commands a candidate
+    abbreviates or extends without scanning the whole command list
+    """
+
+    def __init__(self, commands):
+        """
+        Index the commands by their upper case form
+        """
+        self.commands = {}
+        for command in commands:
+            self.commands.setdefault(command.upper(), command)
+        self.sorted_keys = sorted(self.commands)
+
+
+    def exact_match(self, candidate):
+        """
+        Return the known command matching the candidate, ignoring case, or None
+        """
+        return self.commands.get(candidate.upper())
+
+
+    def prefix_matches(self, candidate):
+        """
+        Return the known commands that are a prefix of the candidate or that start with it
+        """
+        key = candidate.upper()
+        matches = [self.commands[key[:length]] for length in range(1, len(key)) if key[:length] in self.commands]
+        index = bisect.bisect_right(self.sorted_keys, key)
+        while index < len(self.sorted_keys) and self.sorted_keys[index].startswith(key):
+            matches.append(self.commands[self.sorted_keys[index]])
+            index += 1
+        return matches
+
+
+class DeviceResult(object):
+    """
+    Outcome of documenting a single device
+    """
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, ip_address):
+        """
+        initialize internal properties
+        """
+        self.ip_address = ip_address
+        self.hostname = ""
+        self.status = "pending"
+        self.console_prompt = ""
+        self.firmwareversion = ""
+        self.firmware_key = ""
+        # Transport the console answered on: ctp or ssh
+        self.transport = ""
+        self.htmldocfilename = ""
+        # LatencyTracker.statistics() of the device's console
+        self.latency = {}
+        # IP of the device of the same model and firmware whose documentation this device shares
+        self.representative = ""
+        self.error = ""
+        self.output = ""
+        self.elapsed = 0.0
 
 
 class CrestronDeviceDocumenter(object):
@@ -60,31 +204,68 @@ class CrestronDeviceDocumenter(object):
     """
     # pylint: disable=too-many-instance-attributes
 
-    def __init__(self, args):
+    def __init__(self, args, shared=None):
         """
         initialize internal properties
         """
         self.active_ips_to_check = []
         if args.iptocheck:
             self.active_ips_to_check.append(args.iptocheck)
-        self.preseed_command_list = []
+        self.shared = shared if shared else SharedRunState()
+        self.preseed_command_list = self.shared.preseed_command_list
+        self.preseed_command_set = self.shared.preseed_command_set
+        self.output_buffer = None
+        self.open_in_browser = True
         self.possible_commands_filename = args.addtestcommands
         self.preseed_commands_filename = "preseed.upc"
         self.do_not_execute_commands_filename = "donotexec.upc"
         self.do_not_execute_command_list = []
         self.firmwareversion = ""
+        self.firmware_key = ""
         self.console_prompt = ""
         self.htmldocfilename = ""
         self.unpublished_commands_filename = ""
+        self.help_cache = None
+        # The ConsoleSession to the device, driven through the synchronous wrappers of the reactor
+        self.session = None
+        self.reactor = ConsoleReactor()
+        self.report_formats = args.outputformats
+        self.round_trips = 0
+        self.bytes_read = 0
+        self.phase = ""
         self.args = args
 
     def initialize_run_variables(self):
         self.console_prompt = ""
         self.firmwareversion = ""
+        self.firmware_key = ""
+        self.transport = ""
         self.help_dict = {}
+        self.help_store = {}
+        self.help_store_hits = 0
+        # Commands whose help in help_store was taken from the previous snapshot and not used yet
+        self.snapshot_help = set()
+        self.snapshot_hits = 0
+        self.help_cache_hits = 0
+        self.help_queries = 0
+        self.round_trips = 0
+        self.bytes_read = 0
+        self.pipeline_window = self.args.pipeline
+        self.pipeline_verified = False
+        self.prefetched_help = {}
+        self.session_pool = None
+        self.timed_out_commands = []
+        # command -> times it was sent, to tell retries apart in the trace
+        self.command_attempts = {}
+        self.skipped_candidates = 0
+        self.abbreviations = AbbreviationMap("", "")
+        self.abbreviated_candidates = 0
+        self.latency = LatencyTracker(NUDGE_INTERVAL, COMMAND_TIMEOUT)
+        self.previous_snapshot = None
         self.pub_command_list = []
         self.hidden_command_list = []
         self.unpublished_command_list = []
+        self.unpublished_command_set = set()
         self.htmldocfilename = ""
         self.unpublished_commands_filename = ""
 
@@ -102,6 +283,17 @@ class CrestronDeviceDocumenter(object):
         r.destroy()
 
 
+    def log(self, *items, **kwargs):
+        """
+        print() that buffers the output when the device is documented as part of a fleet
+        """
+        if self.output_buffer is None:
+            print(*items, **kwargs)
+            sys.stdout.flush()
+        else:
+            self.output_buffer.append(" ".join(str(item) for item in items) + kwargs.get("end", "\n"))
+
+
     def print_debug_data(self, data, msg):
         """
         debug printing of data
@@ -112,223 +304,540 @@ class CrestronDeviceDocumenter(object):
         print("\n")
 
 
+    def expand_subnet(self, subnet):
+        """
+        Yield the host addresses of a subnet given in CIDR form like 10.61.100.0/22
+        or as the first three octets of a /24 like 17.1.6
+        """
+        if "/" in subnet:
+            network, prefix_len = subnet.split("/", 1)
+            prefix_len = int(prefix_len)
+        else:
+            network = subnet.strip(".")
+            prefix_len = 8 * (network.count(".") + 1)
+            network += ".0" * (3 - network.count("."))
+        if not 0 <= prefix_len <= 32:
+            raise ValueError("Invalid subnet prefix length in " + subnet)
+        mask = (0xFFFFFFFF << (32 - prefix_len)) & 0xFFFFFFFF
+        first = struct.unpack("!I", socket.inet_aton(network))[0] & mask
+        last = first | (~mask & 0xFFFFFFFF)
+        # Skip the network and broadcast addresses unless the subnet is too small to have them
+        if prefix_len < 31:
+            first += 1
+            last -= 1
+        for address in xrange(first, last + 1):
+            yield socket.inet_ntoa(struct.pack("!I", address))
+
+
+    def probe_console_ports(self, hosts, ports=CONSOLE_PORTS):
+        """
+        Attempt non-blocking TCP connections to the console ports of many hosts at once,
+        returning a dict of host to the set of ports that accepted the connection
+        """
+        max_in_flight = max(1, self.args.sweepconcurrency)
+        connect_timeout = self.args.sweeptimeout
+        probes = ((host, port) for host in hosts for port in ports)
+        in_flight = {}
+        open_ports = {}
+        exhausted = False
+        while in_flight or not exhausted:
+            while not exhausted and len(in_flight) < max_in_flight:
+                try:
+                    host, port = next(probes)
+                except StopIteration:
+                    exhausted = True
+                    break
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setblocking(0)
+                err = sock.connect_ex((host, port))
+                if err == 0:
+                    open_ports.setdefault(host, set()).add(port)
+                    sock.close()
+                elif err in CONNECT_IN_PROGRESS:
+                    in_flight[sock] = (host, port, time() + connect_timeout)
+                else:
+                    sock.close()
+            if not in_flight:
+                continue
+            pending = list(in_flight)
+            _unused, writable, failed = select.select([], pending, pending, 0.05)
+            for sock in set(writable) | set(failed):
+                host, port, _unused = in_flight.pop(sock)
+                if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0 and sock not in failed:
+                    open_ports.setdefault(host, set()).add(port)
+                sock.close()
+            now = time()
+            for sock, (host, port, deadline) in list(in_flight.items()):
+                if now > deadline:
+                    del in_flight[sock]
+                    sock.close()
+        return open_ports
+
+
     def build_list_of_activeips(self, subnet):
         """
-        Build a list of devices that respond to ping for a /24 subnet like 17.1.6.{1}:
+        Build a list of devices that have a Crestron console port open for a subnet
+        like 10.61.100.0/22 or a /24 like 17.1.6
         """
-        print ("Building list of active IP addresses on subnet {0}.0/24\nPlease wait...".format(subnet))
-        with open(os.devnull, "wb") as limbo:
-            for last_octet in xrange(1, 255):
-                ip = "{0}.{1}".format(subnet, last_octet)
-                result = subprocess.Popen(["ping", "-n", "1", "-w", "200", ip],
-                         stdout=limbo, stderr=limbo).wait()
-                if not result:
-                    self.active_ips_to_check.append(ip)
-            if self.active_ips_to_check:
-                print("Located {0} active IPs on subnet".format(len(self.active_ips_to_check)))
+        print ("Building list of active Crestron console IP addresses on subnet {0}\nPlease wait...".format(subnet))
+        open_ports = self.probe_console_ports(self.expand_subnet(subnet))
+        for ip in sorted(open_ports, key=socket.inet_aton):
+            if ip not in self.active_ips_to_check:
+                self.active_ips_to_check.append(ip)
+        if self.active_ips_to_check:
+            print("Located {0} active IPs on subnet".format(len(self.active_ips_to_check)))
 
 
-    def build_list_of_crestronips(self):
+    def open_discovery_sockets(self):
         """
-        Build a list of Crestron devices that respond to a UDP message
+        Open a broadcast socket on every IPv4 interface, returning a dict of socket to
+        (interface, local IP, broadcast addresses)
         """
+        discovery_sockets = {}
         for iface in netifaces.interfaces():
-            if netifaces.AF_INET in netifaces.ifaddresses(iface):
-                # This works better than current version of Crestron Toolbox's Device Discovery
-                if 'broadcast' in netifaces.ifaddresses(iface)[netifaces.AF_INET][0] and \
-                   'addr' in netifaces.ifaddresses(iface)[netifaces.AF_INET][0]:
-                    cur_ip = netifaces.ifaddresses(iface)[netifaces.AF_INET][0]['addr']
-                    loc_bcast_ip = netifaces.ifaddresses(iface)[netifaces.AF_INET][0]['broadcast']
-                    print("Testing IP subnet", cur_ip)
-                    for bcast_ip in [BROADCAST_IP, loc_bcast_ip]:
-                        udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                        udp_sock.bind((cur_ip, CIP_PORT))
-                        udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                        udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            for inet_addr in netifaces.ifaddresses(iface).get(netifaces.AF_INET, []):
+                if 'broadcast' not in inet_addr or 'addr' not in inet_addr:
+                    continue
+                cur_ip = inet_addr['addr']
+                bcast_ips = [BROADCAST_IP]
+                if inet_addr['broadcast'] != BROADCAST_IP:
+                    bcast_ips.append(inet_addr['broadcast'])
+                udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                try:
+                    udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                    udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+                    udp_sock.bind((cur_ip, CIP_PORT))
+                    udp_sock.setblocking(0)
+                except socket.error as err:
+                    print("Unable to listen on {0} ({1}): {2}".format(cur_ip, iface, err))
+                    udp_sock.close()
+                    continue
+                discovery_sockets[udp_sock] = (iface, cur_ip, bcast_ips)
+        return discovery_sockets
+
+
+    def discover_crestron_devices(self, quiet_window=1.5, max_wait=10.0):
+        """
+        Broadcast the discovery message on every interface at once and collect the replies,
+        stopping once no new device has answered within the quiet window
+        """
+        discovery_sockets = self.open_discovery_sockets()
+        local_ips = set(cur_ip for _unused, cur_ip, _unused in discovery_sockets.values())
+        responders = set()
+        discovered = []
+        try:
+            for udp_sock, (iface, cur_ip, bcast_ips) in discovery_sockets.items():
+                print("Testing IP subnet", cur_ip)
+                for bcast_ip in bcast_ips:
+                    try:
                         udp_sock.sendto(UDP_MSG, (bcast_ip, CIP_PORT))
-                        udp_sock.settimeout(2.0)
-                        try:
-                            while True:
-                                data, addr = udp_sock.recvfrom(4096)
-                                search = re.findall ('\x00([a-zA-Z0-9-]{2,30})\x00', data[9:40])
-                                if search:
-                                    dev_name = search[0]
-                                    dev_ip = addr[0]
-                                    if cur_ip != dev_ip and dev_ip not in self.active_ips_to_check and dev_name is not "feed":
-                                        self.active_ips_to_check.append(dev_ip)
-                        except Exception, e:
-                            #print ("The exception was: %s" % e) //timed out
-                            pass
+                    except socket.error:
+                        pass
+            start_time = last_reply_time = time()
+            while discovery_sockets:
+                now = time()
+                wait = min(last_reply_time + quiet_window, start_time + max_wait) - now
+                if wait <= 0:
+                    break
+                readable, _unused, _unused = select.select(list(discovery_sockets), [], [], wait)
+                for udp_sock in readable:
+                    try:
+                        data, addr = udp_sock.recvfrom(4096)
+                    except socket.error:
+                        continue
+                    dev_ip = addr[0]
+                    if dev_ip in responders or dev_ip in local_ips:
+                        continue
+                    # This works better than current version of Crestron Toolbox's Device Discovery
+                    search = DISCOVERY_REPLY_NAME.findall(data[9:40])
+                    if search and search[0] != "feed":
+                        responders.add(dev_ip)
+                        discovered.append(DiscoveredDevice(dev_ip, search[0], discovery_sockets[udp_sock][0]))
+                        last_reply_time = time()
+        finally:
+            for udp_sock in discovery_sockets:
+                udp_sock.close()
+        return discovered
+
+
+    def build_list_of_crestronips(self):
+        """
+        Build a list of Crestron devices that respond to a UDP message
+        """
+        for device in self.discover_crestron_devices(self.args.discoveryquiet, self.args.discoverytimeout):
+            self.shared.discovered_devices[device.ip_address] = device
+            if device.ip_address not in self.active_ips_to_check:
+                self.active_ips_to_check.append(device.ip_address)
         total_dev_count = len(self.active_ips_to_check)
         print ("\nLocated a total of {0} Crestron".format(total_dev_count), "device" if total_dev_count == 1 else "devices")
 
 
-    def open_device_connection(self):
+    def console_endpoints(self, ip_address):
+        """
+        The (transport, port) pairs to try in order for a device. An inventory device whose
+        transport is left open is tried over CTP and then SSH, on its inventory port if it has
+        one, the transport it last answered on first.
+        """
+        device = self.shared.inventory.get(ip_address)
+        if device is None:
+            return [("ssh", SSH_PORT)] if self.args.forcessh else [("ctp", CTP_PORT)]
+        if device.transport:
+            return [(device.transport, device.port or (SSH_PORT if device.transport == "ssh" else CTP_PORT))]
+        endpoints = [("ctp", device.port or CTP_PORT), ("ssh", device.port or SSH_PORT)]
+        remembered = self.shared.transports.transport(ip_address) if self.shared.transports else None
+        # A remembered endpoint whose port the inventory has since changed is not tried
+        if remembered in endpoints:
+            endpoints = [remembered] + [endpoint for endpoint in endpoints if endpoint != remembered]
+        return endpoints
+
+
+    def device_credentials(self, ip_address):
         """
-        Open the device connection, attempting port 41795
+        (user name, password) of a device, from its inventory entry or the command line
         """
-        SOCKET_TIMEOUT = 5.0
+        device = self.shared.inventory.get(ip_address)
+        username = device.username if device and device.username is not None else self.args.username
+        password = device.password if device and device.password is not None else self.args.password
+        return username, password
 
-        if not self.args.forcessh:
-            try:
-                self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                server_address = (self.device_ip_address, 41795)
-                self.sock.settimeout(SOCKET_TIMEOUT)
-                print("Attempting to connect to {0} port {1}".format(self.device_ip_address, CTP_PORT))
-                self.sock.connect(server_address)
-                self.usingssh = False
-                return True
-            except:
-                pass
-        else:
-            self.sshclient = paramiko.client.SSHClient()
-            try:
-                self.sshclient.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                self.sshclient.load_system_host_keys()
-                print("Attempting to connect to {0} port {1}".format(self.device_ip_address, SSH_PORT))
-                self.sshclient.connect(self.device_ip_address, port=22, username=self.args.username, password=self.args.password, timeout=SOCKET_TIMEOUT)
-                self.usingssh = True
+
+    def open_device_connection(self):
+        """
+        Open the device connection, attempting port 41795 or SSH as console_endpoints() gives
+        """
+        username, password = self.device_credentials(self.device_ip_address)
+        for transport, port in self.console_endpoints(self.device_ip_address):
+            self.log("Attempting to connect to {0} port {1}".format(self.device_ip_address, port))
+            self.session = ConsoleSession(self.device_ip_address, port, use_ssh=transport == "ssh",
+                                          username=username, password=password, connect_timeout=SOCKET_TIMEOUT,
+                                          max_prompt_attempts=MAX_RETRIES, terminal_width=SSH_TERMINAL_WIDTH,
+                                          latency=self.latency, reconnect_delay=RECONNECT_DELAY,
+                                          max_reconnect_delay=MAX_RECONNECT_DELAY, no_delay=bool(self.args.pipeline))
+            if self.drive_session(self.reactor.open):
+                self.transport = transport
+                if self.shared.transports:
+                    self.shared.transports.record(self.device_ip_address, transport, port)
                 return True
-            except:
-                print("Error: Unable to connect to device.")
+        self.session = None
+        self.log("Error: Unable to connect to device.")
         return False
 
 
+    def drive_session(self, wrapper, *args):
+        """
+        Call a synchronous wrapper of the reactor on the device's session, counting its traffic
+        """
+        session = self.session
+        round_trips = session.round_trips
+        bytes_read = session.bytes_read
+        try:
+            return wrapper(session, *args)
+        finally:
+            self.round_trips += session.round_trips - round_trips
+            self.bytes_read += session.bytes_read - bytes_read
+
+
     def close_device_connection(self):
         """
-        Close the socket
+        Close the socket or SSH session
+        """
+        self.log("\nProcess complete.")
+        self.close_console()
+
+
+    def close_console(self):
+        """
+        Close the console session and any pooled sessions without reporting it
+        """
+        if self.session_pool:
+            self.session_pool.close()
+            self.session_pool = None
+        if self.session:
+            self.session.close()
+
+
+    def reconnect_device(self):
+        """
+        Open a new console session after the current one died, giving a rebooting device time
+        to come back. Raises socket.error if the device does not return with the same prompt.
+        """
+        self.log("\nConsole session lost, reconnecting (up to {0} attempts)".format(MAX_RECONNECT_ATTEMPTS))
+        if self.session_pool:
+            self.session_pool.close()
+            self.session_pool = None
+        if self.session is None or not self.drive_session(self.reactor.reconnect, MAX_RECONNECT_ATTEMPTS):
+            raise socket.error("Unable to reconnect to {0}".format(self.device_ip_address))
+
+
+    def session_alive(self):
+        """
+        True if the console session still answers with its prompt
         """
         try:
-            print("\nProcess complete.")
-            if self.usingssh:
-                self.sshclient.close()
-            else:
-                self.sock.close()
-        except:
-            pass
+            data = self.send_command_wait_prompt("")
+        except (socket.error, EOFError, paramiko.SSHException):
+            return False
+        return data.find(self.console_prompt + ">") > -1
 
 
+    @traced_phase
     def get_console_prompt(self):
         """
         Determine the device console prompt
         """
-        data = ""
-        #try:
-        for _unused in range(0, MAX_RETRIES):
-            if self.usingssh:
-                stdin,stdout,stderr=self.sshclient.exec_command("ver")
-                data = str(stdout.readlines())
-                search = re.findall("([\w-]{3,30})\ ", data, re.MULTILINE)
-            else:
-                self.sock.sendall(CR)
-                data += self.sock.recv(BUFF_SIZE)
-                search = re.findall("[\n\r]([\w-]{3,30})>", data, re.MULTILINE)
-            
-            sleep(.25)
-            #self.place_on_win_clipboard(data)
-            #print(hexdump.hexdump(data))
-            if search:
-                self.console_prompt = search[0]
-                self.unpublished_commands_filename = self.console_prompt + ".upc"
-                print("Console prompt is", self.console_prompt)
-                if self.console_prompt == "MERCURY":
-                    print("Mercury currently unsupported due to Crestron engin.err.uity")
-                    exit()
-                return True
-        #except:
-        #    pass
-        print("Console prompt not found on device.")
+        # SSH shells and some consoles print a banner and prompt without being asked; the
+        #   session sends CRs, waiting longer after each unanswered one, until the prompt shows
+        if self.drive_session(self.reactor.wait_for_prompt):
+            self.console_prompt = self.session.console_prompt
+            self.unpublished_commands_filename = self.console_prompt + ".upc"
+            self.log("Console prompt is", self.console_prompt)
+            if self.console_prompt == "MERCURY":
+                self.log("Mercury currently unsupported due to Crestron engin.err.uity")
+                return False
+            return True
+        self.log("Console prompt not found on device.")
         return False
 
 
-    def remove_prompt(self, data, char_limit):
+    def send_command_wait_prompt(self, command):
         """
-        Remove the console prompt from the text within the specified character limit
+        Send a command and return the response as soon as the console prompt follows it
         """
-        prompt_pos = data.find(self.console_prompt+">")
-        if prompt_pos < char_limit:
-            data = data.replace(self.console_prompt+">", "", 1)
-        if char_limit == -1:
-            data = data.replace(self.console_prompt+">", "")
-        return data
-
-
-    def send_command_wait_prompt(self, command, waitforpromptlocation):
+        if self.session is None:
+            raise socket.error("Not connected to {0}".format(self.device_ip_address))
+        pending = self.drive_session(self.reactor.command, command)
+        timed_out = pending.timed_out or pending.response is None
+        self.trace_command(command, pending, timed_out)
+        if pending.response is None:
+            raise socket.error(self.session.error or "Console session to {0} closed".format(self.device_ip_address))
+        if timed_out:
+            self.log("\nTimed out waiting for the console prompt after", command)
+            if command:
+                self.timed_out_commands.append(command)
+        return pending.response
+
+
+    def run_phase(self, name, method, *args, **kwargs):
         """
-        Send a command and wait for the console prompt following the specified location
+        Run a phase method, tracing its duration and console traffic. Phases run within
+        another phase, such as finding the prompt again after a reconnect, are traced too.
         """
-        if self.usingssh:
-            stdin,stdout,stderr=self.sshclient.exec_command(command)
-            data = stdout.readlines()
-            data = "".join(data)
-        else:
-            message = CR + command + CR
-            self.sock.sendall(message)
-            data = ""
-            sleep(0.2)
-            waitcount = 0
-            data = self.sock.recv(BUFF_SIZE)
-            data = data.replace(message, "")
-            while data.find(self.console_prompt, waitforpromptlocation) == -1:
-                # Deal with newer firmware that executes commands / doesn't return a prompt
-                #   instead of printing help
-                try:
-                    sleep(0.2)
-                    data += self.sock.recv(BUFF_SIZE)
-                except:
-                    self.sock.sendall(CR)
-                waitcount += 1
-                if waitcount == 5:
-                    self.sock.sendall(CR)
-                    waitcount = 0
-        return data
+        previous_phase = self.phase
+        self.phase = name
+        started = time()
+        round_trips = self.round_trips
+        bytes_read = self.bytes_read
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.phase = previous_phase
+            if self.shared.tracer:
+                self.shared.tracer.write({"kind": "phase", "device": self.device_ip_address,
+                                          "console_prompt": self.console_prompt, "phase": name,
+                                          "elapsed_ms": round((time() - started) * 1000, 3),
+                                          "round_trips": self.round_trips - round_trips,
+                                          "bytes": self.bytes_read - bytes_read})
+
+
+    def trace_command(self, command, pending, timed_out):
+        """
+        Record a command answered (or not) by the console in the trace and live metrics
+        """
+        tracer = self.shared.tracer
+        metrics = self.shared.metrics
+        if not tracer and not metrics:
+            return
+        retry = self.command_attempts.get(command, 0)
+        self.command_attempts[command] = retry + 1
+        if metrics:
+            metrics.record_command(self.device_ip_address, self.console_prompt, self.phase, pending.elapsed,
+                                   pending.bytes_read, pending.nudges, timed_out, retry > 0)
+        if tracer:
+            tracer.write({"kind": "command", "device": self.device_ip_address, "console_prompt": self.console_prompt,
+                          "phase": self.phase, "command": command, "elapsed_ms": round(pending.elapsed * 1000, 3),
+                          "bytes": pending.bytes_read, "nudges": pending.nudges, "retry": retry,
+                          "timed_out": timed_out})
+
+
+    def report_progress(self, done, total):
+        """
+        Tell the live metrics how far the current phase has got
+        """
+        if self.shared.metrics:
+            self.shared.metrics.progress(self.device_ip_address, self.phase, done, total)
 
 
+    @traced_phase
     def get_firmware_version(self):
         """
         Get the firmware version of the device
         """
-        data = self.send_command_wait_prompt("ver", 40)
-        if not self.usingssh:
-            data = data.replace(self.console_prompt + ">", "")
-            search = re.search(r"[\r\n]{1,2}([\w\[\]\.\ \(\),#@-]{20,90})[\r\n]{1,2}", data, re.MULTILINE)
-            if search:
-                self.firmwareversion = search.group().strip()
-        else:
-            self.firmwareversion = data.strip()
-        print("Firmware version ", self.firmwareversion)
+        firmwareversion = parse_firmware_version(self.send_command_wait_prompt("ver"), self.console_prompt + ">")
+        if firmwareversion:
+            self.firmwareversion = firmwareversion
+        self.firmware_key = firmware_key(self.firmwareversion)
+        self.log("Firmware version ", self.firmwareversion)
 
 
     def get_command_help(self, command):
         """
-        Get the help text for a command
+        Get the help text for a command, querying the device at most once per run
         """
         if command in self.do_not_execute_command_list:
-            return self.help_dict[cmd]
-        
-        message = command + " ?"
-        data = self.send_command_wait_prompt(message, 30)
-        if data.upper().find("BAD COMM") > -1 or data.upper().find("INCOMPLETE COMM") > -1:
-            return ""
-        if data.find("Authentication is not on. Command not allowed.") > -1 or \
-           data.find("ERROR: Command Blocked from this console type.") > -1 or \
-           data == "":
-            return "No help available for this command."
-        help_text = ""
-        if not self.usingssh:
-            search = re.findall(r"[\r\n]{1,2}(.{5," + str(len(data)) + "})[\r\n]{1,2}" + \
-                    self.console_prompt + ">", data, re.M|re.S)
-            if search:
-                help_text = search[0].replace(self.console_prompt + ">", ""). \
-                            replace(">", "&gt;").replace("<", "&lt;")
-                if help_text.find(message, 1, 30) > -1:
-                    help_text = help_text[len(message) + 2:]
+            return self.help_dict[command]
+        if command in self.help_store:
+            if command in self.snapshot_help:
+                self.snapshot_help.discard(command)
+                self.snapshot_hits += 1
+            else:
+                self.help_store_hits += 1
+            return self.help_store[command]
+        help_text = None
+        if self.help_cache and self.firmware_key:
+            help_text = self.help_cache.get_long_help(self.console_prompt, self.firmware_key, command)
+        if help_text is not None:
+            self.help_cache_hits += 1
+        else:
+            self.help_queries += 1
+            help_text = self.prefetched_help.pop(command, None)
+            if help_text is None:
+                help_text = self.query_command_help(command)
+            # Help cut short by a timeout is not kept for later runs
+            if self.help_cache and self.firmware_key and help_text and command + " ?" not in self.timed_out_commands:
+                self.help_cache.put_long_help(self.console_prompt, self.firmware_key, command, help_text)
+        self.help_store[command] = help_text
+        return help_text
+
+
+    def log_help_statistics(self):
+        """
+        Report where the help text used during the run came from
+        """
+        self.log("\nHelp lookups: {0} reused within this run, {1} from the last run, {2} from the help cache, "
+                 "{3} queried from the device".format(self.help_store_hits, self.snapshot_hits, self.help_cache_hits,
+                                                      self.help_queries))
+        self.log(self.latency.describe())
+
+
+    def prefetch_command_help(self, commands):
+        """
+        Query the help of the commands not already known ahead of time, spread across a pool
+        of console sessions and/or pipelined when enabled. get_command_help picks up the results.
+        """
+        if self.args.sessions != 1 and self.session_pool is None:
+            self.session_pool = CrestronSessionPool(self)
+            self.session_pool.open(self.args.sessions or MAX_PROBED_SESSIONS)
+        if self.pipeline_window < 2 and not (self.session_pool and self.session_pool.sessions):
+            return
+        pending = []
+        pending_set = set()
+        for command in commands:
+            if command in pending_set or command in self.help_store or command in self.prefetched_help or \
+               command in self.do_not_execute_command_list:
+                continue
+            if self.help_cache and self.firmware_key and \
+               self.help_cache.get_long_help(self.console_prompt, self.firmware_key, command) is not None:
+                continue
+            pending_set.add(command)
+            pending.append(command)
+        if self.session_pool and self.session_pool.sessions:
+            self.prefetched_help.update(self.session_pool.query_help_texts(pending))
         else:
-            help_text = data.replace("\r\n\r\n", "\r\n")
-        reformatted_help_text = ""
-        for line in help_text.split("\n"):
-            reformatted_help_text += textwrap.fill(line, 150) + "\n"
-        return reformatted_help_text
+            self.prefetched_help.update(self.query_help_texts(pending))
+
+
+    def query_help_texts(self, commands):
+        """
+        Query the help of several commands on this session, pipelined when enabled, and
+        return the help text of each command answered
+        """
+        help_texts = {}
+        start = 0
+        while start < len(commands):
+            if self.pipeline_window < 2:
+                for command in commands[start:]:
+                    help_texts[command] = self.query_command_help(command)
+                break
+            # Probe with a single window until the console has shown it answers in order
+            batch_size = PIPELINE_BATCH if self.pipeline_verified else self.pipeline_window
+            batch = commands[start:start + batch_size]
+            answered = self.query_command_help_pipelined(batch)
+            for command, data in answered.items():
+                help_texts[command] = self.parse_command_help(command, data)
+            # The answers are in order; the commands after the last one go in the next batch
+            start += len(answered)
+        return help_texts
+
+
+    def query_command_help_pipelined(self, commands):
+        """
+        Send the help queries for several commands back to back and split the output at the
+        prompts. Returns the output for each command answered, in the same form
+        send_command_wait_prompt would have; the answered commands are always the first ones.
+        A console that answers in order but stops early keeps pipelining for the rest, and a
+        first command it does not answer at all is queried on its own. Firmware that drops or
+        reorders typed ahead input, shown by a response without the echo of its own command,
+        turns pipelining off for the rest of the device run; the unanswered commands are then
+        queried one at a time.
+        """
+        terminator = self.console_prompt + ">"
+        messages = [command + " ?" for command in commands]
+        # A slow console gets a longer quiet period, a fast one never less than a lone query had
+        quiet = max(NUDGE_INTERVAL, self.latency.nudge_interval)
+        started = time()
+        # The leading empty line gives the same output in front of each response as a single query
+        # Each response gets the time a single command would, however long the batch is
+        segments, bytes_read = self.drive_session(ConsoleSession.exchange_pipelined, [""] + messages, terminator,
+                                                  self.pipeline_window, quiet, self.latency.command_timeout)
+        self.round_trips += -(-len(segments) // self.pipeline_window)
+        if self.shared.metrics:
+            self.shared.metrics.record_command(self.device_ip_address, self.console_prompt, self.phase, None,
+                                               bytes_read, commands=len(segments))
+        if self.shared.tracer:
+            self.shared.tracer.write({"kind": "pipelined", "device": self.device_ip_address,
+                                      "console_prompt": self.console_prompt, "phase": self.phase,
+                                      "commands": len(messages), "answered": max(0, len(segments) - 1),
+                                      "window": self.pipeline_window, "elapsed_ms": round((time() - started) * 1000, 3),
+                                      "bytes": bytes_read})
+        responses = {}
+        in_order = True
+        for index, segment in enumerate(segments[1:]):
+            # Each response must start with the echo of its own command and not contain the echo
+            #   of a command sent after it
+            upper_segment = segment.upper()
+            later_echoes = [message.upper() for message in messages[index + 1:index + self.pipeline_window]]
+            if not upper_segment.lstrip().startswith(messages[index].upper()) or \
+               any("\n" + echo in upper_segment or "\r" + echo in upper_segment for echo in later_echoes):
+                in_order = False
+                break
+            responses[commands[index]] = (segments[0] + terminator + segment + terminator). \
+                                         replace(CR + messages[index] + CR, "")
+        if not in_order:
+            self.log("\nConsole did not answer pipelined help queries in order, querying one command at a time")
+            self.pipeline_window = 0
+        elif len(responses) == len(commands):
+            self.pipeline_verified = True
+        if not in_order or not responses:
+            # Answers still on their way must not be taken for those of the next command
+            self.drive_session(ConsoleSession.read_until_quiet, quiet, COMMAND_TIMEOUT)
+        if in_order and not responses:
+            # Such as a command that runs instead of printing its help; a single query nudges it
+            responses[commands[0]] = self.send_command_wait_prompt(messages[0])
+        return responses
+
+
+    def query_command_help(self, command):
+        """
+        Query the device for the help text for a command
+        """
+        return self.parse_command_help(command, self.send_command_wait_prompt(command + " ?"))
+
+
+    def parse_command_help(self, command, data):
+        """
+        Extract the help text for a command from the console output
+        """
+        return parse_command_help(command, data, self.console_prompt + ">")
 
 
     def get_command_categories(self):
@@ -336,8 +845,8 @@ class CrestronDeviceDocumenter(object):
         Get a list of the command categories
         Not currently used
         """
-        print("Getting command categories")
-        data = self.send_command_wait_prompt("hidhelp", 20)
+        self.log("Getting command categories")
+        data = self.send_command_wait_prompt("hidhelp")
         data = data[12:]
         category_list = []
         category_desc = []
@@ -355,9 +864,9 @@ class CrestronDeviceDocumenter(object):
         Get a list of the commands in a given category
         Not currently used
         """
-        print("\n\nGetting categorial commandset", category)
+        self.log("\n\nGetting categorial commandset", category)
         message = CR + "hidhelp " + category
-        data = self.send_command_wait_prompt(message, 30)
+        data = self.send_command_wait_prompt(message)
         data = data[len(message)+4:]
         command_list = []
         help_desc = []
@@ -369,50 +878,42 @@ class CrestronDeviceDocumenter(object):
                     command_list.append(search2[0][0].strip())
                     help_desc.append(search2[0][2].strip())
             if not command_list:
-                print("[None]")
+                self.log("[None]")
 
 
     def get_help_list(self, help_command, command_list, command_dict):
         """
         Get a list of the normal/published commands
         """
-        data = self.send_command_wait_prompt(help_command, 30)
-        data = data.replace(help_command, "")
-        data = self.remove_prompt(data, 100)
-        data = self.remove_prompt(data, -1)
-        if data.find("\r\n"):
-            data = data.replace("\r\n", "\r").replace("\r", "\n")
-        if data.find("Bad") > -1 or data.find("Incomplete Command") > -1:
-            return
-        search = re.findall(r"\n(.{1,200}?)(?=\n)", data, re.MULTILINE)
-        if search:
-            for find in search:
-                search2 = re.findall(r"(\w{2,25})\ *(Programmer|Operator|Administrator|User\ or\ Connect)?\ *(.{1,120})", find, re.MULTILINE)
-                if search2:
-                    command = search2[0][0].strip()
-                    if command not in command_list and command <> "Add":
-                        command_list.append(command)
-                        if command not in command_dict:
-                            command_dict[command] = search2[0][2].strip()
+        data = self.send_command_wait_prompt(help_command)
+        listed_commands = set(command_list)
+        for command, short_help in parse_help_listing(data, help_command, self.console_prompt + ">"):
+            if command not in listed_commands and command <> "Add":
+                listed_commands.add(command)
+                command_list.append(command)
+                if command not in command_dict:
+                    command_dict[command] = short_help
 
 
+    @traced_phase
     def get_published_command_list(self):
         """
         Get a list of the normal/published commands
         """
-        print("Getting Normal Commandset")
+        self.log("Getting Normal Commandset")
         self.get_help_list("help all", self.pub_command_list, self.help_dict)
-        print("Found", len(self.pub_command_list), "Normal commands")
+        self.log("Found", len(self.pub_command_list), "Normal commands")
 
 
+    @traced_phase
     def get_hidden_command_list(self):
         """
         Get a list of the hidden commands
         """
-        print("Getting Hidden Commandset (if available)")
+        self.log("Getting Hidden Commandset (if available)")
         self.get_help_list("hidhelp all", self.hidden_command_list, self.help_dict)
         if self.hidden_command_list:
-            print("Found", len(self.hidden_command_list)-len(self.pub_command_list), "Hidden commands")
+            self.log("Found", len(self.hidden_command_list)-len(self.pub_command_list), "Hidden commands")
 
 
     def save_unpublished_command_list(self):
@@ -424,51 +925,102 @@ class CrestronDeviceDocumenter(object):
                 cmd_file.writelines(["%s\n" % item for item in self.unpublished_command_list])
 
 
+    def read_command_file(self, filename):
+        """
+        Return the commands listed one per line in a text file
+        """
+        if not os.path.isfile(filename):
+            return []
+        with open(filename, "r") as cmd_file:
+            return [item.strip() for item in cmd_file if item.strip()]
+
+
     def load_preseed_command_list(self):
         """
         Load the preseed unpublished command list
         """
-        if os.path.isfile(self.preseed_commands_filename):
-            with open(self.preseed_commands_filename, "r") as cmd_file:
-                upc_lines = cmd_file.readlines()
-                self.preseed_command_list = [item.strip() for item in upc_lines if item.strip != ""]
+        self.preseed_command_list[:] = self.read_command_file(self.preseed_commands_filename)
+        self.preseed_command_set.clear()
+        self.preseed_command_set.update(self.preseed_command_list)
 
 
     def save_preseed_command_list(self):
         """
         Save the unpublished commands for reuse
         """
-        if self.preseed_command_list:
-            with open(self.preseed_commands_filename, "w") as cmd_file:
-                cmd_file.writelines(["%s\n" % item for item in self.preseed_command_list])
+        with self.shared.lock:
+            if self.preseed_command_list:
+                with open(self.preseed_commands_filename, "w") as cmd_file:
+                    cmd_file.writelines(["%s\n" % item for item in self.preseed_command_list])
 
 
-    def test_if_command_exists(self, complete_command_list, command1):
+    def test_if_command_exists(self, command_index, command1):
         """
         Test if the command exists
         """
         command1 = command1.strip()
-        if not command1:
+        if not command1 or command_index.exact_match(command1):
+            return
+        if self.abbreviations.abbreviated_command(command1):
+            self.abbreviated_candidates += 1
             return
-        command_exists = False
         command1_help = self.get_command_help(command1)
-        for cmd_known in complete_command_list:
-            if cmd_known.upper() == command1.upper():
-                command_exists = True
-            elif command1.upper() == cmd_known[:len(command1)].upper() or \
-               cmd_known.upper() == command1[:len(cmd_known)].upper():
-                command2_help = self.get_command_help(cmd_known)
-                if len(command1_help) == len(command2_help):
-                    command_exists = True
-        if not command_exists and command1_help:
-            if command1 not in self.preseed_command_list:
-                self.preseed_command_list.append(command1)
-            if command1 not in self.unpublished_command_list:
-                self.unpublished_command_list.append(command1)
-                if command1 not in self.help_dict:
-                    self.help_dict[command1] = ""
-                print(command1 + " ", end="")
-                sys.stdout.flush()
+        if not command1_help:
+            return
+        # The console accepts abbreviations so a candidate may just be another form of a known command
+        command1_hash = help_hash(command1_help)
+        for cmd_known in command_index.prefix_matches(command1):
+            if command1_hash == help_hash(self.get_command_help(cmd_known)):
+                if cmd_known.upper().startswith(command1.upper()):
+                    self.abbreviations.learn(cmd_known, command1)
+                return
+        self.add_unpublished_command(command1)
+
+
+    def probe_abbreviations(self, known_commands):
+        """
+        Learn if the console resolves abbreviations by querying the help of a few known
+        commands by their shortest prefix no other known command shares
+        """
+        if self.abbreviations.resolves is not None:
+            return
+        prefix_lengths = minimum_unique_prefixes(known_commands)
+        # Some firmware ignores the "?" and executes the command, so nothing that could resolve to
+        #   a do-not-execute command is sent
+        do_not_execute = [command.upper() for command in self.do_not_execute_command_list]
+        probes = [command for command in known_commands if command.upper() in prefix_lengths and
+                  command not in self.do_not_execute_command_list and
+                  not any(unsafe.startswith(command[:prefix_lengths[command.upper()]].upper())
+                          for unsafe in do_not_execute)]
+        rejected = 0
+        for command in probes[:ABBREVIATION_PROBES]:
+            command_help = self.get_command_help(command)
+            abbreviation = command[:prefix_lengths[command.upper()]]
+            abbreviation_help = self.query_command_help(abbreviation)
+            if not abbreviation_help:
+                rejected += 1
+            elif command_help and help_hash(abbreviation_help) == help_hash(command_help):
+                self.abbreviations.learn(command, abbreviation)
+        if self.abbreviations.resolves is None and probes and rejected == min(len(probes), ABBREVIATION_PROBES):
+            self.abbreviations.probed(False)
+        self.log("Console {0} abbreviations".format({True: "resolves", False: "does not resolve",
+                                                     None: "may resolve"}[self.abbreviations.resolves]))
+
+
+    def add_unpublished_command(self, command):
+        """
+        Record a command found by testing candidates
+        """
+        with self.shared.lock:
+            if command not in self.preseed_command_set:
+                self.preseed_command_set.add(command)
+                self.preseed_command_list.append(command)
+        if command not in self.unpublished_command_set:
+            self.unpublished_command_set.add(command)
+            self.unpublished_command_list.append(command)
+            if command not in self.help_dict:
+                self.help_dict[command] = ""
+            self.log(command + " ", end="")
 
 
     def load_do_not_execute_command_list(self):
@@ -479,7 +1031,7 @@ class CrestronDeviceDocumenter(object):
           CMD2FORM1,CMD2FORM2~Short help description|Long help description
         """
         if os.path.isfile(self.do_not_execute_commands_filename):
-            print ("Loading and parsing do-not-execute commands")
+            self.log("Loading and parsing do-not-execute commands")
             with open(self.do_not_execute_commands_filename, "r") as cmd_file:
                 upc_lines = cmd_file.readlines()
                 for item in upc_lines:
@@ -495,191 +1047,926 @@ class CrestronDeviceDocumenter(object):
                                     self.help_dict[cmd] = short_long_help
 
 
-    def load_possible_command_list(self):
+    def open_candidate_store(self):
         """
-        Load possible commands from a text file
+        The candidate store of the possible commands file, tokenized into it first if the file
+        is new or has changed, or None without a possible commands file
         """
-        poss_list = []
-        if os.path.isfile(self.possible_commands_filename):
-            print ("Loading and parsing possible commands")
-            with open(self.possible_commands_filename, "r") as cmd_list_file:
-                for line in iter(cmd_list_file):
-                    cmds = line.strip().upper()
-                    cmds = re.split(r"([\w]+)", cmds)
-                    #print (cmds)
-                    if cmds:
-                        for cmd in cmds:
-                            poss_list.append(cmd)
-            uniq_cmds = set(poss_list)
-            poss_list = list(uniq_cmds)
-            poss_list.sort()
-            with open("a_" + self.possible_commands_filename, "w") as cmd_list_file:
-                for cmd in poss_list:
-                    cmd_list_file.write(cmd + "\n")
-            return poss_list
-
-
+        if not os.path.isfile(self.possible_commands_filename):
+            return None
+        self.log("Loading and parsing possible commands")
+        # Fleet workers share the store, the first one tokenizes the file
+        with self.shared.named_lock("candidates:" + self.possible_commands_filename):
+            store = CandidateStore(self.possible_commands_filename + CANDIDATE_STORE_SUFFIX)
+            if store.load(self.possible_commands_filename):
+                self.log("Stored {0} distinct possible commands".format(store.count()))
+        return store
+
+
+    def candidate_commands(self, known_commands, rejected, store):
+        """
+        Yield every candidate of the unpublished command search once, most promising first:
+        the known unpublished commands, then the possible commands that share a prefix or
+        suffix with this device's commands or complete a SET/GET style pair, then the rest of
+        the possible commands. Candidates this firmware rejected before are only counted.
+        """
+        ranked = []
+        if store:
+            ranked = rank_candidates(store.words(), AffixModel(self.pub_command_list + self.hidden_command_list))
+        # Only the known and ranked candidates are remembered, the store holds each word once
+        seen = set()
+        for candidates, remember in ((known_commands, True), (ranked, True), (store.words() if store else [], False)):
+            for candidate in candidates:
+                if candidate in seen:
+                    continue
+                if remember:
+                    seen.add(candidate)
+                if candidate in rejected:
+                    self.skipped_candidates += 1
+                else:
+                    yield candidate
+
+
+    @traced_phase
     def test_for_unpublished_commands(self):
         """
         Load a text file and test the commands for inclusion in the device documentation
         """
-        complete_command_list = []
-        complete_command_list.extend(self.pub_command_list)
-        if self.hidden_command_list:
-            complete_command_list.extend(self.hidden_command_list)
-
-        # Load the possible commands file
-        poss_cmds = self.load_possible_command_list()
-        if not poss_cmds:
-            poss_cmds = []
-
-        # Load the device specific existing unpublished commands file, if it exists
-        if os.path.isfile(self.unpublished_commands_filename):
-            with open(self.unpublished_commands_filename, "r") as cmd_list_file:
-                for line in iter(cmd_list_file):
-                    a_cmd = line.strip()
-                    if a_cmd:
-                        poss_cmds.insert(0, a_cmd)
-
-        # Preseed with known unpublished commands file, it if exists
-        if os.path.isfile(self.preseed_commands_filename):
-            with open(self.preseed_commands_filename, "r") as cmd_list_file:
-                for line in iter(cmd_list_file):
-                    a_cmd = line.strip()
-                    if a_cmd and a_cmd not in poss_cmds:
-                        poss_cmds.insert(0, a_cmd)
-
-        if poss_cmds:
-            print("Testing for Unpublished commands")
-            for cmd in poss_cmds:
-                self.test_if_command_exists(complete_command_list, cmd)
-            self.unpublished_command_list.sort()
-            self.save_unpublished_command_list()
-            self.save_preseed_command_list()
+        command_index = CommandPrefixIndex(self.pub_command_list + self.hidden_command_list)
+        # Candidates this firmware rejected in earlier runs are never sent again
+        rejected = RejectedCandidates(self.console_prompt + REJECTED_SUFFIX, self.firmware_key)
+        rejected.load()
+        self.abbreviations = AbbreviationMap(self.console_prompt + ABBREVIATIONS_SUFFIX, self.firmware_key)
+        self.abbreviations.load()
+        # Known unpublished commands (preseed and device specific files) are tested ahead of
+        #   the possible commands file
+        known_commands = self.read_command_file(self.preseed_commands_filename) + \
+                         self.read_command_file(self.unpublished_commands_filename)
+        store = self.open_candidate_store()
+        try:
+            candidate_count = len(known_commands) + (store.count() if store else 0)
+            candidates = self.candidate_commands(known_commands, rejected, store)
+            batch = list(itertools.islice(candidates, PIPELINE_BATCH))
+            if batch:
+                self.log("Testing for Unpublished commands")
+                self.probe_abbreviations(self.pub_command_list + self.hidden_command_list)
+                checkpoint = self.open_sweep_checkpoint(candidate_count)
+                # Candidates rejected before a resumed search was interrupted
+                rejected.add(cmd for cmd in checkpoint.tested
+                             if cmd not in self.unpublished_command_set and not command_index.exact_match(cmd))
+                position = 0
+                while batch:
+                    position += len(batch)
+                    batch = [cmd for cmd in batch if cmd not in checkpoint.tested]
+                    if batch:
+                        found_before = len(self.unpublished_command_list)
+                        timed_out_before = len(self.timed_out_commands)
+                        self.test_candidate_batch(command_index, batch)
+                        accepted = self.unpublished_command_list[found_before:]
+                        # Only a complete answer proves a candidate is not a command
+                        timed_out = set(self.timed_out_commands[timed_out_before:])
+                        timed_out_batch = sorted(cmd for cmd in set(batch) - set(accepted) if cmd + " ?" in timed_out)
+                        rejected_batch = sorted(set(batch) - set(accepted) - set(timed_out_batch))
+                        checkpoint.record(position, accepted, rejected_batch, timed_out_batch)
+                        rejected.add(cmd for cmd in rejected_batch if not command_index.exact_match(cmd))
+                    self.report_progress(min(position, candidate_count), candidate_count)
+                    batch = list(itertools.islice(candidates, PIPELINE_BATCH))
+                self.unpublished_command_list.sort()
+                self.save_unpublished_command_list()
+                self.save_preseed_command_list()
+                rejected.save()
+                self.abbreviations.save()
+                checkpoint.remove()
+        finally:
+            if store:
+                store.close()
+        if self.skipped_candidates:
+            self.log("\nSkipped {0} candidates rejected by this firmware before".format(self.skipped_candidates))
+        if self.abbreviated_candidates:
+            self.log("\nSkipped {0} candidates known to abbreviate a command".format(self.abbreviated_candidates))
         if self.unpublished_command_list:
-            print("\nFound", len(self.unpublished_command_list), "Unpublished commands")
+            self.log("\nFound", len(self.unpublished_command_list), "Unpublished commands")
 
 
-    def write_html_documentation(self):
+    def open_sweep_checkpoint(self, candidate_count):
         """
-        Write the HTML file
+        Start the checkpoint log of the unpublished command search, or with --resume pick up
+        the commands found by an interrupted search of the same firmware
         """
-        if not self.pub_command_list and not self.hidden_command_list and \
-           not self.unpublished_command_list:
-            print("Help commands not found on this device.")
-            return
+        checkpoint = SweepCheckpoint(self.console_prompt + CHECKPOINT_SUFFIX)
+        if self.args.resume and checkpoint.load(self.firmware_key):
+            self.log("Resuming at candidate {0} of {1}, {2} candidates already tested".format(
+                min(checkpoint.index, candidate_count), candidate_count, len(checkpoint.tested)))
+            for command in checkpoint.accepted:
+                self.add_unpublished_command(command)
+        else:
+            checkpoint.start(self.firmware_key, candidate_count)
+        return checkpoint
 
-        complete_command_list = []
-        complete_command_list.extend(self.pub_command_list)
-        if self.hidden_command_list:
-            complete_command_list.extend(self.hidden_command_list)
-        if self.unpublished_command_list:
-            complete_command_list.extend(self.unpublished_command_list)
-
-        print("")
-        uniq_cmds = set(complete_command_list)
-        complete_command_list = list(uniq_cmds)
-        complete_command_list.sort()
-
-        special_command_color = "#0000FF"
-        unpublished_command_color = "#8B0000"
-
-        self.htmldocfilename = self.console_prompt + ".html"
-        htmlfile = open(self.htmldocfilename, "w")
-        pagetitle = "Commandset for the " + self.console_prompt
-        htmlfile.write("<!DOCTYPE HTML>\n")
-        htmlfile.write("<html>\n")
-        htmlfile.write("<head>\n  <title>" + pagetitle +
-                       "</title>\n  <meta name=\"utility_author\" content=\"Stephen Genusa\">\n")
-        htmlfile.write("  <meta http-equiv=\"Content-Type\" content=\"text/html; charset=UTF-8\">\n")
-        htmlfile.write("  <style type=\"text/css\">\n")
-        htmlfile.write("      table { page-break-inside:auto }\n")
-        htmlfile.write("      tr    { page-break-inside:avoid; page-break-after:auto }\n")
-        htmlfile.write("      thead { display:table-header-group }\n")
-        htmlfile.write("      tfoot { display:table-footer-group }\n")
-        htmlfile.write("      fwver { font-size:12px }\n")
-        htmlfile.write("  </style>\n")
-        htmlfile.write("</head>\n<body>\n<font face='arial'>\n")
-        htmlfile.write("<h1>" + pagetitle + "</h1>\n")
-        htmlfile.write("<blockquote>\n")
-        htmlfile.write("<p style=\"font-size:12px\">" + self.firmwareversion + "</p>\n")
-        htmlfile.write("<p>" + str(len(self.pub_command_list)) +
-                       " normal commands found.&nbsp;")
 
-        if self.hidden_command_list:
-            htmlfile.write("<font color=\"" + special_command_color + "\">" +
-                           str(len(self.hidden_command_list)-len(self.pub_command_list)) +
-                           "</font> hidden commands available.&nbsp;")
-        if self.unpublished_command_list:
-            htmlfile.write("<font color=\"" + unpublished_command_color + "\">" +
-                           str(len(self.unpublished_command_list)) +
-                           " unpublished commands available.</font>")
-        htmlfile.write("</p>\n")
-        htmlfile.write("</blockquote>\n")
+    def test_candidate_batch(self, command_index, batch):
+        """
+        Test a batch of candidate commands, reconnecting and testing the batch again if the
+        console session dies. Help cut short by the failure is queried again.
+        """
+        for retry in range(MAX_BATCH_RETRIES + 1):
+            timed_out_before = len(self.timed_out_commands)
+            try:
+                self.prefetch_command_help([cmd for cmd in batch if not command_index.exact_match(cmd) and
+                                            not self.abbreviations.abbreviated_command(cmd)])
+                for cmd in batch:
+                    self.test_if_command_exists(command_index, cmd)
+                if len(self.timed_out_commands) == timed_out_before or self.session_alive():
+                    return
+            except (socket.error, EOFError, paramiko.SSHException):
+                pass
+            if retry == MAX_BATCH_RETRIES:
+                raise socket.error("Console session of {0} keeps failing".format(self.device_ip_address))
+            for command in self.timed_out_commands[timed_out_before:]:
+                self.help_store.pop(command[:-len(" ?")] if command.endswith(" ?") else command, None)
+            # The batch is tested again, so only what times out then counts
+            del self.timed_out_commands[timed_out_before:]
+            self.reconnect_device()
 
-        htmlfile.write("<table border=\"1\" cellpadding=\"5\" cellspacing=\"5\" style=\"border-collapse:collapse;\" width=\"100%\">\n")
 
+    @traced_phase
+    def collect_command_help(self):
+        """
+        Look up the long help of every documented command ahead of writing the documentation
+        """
+        complete_command_list = sorted(set(self.pub_command_list + self.hidden_command_list +
+                                           self.unpublished_command_list))
+        self.prefetch_command_help([command for command in complete_command_list
+                                    if command not in self.do_not_execute_command_list])
+        self.log("")
         for index, command in enumerate(complete_command_list):
-            if command in self.unpublished_command_list:
-                color = unpublished_command_color
-                class_name = "unpub"
-            elif command in self.pub_command_list:
-                color = "#000000"
-                class_name = "pub"
+            if command not in self.do_not_execute_command_list:
+                self.get_command_help(command)
+            self.report_progress(index + 1, len(complete_command_list))
+            # Live metrics replace the list of commands as progress report
+            if not self.shared.metrics or not self.shared.metrics.interval:
+                self.log("(" + str(index) + ")" + command + " ", end="")
+
+
+    @traced_phase
+    def write_documentation(self, model):
+        """
+        Write the documentation of the command model in each requested format
+        """
+        if not model.published and not model.hidden and not model.unpublished:
+            self.log("Help commands not found on this device.")
+            return
+        report_files = write_reports(model, self.report_formats)
+        self.htmldocfilename = report_files[0]
+
+
+    def open_help_cache(self):
+        """
+        Open the persistent help text cache unless it has been disabled
+        """
+        if self.args.helpcache and self.help_cache is None:
+            self.help_cache = HelpTextCache(self.args.helpcache)
+
+
+    def commit_help_cache(self):
+        """
+        Write the long help cached during a phase to the help text cache file
+        """
+        if self.help_cache:
+            self.help_cache.commit()
+
+
+    def close_help_cache(self):
+        """
+        Close the persistent help text cache
+        """
+        if self.help_cache:
+            self.help_cache.close()
+            self.help_cache = None
+
+
+    def evict_help_cache(self):
+        """
+        Remove models from the help text cache that are too old or exceed the size limit
+        """
+        if self.args.helpcache:
+            help_cache = HelpTextCache(self.args.helpcache)
+            try:
+                evicted = help_cache.evict(self.args.cachemaxage, self.args.cachemaxmodels)
+                if evicted:
+                    print("Evicted {0} models from the help cache".format(evicted))
+            finally:
+                help_cache.close()
+
+
+    def load_model_from_help_cache(self):
+        """
+        Fill the command lists and short help from the help cache if this model and firmware
+        have been completely documented before
+        """
+        if not self.help_cache or not self.firmware_key:
+            return False
+        model_key = (self.console_prompt, self.firmware_key)
+        if self.args.refreshcache:
+            with self.shared.lock:
+                refresh = model_key not in self.shared.refreshed_models
+                self.shared.refreshed_models.add(model_key)
+            if refresh:
+                self.help_cache.invalidate(self.console_prompt, self.firmware_key)
+                return False
+        model = self.help_cache.get_model(self.console_prompt, self.firmware_key)
+        if not model:
+            return False
+        self.pub_command_list, self.hidden_command_list, self.unpublished_command_list, cached_help = model
+        for command, short_help in cached_help.items():
+            if command not in self.help_dict:
+                self.help_dict[command] = short_help
+        self.log("Documenting {0} commands from the help cache".format(len(cached_help)))
+        return True
+
+
+    def store_model_in_help_cache(self):
+        """
+        Save the command lists and short help of the documented device to the help cache
+        """
+        if self.help_cache and self.firmware_key:
+            self.help_cache.store_model(self.console_prompt, self.firmware_key, self.pub_command_list,
+                                        self.hidden_command_list, self.unpublished_command_list,
+                                        self.help_dict)
+
+
+    def load_previous_snapshot(self):
+        """
+        Load the snapshot saved by the last documentation run of this model, if there is one
+        """
+        snapshot_filename = self.console_prompt + SNAPSHOT_SUFFIX
+        if os.path.isfile(snapshot_filename):
+            try:
+                self.previous_snapshot = DeviceSnapshot.load(snapshot_filename)
+            except (ValueError, KeyError):
+                self.log("Ignoring unreadable snapshot", snapshot_filename)
+
+
+    def reuse_previous_snapshot(self):
+        """
+        In incremental mode reuse the long help of every command listed exactly as in the last
+        run. Returns True if the firmware is unchanged and the unpublished commands found by
+        the last run were reused instead of probing the candidates again.
+        """
+        if not self.args.incremental or not self.previous_snapshot:
+            return False
+        same_firmware = self.previous_snapshot.firmware_key == self.firmware_key
+        if same_firmware:
+            for command in self.previous_snapshot.unpublished:
+                if command not in self.unpublished_command_set:
+                    self.unpublished_command_set.add(command)
+                    self.unpublished_command_list.append(command)
+                    self.help_dict.setdefault(command, "")
+            self.log("Firmware unchanged since the last run, reusing its", len(self.unpublished_command_list),
+                     "unpublished commands")
+        reused = 0
+        for command in self.pub_command_list + self.hidden_command_list + self.unpublished_command_list:
+            if command in self.help_store or command in self.do_not_execute_command_list:
+                continue
+            long_help = self.previous_snapshot.reusable_help(command, self.help_dict.get(command, ""))
+            if long_help is not None:
+                self.help_store[command] = long_help
+                self.snapshot_help.add(command)
+                reused += 1
+        self.log("Reusing the help text of {0} unchanged commands from the last run".format(reused))
+        return same_firmware
+
+
+    def save_snapshot(self, snapshot):
+        """
+        Save the snapshot of this run and add the changes since the last run to the changelog
+        """
+        if not snapshot.published and not snapshot.hidden and not snapshot.unpublished:
+            return
+        if self.previous_snapshot:
+            changes = snapshot.changes_since(self.previous_snapshot)
+            self.log("")
+            for line in append_changelog(self.console_prompt + CHANGELOG_SUFFIX, self.console_prompt, changes):
+                self.log(line)
+        snapshot.save(self.console_prompt + SNAPSHOT_SUFFIX)
+
+
+    def document_commands(self):
+        """
+        Find and document the commands of the connected device
+        """
+        try:
+            self.open_help_cache()
+            self.load_previous_snapshot()
+            if not self.load_model_from_help_cache():
+                self.get_published_command_list()
+                self.get_hidden_command_list()
+                if not self.reuse_previous_snapshot():
+                    self.test_for_unpublished_commands()
+                    self.commit_help_cache()
+            self.collect_command_help()
+            self.commit_help_cache()
+            command_model = DeviceSnapshot.from_documenter(self)
+            self.write_documentation(command_model)
+            self.store_model_in_help_cache()
+            self.save_snapshot(command_model)
+            self.log_help_statistics()
+        finally:
+            self.close_help_cache()
+
+
+    def handshake_devices(self, ip_addresses):
+        """
+        Read the console prompt and firmware version of many devices at once over a single
+        ConsoleReactor and return a DeviceResult for each, with status "connected" if both
+        were found. Devices that could not be reached are tried again over the next
+        transport console_endpoints() gives for them.
+        """
+        sessions = {}
+        versions = {}
+        attempted = {}
+        pending = list(ip_addresses)
+        attempt = 0
+        while pending:
+            attempt_sessions = []
+            for ip_address in pending:
+                transport, port = self.console_endpoints(ip_address)[attempt]
+                username, password = self.device_credentials(ip_address)
+                session = ConsoleSession(ip_address, port, use_ssh=transport == "ssh", username=username,
+                                         password=password, connect_timeout=SOCKET_TIMEOUT,
+                                         command_timeout=COMMAND_TIMEOUT, nudge_interval=NUDGE_INTERVAL,
+                                         max_prompt_attempts=MAX_RETRIES, max_reconnects=1,
+                                         terminal_width=SSH_TERMINAL_WIDTH)
+                versions[ip_address] = session.send_command("ver")
+                sessions[ip_address] = session
+                attempted.setdefault(ip_address, []).append(port)
+                attempt_sessions.append(session)
+            ConsoleReactor().run_sessions(attempt_sessions, max(1, self.args.sweepconcurrency))
+            attempt += 1
+            pending = [session.ip_address for session in attempt_sessions if not session.connected and
+                       len(self.console_endpoints(session.ip_address)) > attempt]
+        results = []
+        for ip_address in ip_addresses:
+            session = sessions[ip_address]
+            version = versions[ip_address]
+            self.round_trips += session.round_trips
+            self.bytes_read += session.bytes_read
+            if version.response is not None and self.shared.metrics:
+                self.shared.metrics.record_command(session.ip_address, session.console_prompt, "handshake_devices",
+                                                   version.elapsed, version.bytes_read, version.nudges,
+                                                   version.timed_out)
+            if version.response is not None and self.shared.tracer:
+                self.shared.tracer.write({"kind": "command", "device": session.ip_address,
+                                          "console_prompt": session.console_prompt, "phase": "handshake_devices",
+                                          "command": version.command, "elapsed_ms": round(version.elapsed * 1000, 3),
+                                          "bytes": version.bytes_read, "nudges": version.nudges, "retry": 0,
+                                          "timed_out": version.timed_out})
+            result = DeviceResult(session.ip_address)
+            if session.ip_address in self.shared.discovered_devices:
+                result.hostname = self.shared.discovered_devices[session.ip_address].hostname
+            result.elapsed = session.finished - session.started
+            result.latency = session.latency.statistics()
+            output = ["Attempting to connect to {0} port {1}".format(session.ip_address, port)
+                      for port in attempted[ip_address]]
+            if not session.connected:
+                output.append("Error: Unable to connect to device.")
+                result.status = "unreachable"
+            elif not session.console_prompt or session.console_prompt == "MERCURY":
+                output.append(session.error)
+                result.status = "no console prompt"
+            elif version.response is None:
+                output.append(session.error)
+                result.status = "error"
+                result.console_prompt = session.console_prompt
             else:
-                color = special_command_color
-                class_name = "hid"
-            if command in self.do_not_execute_command_list:
-                short_help = self.help_dict[command].split("|")[0]
-                long_help = self.help_dict[command].split("|")[1]
+                result.status = "connected"
+                result.transport = "ssh" if session.use_ssh else "ctp"
+                if self.shared.transports:
+                    self.shared.transports.record(ip_address, result.transport, session.port)
+                result.console_prompt = session.console_prompt
+                result.firmwareversion = parse_firmware_version(version.response,
+                                                                session.console_prompt + ">")
+                result.firmware_key = firmware_key(result.firmwareversion)
+                output.append("Console prompt is " + result.console_prompt)
+                output.append("Firmware version  " + result.firmwareversion)
+            result.output = "\n".join(output) + "\n"
+            results.append(result)
+        return results
+
+
+    def document_device(self, ip_address):
+        """
+        Document a single device and return its DeviceResult
+        """
+        result = DeviceResult(ip_address)
+        start_time = time()
+        if ip_address in self.shared.discovered_devices:
+            result.hostname = self.shared.discovered_devices[ip_address].hostname
+        self.device_ip_address = ip_address
+        self.initialize_run_variables()
+        self.load_do_not_execute_command_list()
+        # Some consoles only allow a single session so never connect to the same device twice at once
+        with self.shared.named_lock("ip:" + ip_address):
+            if not self.open_device_connection():
+                result.status = "unreachable"
+            elif not self.get_console_prompt():
+                result.status = "no console prompt"
+                self.close_device_connection()
             else:
-                short_help = self.help_dict[command]
-                long_help = self.get_command_help(command)
-            htmlfile.write("<tr class=\"" + class_name + "\" bgcolor=\"#C0C0C0\">\n  <th width=\"20%\"><font color=\"" +
-                           color + "\">" + command +
-                           "</font></th>\n  <th align=\"left\"><font color=\"" +
-                           color + "\">&nbsp;" + short_help +
-                           "</font></th>\n</tr>\n")
-            htmlfile.write("<tr>\n  <td colspan=\"2\">\n<pre>" + long_help +
-                           "</pre>\n</td>\n</tr>\n")
-            print("(" + str(index) + ")" + command + " ", end="")
-            sys.stdout.flush()
-        htmlfile.write("</table>\n</font>\n")
-        htmlfile.write("</body>\n</html>")
+                result.console_prompt = self.console_prompt
+                result.transport = self.transport
+                # Devices reporting the same prompt share a documentation file
+                with self.shared.named_lock("prompt:" + self.console_prompt):
+                    try:
+                        self.get_firmware_version()
+                        result.firmwareversion = self.firmwareversion
+                        result.firmware_key = self.firmware_key
+                        model_key = (self.console_prompt, self.firmware_key)
+                        representative = self.shared.documented_models.get(model_key) if self.firmware_key else None
+                        documentation_filename = report_filename(self.console_prompt, self.report_formats[0])
+                        if representative:
+                            self.log("Same model and firmware as {0}, sharing its documentation".format(
+                                representative.ip_address))
+                            result.status = "duplicate"
+                            result.representative = representative.ip_address
+                            result.htmldocfilename = representative.htmldocfilename
+                        elif not os.path.isfile(documentation_filename) or self.args.overwrite or \
+                             self.args.incremental:
+                            self.document_commands()
+                            result.status = "documented"
+                            result.htmldocfilename = self.htmldocfilename
+                            if self.firmware_key:
+                                with self.shared.lock:
+                                    self.shared.documented_models[model_key] = result
+                            if self.open_in_browser and os.path.isfile(os.path.realpath(self.htmldocfilename)):
+                                webbrowser.open_new_tab("file://" + os.path.realpath(self.htmldocfilename))
+                        else:
+                            self.log("Documentation file already found for {0}. Overwrite is off.".format(self.console_prompt))
+                            result.status = "skipped"
+                            result.htmldocfilename = documentation_filename
+                    finally:
+                        self.close_device_connection()
+        result.latency = self.latency.statistics()
+        result.elapsed = time() - start_time
+        if self.shared.metrics:
+            self.shared.metrics.finish(ip_address)
+        return result
 
 
     def generate_documentation(self):
         """
         Generate device documentation
         """
+        self.start_instrumentation()
+        try:
+            if self.args.watch > 0:
+                self.watch_devices()
+            else:
+                self.document_requested_devices()
+        finally:
+            self.stop_instrumentation()
+
+
+    def start_instrumentation(self):
+        """
+        Open the trace file and start the live metrics as requested on the command line
+        """
+        if self.args.trace:
+            self.shared.tracer = CommandTracer(self.args.trace)
+        if self.args.metricsinterval > 0 or self.args.prometheusfile:
+            self.shared.metrics = LiveMetrics(self.args.metricsinterval, self.args.prometheusfile)
+            self.shared.metrics.start()
+
+
+    def stop_instrumentation(self):
+        """
+        Stop the live metrics and close the trace file
+        """
+        if self.shared.metrics:
+            self.shared.metrics.stop()
+            self.shared.metrics = None
+        if self.shared.tracer:
+            self.shared.tracer.close()
+            self.shared.tracer = None
+
+
+    def document_requested_devices(self):
+        """
+        Locate the devices to document and document each of them. The devices of an
+        inventory file are read and documented a batch at a time.
+        """
         self.load_preseed_command_list()
+        self.evict_help_cache()
+        results = []
+        if self.args.inventory:
+            for batch in prioritized_batches(self.inventory_devices(), INVENTORY_BATCH):
+                results.extend(self.document_devices([device.ip_address for device in batch]))
+                self.shared.transports.save()
+                with self.shared.lock:
+                    for device in batch:
+                        self.shared.inventory.pop(device.ip_address, None)
+        self.locate_devices()
+        if self.active_ips_to_check:
+            results.extend(self.document_devices(self.active_ips_to_check))
+        if len(results) > 1:
+            for index_filename in write_fleet_index(results):
+                print("Fleet index written to", index_filename)
+
+
+    def inventory_devices(self):
+        """
+        Yield the devices of the inventory file, making their settings known to every
+        device session of the run
+        """
+        if self.shared.transports is None:
+            self.shared.transports = TransportState(self.args.transportstate)
+            self.shared.transports.load()
+        for device in read_inventory(self.args.inventory):
+            with self.shared.lock:
+                self.shared.inventory[device.ip_address] = device
+            yield device
+
+
+    def locate_devices(self):
+        """
+        Add the devices found by UDP discovery or the subnet sweep to the devices to check
+        """
         if self.args.autolocatecrestron:
             self.build_list_of_crestronips()
         elif self.args.autolocateactiveips:
             self.build_list_of_activeips(self.args.autolocateactiveips)
-        for self.device_ip_address in self.active_ips_to_check:
-            self.initialize_run_variables()
-            self.load_do_not_execute_command_list()
-            if self.open_device_connection():
-                if self.get_console_prompt():
-                    if not os.path.isfile(self.console_prompt + ".html") or self.args.overwrite:
-                        try:
-                            self.get_firmware_version()
-                            self.get_published_command_list()
-                            self.get_hidden_command_list()
-                            self.test_for_unpublished_commands()
-                            self.write_html_documentation()
-                        finally:
-                            self.close_device_connection()
-                            if os.path.isfile(os.path.realpath(self.htmldocfilename)):
-                                webbrowser.open_new_tab("file://" + os.path.realpath(self.htmldocfilename))
-                    else:
-                        print("Documentation file already found for {0}. Overwrite is off.".format(self.console_prompt))
 
 
-if __name__ == "__main__":
-    # pylint: disable-msg=C0103
-    print("\nStephen Genusa's Crestron Device Command Documentation Builder 1.82\n")
+    def document_devices(self, ip_addresses):
+        """
+        Document the devices, several at once with --workers, and return their DeviceResults
+        """
+        if self.args.workers > 1 and len(ip_addresses) > 1:
+            fleet = CrestronFleetDocumenter(self.args, self.shared, self.__class__)
+            results = fleet.document_devices(ip_addresses)
+            fleet.print_results()
+            return results
+        return [self.document_device(ip_address) for ip_address in ip_addresses]
+
+
+    def watch_devices(self):
+        """
+        Keep running, polling every device with the prompt and "ver" handshake about every
+        --watch seconds and documenting only the devices whose console prompt or firmware
+        version changed since they were last documented. The devices are located again
+        every --watch seconds; devices that disappear keep being polled.
+        """
+        state = WatchState(self.args.watchstate)
+        state.load()
+        # A changed device must be documented again even though documentation for its prompt exists
+        if not self.args.incremental:
+            self.args.overwrite = True
+        print("Watching devices every {0:g} seconds, state kept in {1}".format(self.args.watch, self.args.watchstate))
+        if self.args.inventory:
+            # Every watched device is polled, so the whole inventory is read
+            for device in sorted(self.inventory_devices(), key=lambda device: -device.priority):
+                if device.ip_address not in self.active_ips_to_check:
+                    self.active_ips_to_check.append(device.ip_address)
+        passes = 0
+        next_discovery = 0
+        while True:
+            now = time()
+            if now >= next_discovery:
+                self.locate_devices()
+                next_discovery = now + self.args.watch
+            located = set(self.active_ips_to_check)
+            due = state.due(self.active_ips_to_check + sorted(ip for ip in state.devices if ip not in located), now)
+            if due:
+                self.watch_pass(state, due)
+                passes += 1
+                if self.args.watchcycles and passes >= self.args.watchcycles:
+                    return
+            next_poll = state.next_poll()
+            sleep(max(0.0, min(next_discovery, next_poll if next_poll is not None else next_discovery) - time()))
+
+
+    def watch_pass(self, state, ip_addresses):
+        """
+        Poll the devices that are due and document the ones that changed. A device whose
+        documentation fails keeps its old state and is documented again at its next poll.
+        """
+        handshakes = self.handshake_devices(ip_addresses)
+        changed = [handshake.ip_address for handshake in handshakes
+                   if handshake.status == "connected" and state.changed(handshake)]
+        for handshake in handshakes:
+            state.polled(handshake, self.args.watch, self.args.watchjitter)
+            if self.shared.metrics:
+                self.shared.metrics.finish(handshake.ip_address)
+        state.save()
+        if self.shared.transports:
+            self.shared.transports.save()
+        print("{0} Polled {1} devices: {2} unchanged, {3} changed, {4} not answering".format(
+            strftime("%Y-%m-%d %H:%M:%S", localtime()), len(handshakes),
+            sum(1 for handshake in handshakes if handshake.status == "connected") - len(changed), len(changed),
+            sum(1 for handshake in handshakes if handshake.status != "connected")))
+        sys.stdout.flush()
+        if not changed:
+            return
+        self.load_preseed_command_list()
+        self.evict_help_cache()
+        # Each pass documents its changed models afresh
+        with self.shared.lock:
+            self.shared.documented_models.clear()
+        try:
+            results = self.document_devices(changed)
+        except Exception:
+            traceback.print_exc()
+            return
+        for result in results:
+            if result.status in ("documented", "duplicate"):
+                state.documented(result)
+        state.save()
+
+
+class CrestronSessionPool(object):
+    """
+    Additional console sessions to the device being documented so help text can be queried
+    over several connections at once. Devices that refuse a second session are documented
+    over the primary session alone.
+    """
+
+    def __init__(self, documenter):
+        """
+        initialize internal properties
+        """
+        self.documenter = documenter
+        self.sessions = []
+        self.lock = threading.Lock()
+
+
+    def open(self, size):
+        """
+        Open up to size - 1 sessions alongside the documenter's own, stopping at the first the
+        device refuses or that disturbs the primary session
+        """
+        documenter = self.documenter
+        while len(self.sessions) < size - 1:
+            # A subclass such as the benchmark's documenter opens sessions of its own class
+            session = documenter.__class__(documenter.args, documenter.shared)
+            session.output_buffer = []
+            session.open_in_browser = False
+            session.device_ip_address = documenter.device_ip_address
+            session.initialize_run_variables()
+            if not session.open_device_connection():
+                break
+            try:
+                accepted = session.get_console_prompt() and session.console_prompt == documenter.console_prompt
+            except (socket.error, EOFError, paramiko.SSHException):
+                accepted = False
+            if not accepted:
+                session.close_device_connection()
+                break
+            # Single session consoles may drop the first session when another one logs in
+            if not documenter.session_alive():
+                session.close_device_connection()
+                self.close()
+                documenter.log("Console session was dropped when a second session opened, reconnecting")
+                if not documenter.open_device_connection() or not documenter.get_console_prompt():
+                    raise socket.error("Unable to reconnect to the device")
+                break
+            self.sessions.append(session)
+        documenter.log("Using {0} console session(s)".format(len(self.sessions) + 1))
+
+
+    def query_help_texts(self, commands):
+        """
+        Query the help of the commands across every session and return the help text of each
+        command answered. Commands left unanswered by a failed session are simply missing from
+        the result and get queried later on the primary session.
+        """
+        chunks = Queue.Queue()
+        for start in range(0, len(commands), SESSION_POOL_CHUNK):
+            chunks.put(commands[start:start + SESSION_POOL_CHUNK])
+        help_texts = {}
+        failed_sessions = []
+        threads = []
+        for session in self.sessions:
+            session.phase = self.documenter.phase
+            thread = threading.Thread(target=self.worker, args=(session, chunks, help_texts, failed_sessions))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        self.worker(self.documenter, chunks, help_texts, failed_sessions)
+        for thread in threads:
+            thread.join()
+        for session in list(self.sessions):
+            # Count the pooled sessions' traffic as the device's own
+            self.documenter.round_trips += session.round_trips
+            self.documenter.bytes_read += session.bytes_read
+            self.documenter.timed_out_commands.extend(session.timed_out_commands)
+            session.round_trips = 0
+            session.bytes_read = 0
+            session.timed_out_commands = []
+            if session in failed_sessions:
+                self.sessions.remove(session)
+                session.close_device_connection()
+        return help_texts
+
+
+    def worker(self, session, chunks, help_texts, failed_sessions):
+        """
+        Query chunks of commands on one session until the queue is empty. A pooled session
+        that fails stops working; a failure of the primary session is raised.
+        """
+        while True:
+            try:
+                chunk = chunks.get_nowait()
+            except Queue.Empty:
+                return
+            if session is self.documenter:
+                answered = session.query_help_texts(chunk)
+            else:
+                try:
+                    answered = session.query_help_texts(chunk)
+                except (socket.error, EOFError, paramiko.SSHException):
+                    with self.lock:
+                        failed_sessions.append(session)
+                    return
+            with self.lock:
+                help_texts.update(answered)
+
+
+    def close(self):
+        """
+        Close the pooled sessions
+        """
+        for session in self.sessions:
+            session.close_device_connection()
+        self.sessions = []
+
+
+class CrestronFleetDocumenter(object):
+    """
+    Document many Crestron devices concurrently, each with its own device session
+    """
+
+    def __init__(self, args, shared, documenter_class=CrestronDeviceDocumenter):
+        """
+        initialize internal properties
+        """
+        self.args = args
+        self.shared = shared
+        self.documenter_class = documenter_class
+        self.workers = max(1, args.workers)
+        self.results = []
+        self.device_order = {}
+        self.device_count = 0
+
+
+    def document_devices(self, ip_addresses):
+        """
+        Document the devices using a pool of worker threads and collect their results. Every
+        device is first asked for its console prompt and firmware version; one device of each
+        model/firmware combination is then documented and the others share its documentation.
+        """
+        for ip_address in ip_addresses:
+            if ip_address not in self.device_order:
+                self.device_order[ip_address] = len(self.device_order)
+        self.device_count = len(self.device_order)
+        ordered_ips = sorted(self.device_order, key=self.device_order.get)
+        print("Documenting {0} devices using {1} workers".format(self.device_count, self.workers))
+        handshakes = self.handshake_devices(ordered_ips)
+        model_groups = collections.OrderedDict()
+        for ip_address in ordered_ips:
+            handshake = handshakes[ip_address]
+            if handshake.status != "connected":
+                self.add_result(handshake)
+            elif handshake.firmware_key:
+                model_groups.setdefault((handshake.console_prompt, handshake.firmware_key), []).append(handshake)
+            else:
+                # Without a firmware version there is nothing to match on
+                model_groups[(handshake.console_prompt, ip_address)] = [handshake]
+        print("Found {0} distinct model/firmware combinations".format(len(model_groups)))
+        self.run_workers(self.model_group_worker, list(model_groups.values()))
+        return self.results
+
+
+    def run_workers(self, target, items, *args):
+        """
+        Call target(item, *args) for every item using the worker threads
+        """
+        work_queue = Queue.Queue()
+        for item in items:
+            work_queue.put(item)
+        threads = []
+        for _unused in range(0, min(self.workers, len(items))):
+            thread = threading.Thread(target=self.worker, args=(work_queue, target) + args)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        # Join with a timeout so Ctrl-C is still delivered to the main thread
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(0.5)
+
+
+    @staticmethod
+    def worker(work_queue, target, *args):
+        """
+        Take items from the queue until it is empty
+        """
+        while True:
+            try:
+                item = work_queue.get_nowait()
+            except Queue.Empty:
+                return
+            target(item, *args)
+
+
+    def run_documenter(self, method, ip_address):
+        """
+        Run a documenter method for a device, capturing its output and any error in the result
+        """
+        documenter = self.documenter_class(self.args, self.shared)
+        documenter.output_buffer = []
+        documenter.open_in_browser = False
+        try:
+            result = method(documenter, ip_address)
+        except Exception:
+            result = DeviceResult(ip_address)
+            result.status = "error"
+            result.error = traceback.format_exc()
+            result.console_prompt = documenter.console_prompt
+            documenter.close_device_connection()
+        result.output = "".join(documenter.output_buffer)
+        return result
+
+
+    def handshake_devices(self, ip_addresses):
+        """
+        Read the console prompt and firmware version of every device at once
+        """
+        documenter = self.documenter_class(self.args, self.shared)
+        documenter.output_buffer = []
+        return dict((result.ip_address, result) for result in documenter.handshake_devices(ip_addresses))
+
+
+    def model_group_worker(self, handshakes):
+        """
+        Document the first device of a model group that can be documented and mark the rest
+        of the group as sharing its documentation
+        """
+        first = handshakes[0]
+        with self.shared.lock:
+            representative = self.shared.documented_models.get((first.console_prompt, first.firmware_key)) \
+                if first.firmware_key else None
+        # A model documented earlier in the run, e.g. from an earlier inventory batch, is not documented again
+        remaining = handshakes
+        if representative is None:
+            for index, handshake in enumerate(handshakes):
+                result = self.run_documenter(self.documenter_class.document_device, handshake.ip_address)
+                self.add_result(result)
+                if result.status in ("documented", "skipped", "duplicate"):
+                    representative = result
+                    remaining = handshakes[index + 1:]
+                    break
+            if representative is None:
+                return
+        for handshake in remaining:
+            handshake.status = "duplicate"
+            handshake.representative = representative.representative or representative.ip_address
+            handshake.htmldocfilename = representative.htmldocfilename
+            handshake.output = "Same model and firmware as {0}, sharing its documentation\n".format(
+                representative.ip_address)
+            self.add_result(handshake)
+
+
+    def add_result(self, result):
+        """
+        Record the result of a device and report progress
+        """
+        with self.shared.lock:
+            self.results.append(result)
+            print("[{0}/{1}] {2} {3} {4}".format(len(self.results), self.device_count, result.ip_address,
+                                                 result.console_prompt, result.status))
+
+
+    def print_results(self):
+        """
+        Print the collected output of every device followed by a summary
+        """
+        self.results.sort(key=lambda result: self.device_order[result.ip_address])
+        for result in self.results:
+            print("\n" + "=" * 25, result.ip_address, result.hostname, result.console_prompt, "=" * 25)
+            print(result.output)
+            if result.error:
+                print(result.error)
+        print("\n" + "=" * 25, "Summary", "=" * 25)
+        for result in self.results:
+            print("{0:<16} {1:<20} {2:<20} {3:<18} {4:>8.1f}s  {5}".format(result.ip_address, result.hostname,
+                                                                           result.console_prompt, result.status,
+                                                                           result.elapsed, result.htmldocfilename))
+
+
+def build_argument_parser():
+    """
+    Command line options shared by the documenter and the tools built on it
+    """
     parser = argparse.ArgumentParser()
     parser.add_argument("-ip", "--iptocheck", help="A single Crestron IP address to build documentation for.")
     parser.add_argument("-fssh", "--forcessh", action="store_true",
@@ -690,14 +1977,68 @@ if __name__ == "__main__":
                         help="Authentication password.")
     parser.add_argument("-alc", "--autolocatecrestron", action="store_true",
                         help="Automatically locate Crestron devices on all connected subnets and build documentation.")
+    parser.add_argument("--discoveryquiet", default=1.5, type=float,
+                        help="Stop UDP discovery once no new device has replied for this many seconds. Default is 1.5.")
+    parser.add_argument("--discoverytimeout", default=10.0, type=float,
+                        help="Maximum number of seconds to spend on UDP discovery. Default is 10.")
     parser.add_argument("-ala", "--autolocateactiveips", default="", type=str,
-                        help="Automatically locate active IPs on a subnet and look for Crestron devices. Example: 174.209.101 as an argument will check 174.209.101.0/24.")
+                        help="Automatically locate IPs with an open Crestron console port on a subnet. Example: 174.209.101 as an argument will check 174.209.101.0/24. CIDR ranges like 174.209.100.0/22 are also accepted.")
+    parser.add_argument("--sweepconcurrency", default=200, type=int,
+                        help="Maximum number of connection attempts in flight during a subnet sweep, and of console sessions open at once while a fleet run reads every device's prompt and firmware. Default is 200.")
+    parser.add_argument("--sweeptimeout", default=1.0, type=float,
+                        help="Seconds to wait for a console port to accept a connection during a subnet sweep. Default is 1.0.")
+    parser.add_argument("-inv", "--inventory", default="", type=str,
+                        help="CSV (with a header row) or JSON lines file of devices to document with the fields ip, transport (ctp, ssh or empty to try CTP and then SSH), port, username, password and priority. Missing fields use the command line settings. Devices with a higher priority are documented first within each batch of 100.")
+    parser.add_argument("--transportstate", default=TRANSPORT_STATE_FILENAME, type=str,
+                        help="File recording the transport each inventory device answered on, tried first on later runs.")
     parser.add_argument("-atc", "--addtestcommands", default='',
                         help="Filename containing additional commands to test for")
     parser.add_argument("-ow", "--overwrite", action="store_true", default=False,
                         help="Overwrite doc file if it already exists. Off by default.")
+    parser.add_argument("-inc", "--incremental", action="store_true", default=False,
+                        help="Re-document devices that already have documentation, querying help only for new or changed commands and probing for unpublished commands only if the firmware changed. Changes are added to <prompt>.changelog.txt.")
+    parser.add_argument("-rs", "--resume", action="store_true", default=False,
+                        help="Continue an interrupted search for unpublished commands from its checkpoint (<prompt>.checkpoint.jsonl) instead of testing every candidate again.")
+    parser.add_argument("-of", "--outputformats", default="html", type=report_formats_argument,
+                        help="Comma separated documentation formats to write: html, json, md. Default is html.")
+    parser.add_argument("-hc", "--helpcache", default="helpcache.db", type=str,
+                        help="SQLite file used to cache help text by model and firmware version. Pass an empty string to disable.")
+    parser.add_argument("-rc", "--refreshcache", action="store_true", default=False,
+                        help="Ignore and replace cached help text for the devices being documented.")
+    parser.add_argument("--cachemaxage", default=90, type=int,
+                        help="Evict cached models not used within this many days. Default is 90, 0 disables.")
+    parser.add_argument("--cachemaxmodels", default=500, type=int,
+                        help="Maximum number of model/firmware combinations kept in the help cache. Default is 500, 0 disables.")
+    parser.add_argument("-w", "--workers", default=1, type=int,
+                        help="Number of devices to document concurrently. Default is 1.")
+    parser.add_argument("-ss", "--sessions", default=1, type=int,
+                        help="Number of console sessions per device used to query help text. 0 opens as many as the device accepts, up to 4. Devices that refuse a second session use one. Default is 1.")
+    parser.add_argument("-pl", "--pipeline", default=0, type=int,
+                        help="Send up to this many help queries without waiting for each prompt. Consoles that do not answer in order fall back to one query at a time. Default is 0 (off).")
+    parser.add_argument("-wa", "--watch", default=0.0, type=float,
+                        help="Keep running and poll the devices about every this many seconds, documenting only devices whose console prompt or firmware version changed. Default is 0 (document once and exit).")
+    parser.add_argument("--watchjitter", default=0.1, type=float,
+                        help="Vary each device's poll interval by up to this fraction so polls spread out. Default is 0.1.")
+    parser.add_argument("--watchstate", default=WATCH_STATE_FILENAME, type=str,
+                        help="File keeping the prompt and firmware each watched device was documented with.")
+    parser.add_argument("--watchcycles", default=0, type=int,
+                        help="Stop watching after this many polling passes. Default is 0 (run until interrupted).")
+    parser.add_argument("-tr", "--trace", default="", type=str,
+                        help="Append a JSON line per console command and per phase (latency, bytes, nudges, retries) to this file.")
+    parser.add_argument("-mi", "--metricsinterval", default=0.0, type=float,
+                        help="Seconds between live throughput and latency reports, which replace the list of commands printed as their help is collected. Default is 0 (off).")
+    parser.add_argument("-pf", "--prometheusfile", default="", type=str,
+                        help="Keep the live metrics in this file in the Prometheus text format, e.g. for the node_exporter textfile collector.")
+    return parser
+
+
+if __name__ == "__main__":
+    # pylint: disable-msg=C0103
+    print("\nStephen Genusa's Crestron Device Command Documentation Builder 1.82\n")
+    parser = build_argument_parser()
     parser_args = parser.parse_args()
-    if not parser_args.iptocheck and not parser_args.autolocatecrestron and not parser_args.autolocateactiveips:
+    if not parser_args.iptocheck and not parser_args.autolocatecrestron and not parser_args.autolocateactiveips and \
+       not parser_args.inventory:
         parser.print_help()
         exit()
 
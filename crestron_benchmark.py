@@ -0,0 +1,454 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Benchmark the documentation pipeline against simulated devices. Every scenario starts a
+fleet of simulated consoles with synthetic command sets, runs generate_documentation against
+them and records wall time, console round trips, bytes read and peak memory per phase.
+Results are saved as JSON and can be compared against an earlier run to catch slowdowns.
+
+Copyright © 2017 by Stephen Genusa. Distributed under the license in LICENSE.txt
+"""
+
+from __future__ import print_function
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+from time import sleep, time
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory is reported as 0
+    resource = None
+#
+from BuildCrestronCommandReference import CrestronDeviceDocumenter, build_argument_parser, CTP_PORT
+from crestron_simulator import DeviceTranscript, NEW_LINE
+
+# (phase name, CrestronDeviceDocumenter method timed as that phase)
+PHASES = (("discovery", "build_list_of_activeips"),
+          ("get_console_prompt", "get_console_prompt"),
+          ("get_firmware_version", "get_firmware_version"),
+          ("get_published_command_list", "get_published_command_list"),
+          ("get_hidden_command_list", "get_hidden_command_list"),
+          ("test_for_unpublished_commands", "test_for_unpublished_commands"),
+          ("collect_command_help", "collect_command_help"),
+          ("write_documentation", "write_documentation"))
+# Methods that start a new device run; their totals are the device traffic of the scenario
+DEVICE_TOTALS = (("handshake", "handshake_devices"), ("document_device", "document_device"))
+# Devices x commands x candidate words
+STANDARD_SCENARIOS = ("1x100x1000", "1x2000x1000", "1x100x100000", "10x500x1000", "200x100x1000")
+FULL_SCENARIOS = tuple("{0}x{1}x{2}".format(devices, commands, candidates)
+                       for devices in (1, 10, 200)
+                       for commands in (100, 2000)
+                       for candidates in (1000, 100000))
+SIMULATED_SUBNET = "127.77.0"
+SIMULATOR_STARTUP_TIMEOUT = 60.0
+# Resolved at import time, the scenarios run in their own working directories
+SIMULATOR_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "crestron_simulator.py")
+# Changes smaller than this are timer noise, not regressions
+MIN_REGRESSION_SECONDS = 0.05
+COMMAND_STEMS = ("AUDIO", "VIDEO", "IP", "TIME", "USB", "HDMI", "DBG", "PROG", "ETH", "SSL",
+                 "USER", "FILE", "LOG", "CRESNET", "IR", "RELAY", "DHCP", "CERT", "ROUTE", "EDID")
+COMMAND_VERBS = ("SET", "GET", "SHOW", "TEST", "RESET", "")
+HELP_WORDS = ("the", "device", "port", "value", "enable", "disable", "current", "setting", "address",
+              "slot", "program", "status", "mode", "optional", "default", "reboot", "required")
+
+
+def peak_rss_kb():
+    """
+    Peak resident memory of this process in KB
+    """
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and KB elsewhere
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+class PhaseRecorder(object):
+    """
+    Thread safe totals of the time, round trips and bytes read spent in each phase
+    """
+
+    def __init__(self):
+        """
+        initialize internal properties
+        """
+        self.lock = threading.Lock()
+        self.phases = {}
+
+
+    def record(self, phase, started, finished, round_trips, bytes_read):
+        """
+        Add one call of a phase
+        """
+        with self.lock:
+            totals = self.phases.setdefault(phase, {"calls": 0, "seconds": 0.0, "max_seconds": 0.0,
+                                                    "first_start": started, "last_end": finished,
+                                                    "round_trips": 0, "bytes_read": 0, "peak_rss_kb": 0})
+            totals["calls"] += 1
+            totals["seconds"] += finished - started
+            totals["max_seconds"] = max(totals["max_seconds"], finished - started)
+            totals["first_start"] = min(totals["first_start"], started)
+            totals["last_end"] = max(totals["last_end"], finished)
+            totals["round_trips"] += round_trips
+            totals["bytes_read"] += bytes_read
+            totals["peak_rss_kb"] = max(totals["peak_rss_kb"], peak_rss_kb())
+
+
+    def results(self, phase):
+        """
+        The totals of a phase. span_seconds is the wall time from the first call starting to
+        the last call ending, which is less than seconds when devices are documented concurrently.
+        """
+        totals = dict(self.phases.get(phase, {"calls": 0, "seconds": 0.0, "max_seconds": 0.0,
+                                              "first_start": 0.0, "last_end": 0.0,
+                                              "round_trips": 0, "bytes_read": 0, "peak_rss_kb": 0}))
+        totals["span_seconds"] = totals.pop("last_end") - totals.pop("first_start")
+        for key in ("seconds", "max_seconds", "span_seconds"):
+            totals[key] = round(totals[key], 4)
+        return totals
+
+
+def timed_phase(phase, method, resets_counters=False):
+    """
+    Wrap a documenter method so every call is recorded as the given phase.
+    resets_counters is set for methods that start a new device run and zero the counters.
+    """
+    def timed(self, *args, **kwargs):
+        """
+        Call the wrapped method and record its cost
+        """
+        round_trips = 0 if resets_counters else self.round_trips
+        bytes_read = 0 if resets_counters else self.bytes_read
+        started = time()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.recorder.record(phase, started, time(), self.round_trips - round_trips,
+                                 self.bytes_read - bytes_read)
+    timed.__name__ = method.__name__
+    timed.__doc__ = method.__doc__
+    return timed
+
+
+class BenchmarkDocumenter(CrestronDeviceDocumenter):
+    """
+    Documenter that records the cost of each phase of the pipeline
+    """
+    recorder = None
+
+
+for _phase, _method_name in PHASES:
+    setattr(BenchmarkDocumenter, _method_name,
+            timed_phase(_phase, CrestronDeviceDocumenter.__dict__[_method_name]))
+for _phase, _method_name in DEVICE_TOTALS:
+    setattr(BenchmarkDocumenter, _method_name,
+            timed_phase(_phase, CrestronDeviceDocumenter.__dict__[_method_name], resets_counters=True))
+
+
+def synthetic_command_names(count, rng):
+    """
+    Unique command names that look like a Crestron command set, including commands that
+    are prefixes of other commands
+    """
+    names = set(["HELP", "HIDHELP", "VER"])
+    command_names = []
+    while len(command_names) < count:
+        name = rng.choice(COMMAND_VERBS) + rng.choice(COMMAND_STEMS)
+        if rng.random() < 0.5:
+            name += rng.choice(COMMAND_STEMS)
+        if rng.random() < 0.3:
+            name += str(rng.randint(1, 99))
+        if name not in names and len(name) <= 25:
+            names.add(name)
+            command_names.append(name)
+    return command_names
+
+
+def synthetic_help_text(command, rng):
+    """
+    Long help text for a command
+    """
+    lines = [command + " help:", "  usage: {0} [{1}]".format(command, "|".join(rng.sample(COMMAND_STEMS, 3)))]
+    for _unused in range(rng.randint(2, 8)):
+        lines.append("  " + " ".join(rng.choice(HELP_WORDS) for _unused2 in range(rng.randint(6, 14))))
+    return NEW_LINE.join(lines)
+
+
+def build_synthetic_transcript(console_prompt, command_count, rng):
+    """
+    A transcript with command_count commands: 70% published, 25% hidden and 5% unpublished.
+    Returns the transcript and the unpublished command names.
+    """
+    commands = synthetic_command_names(command_count, rng)
+    published_count = int(command_count * 0.70)
+    hidden_count = int(command_count * 0.25)
+    published = commands[:published_count]
+    hidden = commands[published_count:published_count + hidden_count]
+    unpublished = commands[published_count + hidden_count:]
+    descriptions = dict((command, " ".join(rng.sample(HELP_WORDS, 3)).capitalize()) for command in commands)
+    transcript = DeviceTranscript(console_prompt)
+    transcript.add_response("", NEW_LINE + NEW_LINE)
+    transcript.add_response("ver", "ver" + NEW_LINE + console_prompt +
+                            " Cntrl Eng [v1.601.3935.26568 (Jan 26 2018), #00000000] @E-00107f4c47d2" +
+                            NEW_LINE + NEW_LINE)
+    transcript.add_response("help all", "help all" + NEW_LINE + "".join(
+        "{0:<20} Operator   {1}{2}".format(command, descriptions[command], NEW_LINE)
+        for command in sorted(published)) + NEW_LINE)
+    transcript.add_response("hidhelp all", "hidhelp all" + NEW_LINE + "".join(
+        "{0:<20} Programmer {1}{2}".format(command, descriptions[command], NEW_LINE)
+        for command in sorted(published + hidden)) + NEW_LINE)
+    for command in commands:
+        transcript.add_response(command + " ?", command + " ?" + NEW_LINE +
+                                synthetic_help_text(command, rng) + NEW_LINE + NEW_LINE)
+    return transcript, commands, unpublished
+
+
+def build_candidate_words(count, commands, unpublished, rng):
+    """
+    Candidate command words: every unpublished command, abbreviations of known commands
+    (which the console resolves and the documenter must recognise) and random words
+    """
+    words = set(unpublished)
+    for command in rng.sample(commands, min(len(commands), max(1, count // 50))):
+        if len(command) > 3:
+            words.add(command[:rng.randint(3, len(command) - 1)])
+    letters = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    while len(words) < count:
+        words.add("".join(rng.choice(letters) for _unused in range(rng.randint(3, 12))))
+    words = sorted(words)
+    rng.shuffle(words)
+    return words[:count]
+
+
+def wait_for_simulators(hosts, timeout):
+    """
+    Wait until every simulated console accepts connections
+    """
+    deadline = time() + timeout
+    for host in hosts:
+        while True:
+            try:
+                socket.create_connection((host, CTP_PORT), 1.0).close()
+                break
+            except socket.error:
+                if time() > deadline:
+                    raise RuntimeError("Simulated console on {0} did not start".format(host))
+                sleep(0.1)
+
+
+def parse_scenario(scenario):
+    """
+    Split DEVICESxCOMMANDSxCANDIDATES into three integers
+    """
+    try:
+        devices, commands, candidates = [int(value) for value in scenario.lower().split("x")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("Scenario must look like 10x500x1000, not " + scenario)
+    if not 1 <= devices <= 254:
+        raise argparse.ArgumentTypeError("Scenarios are limited to 1-254 devices")
+    return devices, commands, candidates
+
+
+def run_scenario(bench_args, scenario):
+    """
+    Start the simulated devices of a scenario, document them and return the measurements
+    """
+    # pylint: disable=too-many-locals
+    device_count, command_count, candidate_count = parse_scenario(scenario)
+    model_count = min(bench_args.models or device_count, device_count)
+    work_dir = tempfile.mkdtemp(prefix="crestron_bench_")
+    original_dir = os.getcwd()
+    original_stdout = sys.stdout
+    simulator = None
+    try:
+        os.chdir(work_dir)
+        rng = random.Random(bench_args.seed)
+        all_commands = []
+        all_unpublished = []
+        for model in range(model_count):
+            transcript, commands, unpublished = build_synthetic_transcript("BENCH{0:03d}".format(model),
+                                                                           command_count, rng)
+            transcript.save("model{0:03d}.json".format(model))
+            all_commands.extend(commands)
+            all_unpublished.extend(unpublished)
+        with open("candidates.txt", "w") as candidate_file:
+            for word in build_candidate_words(candidate_count, all_commands, all_unpublished, rng):
+                candidate_file.write(word + "\n")
+
+        hosts = ["{0}.{1}".format(SIMULATED_SUBNET, device + 1) for device in range(device_count)]
+        simulator_command = [sys.executable, SIMULATOR_SCRIPT, "serve", "--latency", str(bench_args.latency),
+                             "--rtt", str(bench_args.rtt)]
+        simulator_command += ["model{0:03d}.json@{1}".format(device % model_count, host)
+                              for device, host in enumerate(hosts)]
+        with open(os.devnull, "w") as devnull:
+            simulator = subprocess.Popen(simulator_command, stdout=devnull, stderr=devnull)
+        wait_for_simulators(hosts, SIMULATOR_STARTUP_TIMEOUT)
+
+        args = build_argument_parser().parse_args(["-ala", SIMULATED_SUBNET, "-atc", "candidates.txt", "-ow",
+                                                   "-hc", "", "-w", str(bench_args.workers),
+                                                   "--sweeptimeout", str(bench_args.sweeptimeout),
+                                                   "-pl", str(bench_args.pipeline), "-ss", str(bench_args.sessions)])
+        BenchmarkDocumenter.recorder = PhaseRecorder()
+        documenter = BenchmarkDocumenter(args)
+        documenter.open_in_browser = False
+        if not bench_args.verbose:
+            sys.stdout = open(os.devnull, "w")
+        started = time()
+        documenter.generate_documentation()
+        wall_seconds = time() - started
+    finally:
+        if sys.stdout is not original_stdout:
+            sys.stdout.close()
+            sys.stdout = original_stdout
+        if simulator:
+            simulator.terminate()
+            simulator.wait()
+        os.chdir(original_dir)
+        if bench_args.keep:
+            print("Scenario files kept in", work_dir)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    recorder = BenchmarkDocumenter.recorder
+    device_totals = [recorder.results(phase) for phase, _unused in DEVICE_TOTALS]
+    return {"name": scenario,
+            "pipeline": bench_args.pipeline,
+            "sessions": bench_args.sessions,
+            "devices": device_count,
+            "commands": command_count,
+            "candidates": candidate_count,
+            "models": model_count,
+            "workers": bench_args.workers,
+            "latency": bench_args.latency,
+            "rtt": bench_args.rtt,
+            "devices_found": len(documenter.active_ips_to_check),
+            "devices_documented": recorder.results("write_documentation")["calls"],
+            "wall_seconds": round(wall_seconds, 4),
+            "round_trips": sum(totals["round_trips"] for totals in device_totals),
+            "bytes_read": sum(totals["bytes_read"] for totals in device_totals),
+            "peak_rss_kb": peak_rss_kb(),
+            "phases": dict((phase, recorder.results(phase)) for phase, _unused in PHASES + DEVICE_TOTALS[:1])}
+
+
+def scenario_key(scenario):
+    """
+    Scenarios are only comparable if they were run with the same settings
+    """
+    return (scenario["name"], scenario["models"], scenario["workers"], scenario["latency"],
+            scenario.get("rtt", 0.0), scenario.get("pipeline", 0), scenario.get("sessions", 1))
+
+
+def print_scenario(scenario):
+    """
+    Print the measurements of one scenario
+    """
+    print("\n{0}: {1} devices, {2} commands, {3} candidates, {4} models, {5} workers".format(
+        scenario["name"], scenario["devices"], scenario["commands"], scenario["candidates"],
+        scenario["models"], scenario["workers"]))
+    print("  {0:<31} {1:>6} {2:>10} {3:>10} {4:>12} {5:>14} {6:>12}".format(
+        "Phase", "Calls", "Seconds", "Span", "Round trips", "Bytes read", "Peak RSS KB"))
+    for phase, _unused in PHASES + DEVICE_TOTALS[:1]:
+        totals = scenario["phases"].get(phase)
+        if not totals or not totals["calls"]:
+            continue
+        print("  {0:<31} {1:>6} {2:>10.3f} {3:>10.3f} {4:>12} {5:>14} {6:>12}".format(
+            phase, totals["calls"], totals["seconds"], totals["span_seconds"], totals["round_trips"],
+            totals["bytes_read"], totals["peak_rss_kb"]))
+    print("  {0:<31} {1:>6} {2:>10.3f} {3:>10} {4:>12} {5:>14} {6:>12}".format(
+        "Total wall time", scenario["devices_documented"], scenario["wall_seconds"], "",
+        scenario["round_trips"], scenario["bytes_read"], scenario["peak_rss_kb"]))
+
+
+def compare_results(baseline, current, threshold):
+    """
+    Print the change of every scenario and phase against a baseline run and return the
+    number of regressions: more than threshold percent slower or more round trips
+    """
+    regressions = 0
+    baseline_scenarios = dict((scenario_key(scenario), scenario) for scenario in baseline["scenarios"])
+    print("\nComparison with {0} ({1})".format(baseline.get("label") or "baseline", baseline.get("created", "")))
+    for scenario in current["scenarios"]:
+        previous = baseline_scenarios.get(scenario_key(scenario))
+        if not previous:
+            print("\n{0}: not in baseline".format(scenario["name"]))
+            continue
+        print("\n{0}:".format(scenario["name"]))
+        measurements = [("Total wall time", previous["wall_seconds"], scenario["wall_seconds"],
+                         previous["round_trips"], scenario["round_trips"])]
+        for phase, _unused in PHASES + DEVICE_TOTALS[:1]:
+            old_phase = previous["phases"].get(phase)
+            if old_phase:
+                new_phase = scenario["phases"][phase]
+                measurements.append((phase, old_phase["seconds"], new_phase["seconds"],
+                                     old_phase["round_trips"], new_phase["round_trips"]))
+        for name, old_seconds, new_seconds, old_trips, new_trips in measurements:
+            change = (new_seconds - old_seconds) * 100.0 / old_seconds if old_seconds else 0.0
+            slower = change > threshold and new_seconds - old_seconds > MIN_REGRESSION_SECONDS
+            more_trips = new_trips > old_trips * (1 + threshold / 100.0)
+            flag = "REGRESSION" if slower or more_trips else ""
+            regressions += bool(flag)
+            print("  {0:<31} {1:>10.3f} -> {2:>10.3f} {3:>+8.1f}%  {4:>10} -> {5:>10}  {6}".format(
+                name, old_seconds, new_seconds, change, old_trips, new_trips, flag))
+    return regressions
+
+
+if __name__ == "__main__":
+    # pylint: disable-msg=C0103
+    parser = argparse.ArgumentParser(description="Benchmark the documenter against simulated devices")
+    parser.add_argument("-s", "--scenario", action="append", default=[],
+                        help="DEVICESxCOMMANDSxCANDIDATES to run, may be repeated. Example: 10x500x1000")
+    parser.add_argument("--matrix", choices=("standard", "full"), default="standard",
+                        help="Scenario set used when no --scenario is given. full runs every combination "
+                             "of 1/10/200 devices, 100/2000 commands and 1k/100k candidates.")
+    parser.add_argument("-w", "--workers", default=1, type=int, help="Devices documented concurrently.")
+    parser.add_argument("-m", "--models", default=0, type=int,
+                        help="Number of distinct device models. Default is one per device.")
+    parser.add_argument("-pl", "--pipeline", default=0, type=int, help="Pipelined help query window.")
+    parser.add_argument("-ss", "--sessions", default=1, type=int, help="Console sessions per device.")
+    parser.add_argument("--latency", default=0.0, type=float, help="Simulated console latency in seconds.")
+    parser.add_argument("--rtt", default=0.0, type=float, help="Simulated network round trip in seconds.")
+    parser.add_argument("--sweeptimeout", default=0.5, type=float, help="Subnet sweep connect timeout.")
+    parser.add_argument("--seed", default=2017, type=int, help="Seed for the synthetic command sets.")
+    parser.add_argument("-l", "--label", default="", help="Label stored with the results, e.g. a version.")
+    parser.add_argument("-o", "--output", default="", help="Save the results to this JSON file.")
+    parser.add_argument("-c", "--compare", default="", help="Compare with the results in this JSON file.")
+    parser.add_argument("-t", "--threshold", default=10.0, type=float,
+                        help="Percentage slowdown reported as a regression. Default is 10.")
+    parser.add_argument("-k", "--keep", action="store_true", help="Keep the generated scenario files.")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show the documenter output.")
+    parser_args = parser.parse_args()
+
+    scenarios = parser_args.scenario or (FULL_SCENARIOS if parser_args.matrix == "full" else STANDARD_SCENARIOS)
+    for scenario_name in scenarios:
+        try:
+            parse_scenario(scenario_name)
+        except argparse.ArgumentTypeError as error:
+            parser.error(str(error))
+    results = {"label": parser_args.label,
+               "created": int(time()),
+               "python": sys.version.split()[0],
+               "platform": sys.platform,
+               "scenarios": []}
+    for scenario_name in scenarios:
+        print("Running scenario", scenario_name)
+        results["scenarios"].append(run_scenario(parser_args, scenario_name))
+        print_scenario(results["scenarios"][-1])
+    if parser_args.output:
+        with open(parser_args.output, "w") as results_file:
+            json.dump(results, results_file, indent=1, sort_keys=True)
+        print("\nResults saved to", parser_args.output)
+    if parser_args.compare:
+        with open(parser_args.compare, "r") as baseline_file:
+            regression_count = compare_results(json.load(baseline_file), results, parser_args.threshold)
+        if regression_count:
+            print("\n{0} regression(s) over {1}%".format(regression_count, parser_args.threshold))
+            sys.exit(1)
@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Candidate commands for the unpublished command search and the candidates a model is known
+to reject, so they are not sent to the device again. Word lists are tokenized once into an
+SQLite store next to the list and streamed from there, so their size is not limited by
+memory. The candidates most likely to be commands of a device, judged by the prefixes and
+suffixes its known commands share, are tested first. Candidates the console would resolve
+as an abbreviation of a known command are recognized without sending them.
+
+Copyright © 2017 by Stephen Genusa. Distributed under the license in LICENSE.txt
+"""
+
+from __future__ import print_function
+import collections
+import heapq
+import itertools
+import json
+import os
+import re
+import sqlite3
+
+REJECTED_SUFFIX = ".rejected.txt"
+FIRMWARE_HEADER = "# firmware: "
+CANDIDATE_STORE_SUFFIX = ".candidates.db"
+WORD = re.compile(r"\w+")
+# Words inserted into the candidate store per statement
+STORE_BATCH = 10000
+# Ranked candidates are held in memory; the rest are streamed from the store afterwards
+MAX_RANKED_CANDIDATES = 50000
+# Prefixes and suffixes of these lengths shared by at least MIN_AFFIX_COMMANDS known commands
+#   mark a command family such as DBG* or *STAT
+AFFIX_LENGTHS = (3, 4, 5, 6)
+MIN_AFFIX_COMMANDS = 2
+# A candidate whose counterpart is a known command, e.g. GETFOO for a known SETFOO
+PAIRED_PREFIXES = (("SET", "GET"), ("GET", "SET"), ("ADD", "DEL"), ("DEL", "ADD"),
+                   ("ENABLE", "DISABLE"), ("DISABLE", "ENABLE"), ("START", "STOP"), ("STOP", "START"))
+PAIRED_SUFFIXES = (("ON", "OFF"), ("OFF", "ON"))
+PAIR_SCORE = 10
+ABBREVIATIONS_SUFFIX = ".abbreviations.json"
+# Known commands queried by their shortest unique prefix to learn if a console resolves abbreviations
+ABBREVIATION_PROBES = 3
+
+
+def tokenize_word_list(filename):
+    """
+    Yield the words of a word list one at a time in upper case. Anything that is not a
+    letter, digit or underscore separates words.
+    """
+    with open(filename, "r") as word_file:
+        for line in word_file:
+            for word in WORD.findall(line.upper()):
+                yield word
+
+
+class CandidateStore(object):
+    """
+    The distinct words of a word list in an SQLite file. The list is tokenized again only
+    when its size or modification time changes.
+    """
+
+    def __init__(self, filename):
+        """
+        Open the store, creating the tables if needed
+        """
+        self.filename = filename
+        self.connection = sqlite3.connect(filename, timeout=30)
+        self.connection.text_factory = str
+        # The store is rebuilt from the word list if it is ever lost, so it need not survive a power cut
+        self.connection.execute("PRAGMA synchronous = OFF")
+        self.connection.execute("PRAGMA cache_size = -16384")
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS words (word TEXT PRIMARY KEY)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS source (name TEXT PRIMARY KEY, signature TEXT)")
+
+
+    def load(self, word_list_filename):
+        """
+        Fill the store from the word list unless it already holds that version of it.
+        Returns True if the list was tokenized.
+        """
+        status = os.stat(word_list_filename)
+        signature = "{0}:{1}".format(status.st_size, status.st_mtime)
+        name = os.path.abspath(word_list_filename)
+        stored = self.connection.execute("SELECT signature FROM source WHERE name = ?", (name,)).fetchone()
+        if stored and stored[0] == signature:
+            return False
+        with self.connection:
+            self.connection.execute("DELETE FROM words")
+            self.connection.execute("DELETE FROM source")
+            words = tokenize_word_list(word_list_filename)
+            while True:
+                batch = [(word,) for word in itertools.islice(words, STORE_BATCH)]
+                if not batch:
+                    break
+                self.connection.executemany("INSERT OR IGNORE INTO words VALUES (?)", batch)
+            self.connection.execute("INSERT INTO source VALUES (?, ?)", (name, signature))
+        return True
+
+
+    def count(self):
+        """
+        The number of distinct words
+        """
+        return self.connection.execute("SELECT COUNT(*) FROM words").fetchone()[0]
+
+
+    def words(self):
+        """
+        Yield the words in alphabetical order without reading them all into memory
+        """
+        for (word,) in self.connection.execute("SELECT word FROM words ORDER BY word"):
+            yield word
+
+
+    def close(self):
+        """
+        Close the store
+        """
+        self.connection.close()
+
+
+class AffixModel(object):
+    """
+    The prefixes and suffixes shared by the known commands of a device, used to score how
+    likely a candidate is to be one of its commands
+    """
+
+    def __init__(self, known_commands):
+        """
+        Count the affixes of the known commands
+        """
+        self.known = set(command.upper() for command in known_commands)
+        prefixes = collections.Counter()
+        suffixes = collections.Counter()
+        for command in self.known:
+            for length in AFFIX_LENGTHS:
+                if length < len(command):
+                    prefixes[command[:length]] += 1
+                    suffixes[command[-length:]] += 1
+        self.prefixes = dict((prefix, count) for prefix, count in prefixes.items() if count >= MIN_AFFIX_COMMANDS)
+        self.suffixes = dict((suffix, count) for suffix, count in suffixes.items() if count >= MIN_AFFIX_COMMANDS)
+
+
+    def score(self, candidate):
+        """
+        0 for a candidate that shares nothing with the known commands, higher the more known
+        commands share its prefix and suffix and if its SET/GET style counterpart is known
+        """
+        score = 0
+        for length in AFFIX_LENGTHS:
+            if length < len(candidate):
+                score = max(score, self.prefixes.get(candidate[:length], 0))
+        suffix_score = 0
+        for length in AFFIX_LENGTHS:
+            if length < len(candidate):
+                suffix_score = max(suffix_score, self.suffixes.get(candidate[-length:], 0))
+        score += suffix_score
+        for prefix, counterpart in PAIRED_PREFIXES:
+            if candidate.startswith(prefix) and counterpart + candidate[len(prefix):] in self.known:
+                score += PAIR_SCORE
+        for suffix, counterpart in PAIRED_SUFFIXES:
+            if candidate.endswith(suffix) and candidate[:-len(suffix)] + counterpart in self.known:
+                score += PAIR_SCORE
+        return score
+
+
+def rank_candidates(words, affix_model, limit=MAX_RANKED_CANDIDATES):
+    """
+    The up to limit highest scoring words that are not known commands, best first. Words
+    scoring 0 are left for the unranked tail.
+    """
+    ranked = []
+    for word in words:
+        if word in affix_model.known:
+            continue
+        score = affix_model.score(word)
+        if not score:
+            continue
+        if len(ranked) < limit:
+            heapq.heappush(ranked, (score, word))
+        elif score > ranked[0][0]:
+            heapq.heapreplace(ranked, (score, word))
+    return [word for _unused, word in sorted(ranked, key=lambda entry: (-entry[0], entry[1]))]
+
+
+class RejectedCandidates(object):
+    """
+    The candidates one model/firmware answered with "Bad Command" or as an abbreviation of a
+    known command, kept as a sorted text file per console prompt. The first line records the
+    firmware; the list is discarded when the device reports a different firmware.
+    """
+
+    def __init__(self, filename, firmware_key):
+        """
+        initialize internal properties
+        """
+        self.filename = filename
+        self.firmware_key = firmware_key
+        self.candidates = set()
+        self.changed = False
+
+
+    def __contains__(self, candidate):
+        """
+        True if the candidate is known to be rejected
+        """
+        return candidate in self.candidates
+
+
+    def __len__(self):
+        """
+        The number of rejected candidates
+        """
+        return len(self.candidates)
+
+
+    def load(self):
+        """
+        Read the candidates rejected by this firmware in earlier runs
+        """
+        if not self.firmware_key or not os.path.isfile(self.filename):
+            return
+        with open(self.filename, "r") as rejected_file:
+            if rejected_file.readline().rstrip("\n") != FIRMWARE_HEADER + self.firmware_key:
+                # A firmware update may have added any of them
+                return
+            self.candidates.update(line.rstrip("\n") for line in rejected_file if line.strip())
+
+
+    def add(self, candidates):
+        """
+        Record candidates the device rejected
+        """
+        for candidate in candidates:
+            if candidate not in self.candidates:
+                self.candidates.add(candidate)
+                self.changed = True
+
+
+    def save(self):
+        """
+        Write the sorted list if it changed
+        """
+        if not self.firmware_key or not self.changed:
+            return
+        with open(self.filename, "w") as rejected_file:
+            rejected_file.write(FIRMWARE_HEADER + self.firmware_key + "\n")
+            rejected_file.writelines(["%s\n" % candidate for candidate in sorted(self.candidates)])
+        self.changed = False
+
+
+def minimum_unique_prefixes(commands):
+    """
+    The length of the shortest prefix of each command that no other command starts with, for
+    the commands that have one shorter than the command itself
+    """
+    keys = sorted(set(command.upper() for command in commands))
+    lengths = {}
+    for index, key in enumerate(keys):
+        shared = max([len(os.path.commonprefix([key, neighbour]))
+                      for neighbour in keys[max(0, index - 1):index] + keys[index + 1:index + 2]] or [0])
+        if shared + 1 < len(key):
+            lengths[key] = shared + 1
+    return lengths
+
+
+class AbbreviationMap(object):
+    """
+    What one model/firmware is known to do with abbreviations, kept as JSON per console
+    prompt and discarded when the device reports a different firmware. When the console has
+    answered the help query of a prefix with the help of a known command, no other command
+    starts with that prefix, so every longer prefix of the command is an abbreviation too.
+    """
+
+    def __init__(self, filename, firmware_key):
+        """
+        initialize internal properties
+        """
+        self.filename = filename
+        self.firmware_key = firmware_key
+        # None until probed, then whether the console resolves any abbreviation
+        self.resolves = None
+        # upper case command -> shortest prefix the console resolved to it
+        self.abbreviations = {}
+        self.commands = {}
+        self.changed = False
+
+
+    def load(self):
+        """
+        Read what this firmware was seen to resolve in earlier runs
+        """
+        if not self.firmware_key or not os.path.isfile(self.filename):
+            return
+        with open(self.filename, "r") as map_file:
+            saved = json.load(map_file)
+        if saved.get("firmware", u"").encode("latin-1") != self.firmware_key:
+            return
+        self.resolves = saved.get("resolves")
+        # Console output is stored as latin-1 so any byte sequence survives the round trip
+        for command, abbreviation in saved.get("abbreviations", {}).items():
+            self.learn(command.encode("latin-1"), abbreviation.encode("latin-1"))
+        self.changed = False
+
+
+    def learn(self, command, abbreviation):
+        """
+        Record that the console resolved an abbreviation to a command
+        """
+        command = command.upper()
+        abbreviation = abbreviation.upper()
+        self.resolves = True
+        if len(abbreviation) >= len(self.abbreviations.get(command, command)):
+            return
+        self.commands.pop(self.abbreviations.get(command), None)
+        self.abbreviations[command] = abbreviation
+        self.commands[abbreviation] = command
+        self.changed = True
+
+
+    def probed(self, resolves):
+        """
+        Record the outcome of probing the console
+        """
+        if self.resolves is None and resolves is not None:
+            self.resolves = resolves
+            self.changed = True
+
+
+    def abbreviated_command(self, candidate):
+        """
+        The upper case known command the console would resolve the candidate to, or None if
+        that is not proven
+        """
+        key = candidate.upper()
+        for length in range(1, len(key) + 1):
+            command = self.commands.get(key[:length])
+            if command and len(key) < len(command) and command.startswith(key):
+                return command
+        return None
+
+
+    def save(self):
+        """
+        Write the map if it changed
+        """
+        if not self.firmware_key or not self.changed:
+            return
+        encode = lambda text: text.decode("latin-1")
+        saved = {"firmware": encode(self.firmware_key), "resolves": self.resolves,
+                 "abbreviations": dict((encode(command), encode(abbreviation))
+                                       for command, abbreviation in self.abbreviations.items())}
+        with open(self.filename, "w") as map_file:
+            json.dump(saved, map_file, indent=1, sort_keys=True)
+        self.changed = False
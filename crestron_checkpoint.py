@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Checkpoint log of the unpublished command search of a device. Every tested batch of candidate
+commands is appended as one JSON line and flushed to disk, so a search that was interrupted
+by a dropped connection or a device reboot can be resumed without testing the same
+candidates again.
+
+Copyright © 2017 by Stephen Genusa. Distributed under the license in LICENSE.txt
+"""
+
+from __future__ import print_function
+import json
+import os
+from time import time
+
+CHECKPOINT_SUFFIX = ".checkpoint.jsonl"
+
+
+class SweepCheckpoint(object):
+    """
+    Append-only log of the candidates tested by the unpublished command search of one model
+    """
+
+    def __init__(self, filename):
+        """
+        initialize internal properties
+        """
+        self.filename = filename
+        self.firmware_key = ""
+        self.total = 0
+        self.index = 0
+        self.accepted = []
+        self.tested = set()
+
+
+    def load(self, firmware_key):
+        """
+        Read the checkpoint left by an earlier search of the same firmware. Returns False if
+        there is none. A last line torn by a crash is cut off so new records follow whole ones.
+        """
+        if not os.path.isfile(self.filename):
+            return False
+        # Console output is stored as latin-1 so any byte sequence survives the round trip
+        decode = lambda text: text.encode("latin-1")
+        valid_length = 0
+        header = None
+        with open(self.filename, "rb") as checkpoint_file:
+            for line in checkpoint_file:
+                if not line.endswith("\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                valid_length += len(line)
+                if header is None:
+                    header = record
+                    if decode(header.get("firmware_key", "")) != firmware_key:
+                        return False
+                    self.firmware_key = firmware_key
+                    self.total = header.get("total", 0)
+                    continue
+                self.index = max(self.index, record["index"])
+                accepted = [decode(command) for command in record["accepted"]]
+                self.accepted.extend(accepted)
+                self.tested.update(accepted)
+                self.tested.update(decode(command) for command in record["rejected"])
+        if header is None:
+            return False
+        if valid_length < os.path.getsize(self.filename):
+            with open(self.filename, "r+b") as checkpoint_file:
+                checkpoint_file.truncate(valid_length)
+        return True
+
+
+    def start(self, firmware_key, total):
+        """
+        Begin a new checkpoint log for a search of total candidates
+        """
+        self.firmware_key = firmware_key
+        self.total = total
+        self.index = 0
+        self.accepted = []
+        self.tested = set()
+        self.write_record({"firmware_key": firmware_key.decode("latin-1"), "total": total, "created": time()}, "wb")
+
+
+    def record(self, index, accepted, rejected, timed_out=()):
+        """
+        Add a tested batch: the position reached in the candidate list, the candidates found
+        to be commands or not, and those whose query timed out. Timed out candidates are not
+        counted as tested, so a resumed search sends them again.
+        """
+        self.index = index
+        self.accepted.extend(accepted)
+        self.tested.update(accepted)
+        self.tested.update(rejected)
+        encode = lambda commands: [command.decode("latin-1") for command in commands]
+        self.write_record({"index": index, "accepted": encode(accepted), "rejected": encode(rejected),
+                           "timed_out": encode(timed_out)}, "ab")
+
+
+    def write_record(self, record, mode):
+        """
+        Write one JSON line and flush it to disk
+        """
+        with open(self.filename, mode) as checkpoint_file:
+            checkpoint_file.write(json.dumps(record) + "\n")
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+
+
+    def remove(self):
+        """
+        Delete the checkpoint once the search has completed
+        """
+        if os.path.isfile(self.filename):
+            os.remove(self.filename)
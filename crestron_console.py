@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Prompt driven reading of Crestron console responses over a socket or SSH channel, with the
+nudge interval and command timeout adapted to the response times observed on each device
+
+Copyright © 2017 by Stephen Genusa. Distributed under the license in LICENSE.txt
+"""
+
+from __future__ import print_function
+import collections
+import math
+import select
+import socket
+from time import time
+
+BUFF_SIZE = 20000
+# Responses timed before the nudge interval and command timeout adapt to a device, and how
+#   many recent responses they are derived from
+MIN_LATENCY_SAMPLES = 20
+LATENCY_WINDOW = 200
+# A device is nudged once it has been silent NUDGE_FACTOR times as long as the 95th percentile
+#   of the longest silence within its responses, and a command times out after TIMEOUT_FACTOR
+#   times the 99th percentile of its response times
+NUDGE_FACTOR = 4.0
+MIN_NUDGE_INTERVAL = 0.5
+MAX_NUDGE_INTERVAL = 5.0
+TIMEOUT_FACTOR = 10.0
+MIN_COMMAND_TIMEOUT = 10.0
+MAX_COMMAND_TIMEOUT = 60.0
+
+
+class PromptScanner(object):
+    """
+    Incrementally collect console output until the expected number of prompts has arrived.
+    Each chunk is scanned once; the end of the previous chunk is carried over so a prompt
+    split across two chunks is still found.
+    """
+
+    def __init__(self, terminator, expected_prompts=1):
+        """
+        initialize internal properties
+        """
+        self.terminator = terminator
+        self.expected_prompts = expected_prompts
+        self.prompts_seen = 0
+        self.chunks = []
+        self.tail = ""
+        self.bytes_read = 0
+        # Timing of the response for the LatencyTracker; the command is sent right after this
+        self.started = time()
+        self.first_data_time = 0.0
+        self.last_data_time = self.started
+        self.longest_silence = 0.0
+        self.nudges = 0
+
+
+    def feed(self, chunk):
+        """
+        Add a chunk of console output, returning True once the response is complete
+        """
+        now = time()
+        if not self.first_data_time:
+            self.first_data_time = now
+        self.longest_silence = max(self.longest_silence, now - self.last_data_time)
+        self.last_data_time = now
+        window = self.tail + chunk
+        self.prompts_seen += window.count(self.terminator)
+        self.tail = window[-(len(self.terminator) - 1):] if len(self.terminator) > 1 else ""
+        self.chunks.append(chunk)
+        self.bytes_read += len(chunk)
+        return self.complete()
+
+
+    def complete(self):
+        """
+        True once the expected number of prompts has been seen
+        """
+        return self.prompts_seen >= self.expected_prompts
+
+
+    def ends_with_prompt(self):
+        """
+        True if the output received so far ends with a prompt
+        """
+        return bool(self.chunks) and (self.tail + self.chunks[-1]).rstrip().endswith(self.terminator)
+
+
+    def data(self):
+        """
+        The complete response
+        """
+        return "".join(self.chunks)
+
+
+def backoff_delay(base, attempt, limit):
+    """
+    base seconds doubled for every attempt after the first (attempt 0), but at most limit
+    """
+    return min(limit, base * 2 ** attempt)
+
+
+def percentile(sorted_samples, fraction):
+    """
+    The nearest-rank percentile of a sorted list of samples
+    """
+    return sorted_samples[max(0, min(len(sorted_samples), int(math.ceil(fraction * len(sorted_samples)))) - 1)]
+
+
+class LatencyTracker(object):
+    """
+    Response times observed on one device and the nudge interval and command timeout derived
+    from them. The defaults apply until MIN_LATENCY_SAMPLES responses have been timed. Each
+    consecutive timeout doubles the command timeout, up to MAX_COMMAND_TIMEOUT, so a device
+    that has become slow is given longer before its commands are abandoned.
+    """
+
+    def __init__(self, nudge_interval, command_timeout):
+        """
+        initialize internal properties
+        """
+        self.default_nudge_interval = nudge_interval
+        self.default_command_timeout = command_timeout
+        self.first_byte_times = collections.deque(maxlen=LATENCY_WINDOW)
+        self.response_times = collections.deque(maxlen=LATENCY_WINDOW)
+        self.silences = collections.deque(maxlen=LATENCY_WINDOW)
+        self.responses = 0
+        self.timeouts = 0
+        self.consecutive_timeouts = 0
+        self.nudge_interval = nudge_interval
+        self.adapted_timeout = command_timeout
+        self.command_timeout = command_timeout
+
+
+    def record(self, scanner):
+        """
+        Time a complete response. Responses that needed a nudge are left out, their silences
+        are the nudge interval itself.
+        """
+        self.consecutive_timeouts = 0
+        if scanner.nudges or not scanner.first_data_time:
+            self.command_timeout = self.adapted_timeout
+            return
+        self.responses += 1
+        self.first_byte_times.append(scanner.first_data_time - scanner.started)
+        self.response_times.append(scanner.last_data_time - scanner.started)
+        self.silences.append(scanner.longest_silence)
+        if len(self.response_times) >= MIN_LATENCY_SAMPLES:
+            self.nudge_interval = min(MAX_NUDGE_INTERVAL, max(MIN_NUDGE_INTERVAL, NUDGE_FACTOR *
+                                                              percentile(sorted(self.silences), 0.95)))
+            self.adapted_timeout = min(MAX_COMMAND_TIMEOUT, max(MIN_COMMAND_TIMEOUT, TIMEOUT_FACTOR *
+                                                                percentile(sorted(self.response_times), 0.99)))
+        self.command_timeout = self.adapted_timeout
+
+
+    def record_timeout(self):
+        """
+        Count a command that timed out and back off the command timeout
+        """
+        self.timeouts += 1
+        self.consecutive_timeouts += 1
+        self.command_timeout = backoff_delay(self.adapted_timeout, self.consecutive_timeouts, MAX_COMMAND_TIMEOUT)
+
+
+    def statistics(self):
+        """
+        Latency statistics in milliseconds and the timeouts currently applied in seconds
+        """
+        statistics = {"responses": self.responses, "timeouts": self.timeouts,
+                      "nudge_interval": round(self.nudge_interval, 3),
+                      "command_timeout": round(self.command_timeout, 3)}
+        if self.response_times:
+            response_times = sorted(self.response_times)
+            first_byte_times = sorted(self.first_byte_times)
+            statistics.update({"response_median_ms": round(percentile(response_times, 0.5) * 1000, 1),
+                               "response_p95_ms": round(percentile(response_times, 0.95) * 1000, 1),
+                               "response_p99_ms": round(percentile(response_times, 0.99) * 1000, 1),
+                               "first_byte_median_ms": round(percentile(first_byte_times, 0.5) * 1000, 1)})
+        return statistics
+
+
+    def describe(self):
+        """
+        One line summary of the statistics for the run log
+        """
+        statistics = self.statistics()
+        if not self.responses:
+            return "Console latency: no responses timed"
+        return ("Console latency over the last {0} of {1} responses: median {2} ms, 95th percentile {3} ms, "
+                "first byte median {4} ms. Nudging after {5:.2f} s, commands time out after {6:.1f} s, "
+                "{7} timed out".format(len(self.response_times), self.responses, statistics["response_median_ms"],
+                                       statistics["response_p95_ms"], statistics["first_byte_median_ms"],
+                                       self.nudge_interval, self.command_timeout, self.timeouts))
+
+
+def drain_input(channel):
+    """
+    Discard output still pending on the channel from an earlier command
+    """
+    while select.select([channel], [], [], 0)[0]:
+        if not channel.recv(BUFF_SIZE):
+            return
+
+
+def read_until_quiet(channel, quiet, max_wait):
+    """
+    Read whatever the device sends until it has been silent for quiet seconds
+    """
+    chunks = []
+    deadline = time() + max_wait
+    while select.select([channel], [], [], max(0, min(quiet, deadline - time())))[0]:
+        chunk = channel.recv(BUFF_SIZE)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return "".join(chunks)
+
+
+def exchange_pipelined(channel, lines, terminator, window, quiet, timeout):
+    """
+    Send each line followed by a CR with up to window lines awaiting their prompt and return
+    the output that preceded each prompt, in order, along with the number of bytes read.
+    Once the device has been quiet for quiet seconds no further lines are sent, and the list
+    ends with the answer to the last line sent. It is cut short if no prompt follows the
+    previous one within timeout seconds, so a slow console that keeps answering is given as
+    long as the whole batch takes.
+    """
+    # pylint: disable=too-many-arguments
+    segments = []
+    pending = ""
+    sent = 0
+    bytes_read = 0
+    stalled = False
+    deadline = time() + timeout
+    while len(segments) < (sent if stalled else len(lines)):
+        while not stalled and sent < len(lines) and sent - len(segments) < window:
+            channel.sendall(lines[sent] + "\r")
+            sent += 1
+        wait = deadline - time() if stalled else min(quiet, deadline - time())
+        if wait <= 0:
+            break
+        if not select.select([channel], [], [], wait)[0]:
+            if stalled:
+                break
+            # The answers to the lines already sent are still awaited, so none arrive later
+            stalled = True
+            continue
+        chunk = channel.recv(BUFF_SIZE)
+        if not chunk:
+            raise socket.error("Connection closed by device")
+        bytes_read += len(chunk)
+        pending += chunk
+        position = pending.find(terminator)
+        while position > -1:
+            segments.append(pending[:position])
+            deadline = time() + timeout
+            pending = pending[position + len(terminator):]
+            position = pending.find(terminator)
+    return segments, bytes_read
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Persistent cache of Crestron console help text keyed by console prompt and firmware version
+
+Copyright © 2017 by Stephen Genusa. Distributed under the license in LICENSE.txt
+"""
+
+from __future__ import print_function
+import sqlite3
+from time import time
+
+SECONDS_PER_DAY = 86400
+
+
+class HelpTextCache(object):
+    """
+    SQLite store of the short and long help for every command of a device model/firmware
+    """
+
+    def __init__(self, filename):
+        """
+        Open the cache file, creating the tables if needed
+        """
+        self.connection = sqlite3.connect(filename, timeout=30)
+        # Console output is not guaranteed to be valid UTF-8
+        self.connection.text_factory = str
+        # (console prompt, firmware, command) -> long help written by the next commit()
+        self.pending_long_help = {}
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS models ("
+                                    "console_prompt TEXT, firmware TEXT, complete INTEGER, "
+                                    "created REAL, last_used REAL, "
+                                    "PRIMARY KEY (console_prompt, firmware))")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS commands ("
+                                    "console_prompt TEXT, firmware TEXT, command TEXT, seq INTEGER, "
+                                    "published INTEGER, hidden INTEGER, unpublished INTEGER, "
+                                    "short_help TEXT, long_help TEXT, "
+                                    "PRIMARY KEY (console_prompt, firmware, command))")
+
+
+    def close(self):
+        """
+        Write the pending long help and close the cache file
+        """
+        self.commit()
+        self.connection.close()
+
+
+    def commit(self):
+        """
+        Write the long help cached since the last commit in a single transaction
+        """
+        if not self.pending_long_help:
+            return
+        with self.connection:
+            for console_prompt, firmware in set(key[:2] for key in self.pending_long_help):
+                self.touch_model(console_prompt, firmware)
+            self.connection.executemany("INSERT OR IGNORE INTO commands (console_prompt, firmware, command) "
+                                        "VALUES (?, ?, ?)", self.pending_long_help.keys())
+            self.connection.executemany("UPDATE commands SET long_help = ? WHERE console_prompt = ? AND "
+                                        "firmware = ? AND command = ?",
+                                        [(long_help,) + key for key, long_help in self.pending_long_help.items()])
+        self.pending_long_help = {}
+
+
+    def touch_model(self, console_prompt, firmware):
+        """
+        Create the model row if needed and mark it as used now
+        """
+        now = time()
+        self.connection.execute("INSERT OR IGNORE INTO models VALUES (?, ?, 0, ?, ?)",
+                                (console_prompt, firmware, now, now))
+        self.connection.execute("UPDATE models SET last_used = ? WHERE console_prompt = ? AND firmware = ?",
+                                (now, console_prompt, firmware))
+
+
+    def invalidate(self, console_prompt, firmware):
+        """
+        Remove everything cached for a model/firmware
+        """
+        for key in [key for key in self.pending_long_help if key[:2] == (console_prompt, firmware)]:
+            del self.pending_long_help[key]
+        with self.connection:
+            self.connection.execute("DELETE FROM commands WHERE console_prompt = ? AND firmware = ?",
+                                    (console_prompt, firmware))
+            self.connection.execute("DELETE FROM models WHERE console_prompt = ? AND firmware = ?",
+                                    (console_prompt, firmware))
+
+
+    def evict(self, max_age_days, max_models):
+        """
+        Remove models not used within max_age_days and all but the max_models most recently used
+        """
+        stale = []
+        rows = self.connection.execute("SELECT console_prompt, firmware, last_used FROM models "
+                                       "ORDER BY last_used DESC").fetchall()
+        oldest_allowed = time() - max_age_days * SECONDS_PER_DAY
+        for index, (console_prompt, firmware, last_used) in enumerate(rows):
+            if (max_age_days > 0 and last_used < oldest_allowed) or (max_models > 0 and index >= max_models):
+                stale.append((console_prompt, firmware))
+        for console_prompt, firmware in stale:
+            self.invalidate(console_prompt, firmware)
+        return len(stale)
+
+
+    def get_long_help(self, console_prompt, firmware, command):
+        """
+        Return the cached long help for a command or None if it is not cached
+        """
+        if (console_prompt, firmware, command) in self.pending_long_help:
+            return self.pending_long_help[(console_prompt, firmware, command)]
+        row = self.connection.execute("SELECT long_help FROM commands WHERE console_prompt = ? AND "
+                                      "firmware = ? AND command = ?",
+                                      (console_prompt, firmware, command)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return row[0]
+
+
+    def put_long_help(self, console_prompt, firmware, command, long_help):
+        """
+        Cache the long help for a command. It is written to the file by the next commit().
+        """
+        self.pending_long_help[(console_prompt, firmware, command)] = long_help
+
+
+    def get_model(self, console_prompt, firmware):
+        """
+        Return (published, hidden, unpublished, short help dict) for a completely cached model
+        or None if the model has not been completely documented
+        """
+        row = self.connection.execute("SELECT complete FROM models WHERE console_prompt = ? AND firmware = ?",
+                                      (console_prompt, firmware)).fetchone()
+        if not row or not row[0]:
+            return None
+        with self.connection:
+            self.touch_model(console_prompt, firmware)
+        pub_command_list = []
+        hidden_command_list = []
+        unpublished_command_list = []
+        help_dict = {}
+        for command, published, hidden, unpublished, short_help in self.connection.execute(
+                "SELECT command, published, hidden, unpublished, short_help FROM commands "
+                "WHERE console_prompt = ? AND firmware = ? AND seq IS NOT NULL ORDER BY seq",
+                (console_prompt, firmware)):
+            if published:
+                pub_command_list.append(command)
+            if hidden:
+                hidden_command_list.append(command)
+            if unpublished:
+                unpublished_command_list.append(command)
+            help_dict[command] = short_help
+        return pub_command_list, hidden_command_list, unpublished_command_list, help_dict
+
+
+    def store_model(self, console_prompt, firmware, pub_command_list, hidden_command_list,
+                    unpublished_command_list, help_dict):
+        """
+        Store the command lists and short help of a completely documented model
+        """
+        # pylint: disable=too-many-arguments
+        published = set(pub_command_list)
+        hidden = set(hidden_command_list)
+        unpublished = set(unpublished_command_list)
+        ordered_commands = []
+        ordered_set = set()
+        for command in pub_command_list + hidden_command_list + unpublished_command_list:
+            if command not in ordered_set:
+                ordered_set.add(command)
+                ordered_commands.append(command)
+        self.commit()
+        with self.connection:
+            self.touch_model(console_prompt, firmware)
+            self.connection.execute("UPDATE commands SET seq = NULL WHERE console_prompt = ? AND firmware = ?",
+                                    (console_prompt, firmware))
+            for seq, command in enumerate(ordered_commands):
+                self.connection.execute("INSERT OR IGNORE INTO commands (console_prompt, firmware, command) "
+                                        "VALUES (?, ?, ?)", (console_prompt, firmware, command))
+                self.connection.execute("UPDATE commands SET seq = ?, published = ?, hidden = ?, unpublished = ?, "
+                                        "short_help = ? WHERE console_prompt = ? AND firmware = ? AND command = ?",
+                                        (seq, command in published, command in hidden, command in unpublished,
+                                         help_dict.get(command, ""), console_prompt, firmware, command))
+            self.connection.execute("UPDATE models SET complete = 1 WHERE console_prompt = ? AND firmware = ?",
+                                    (console_prompt, firmware))
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Inventory files listing the devices of an estate with the transport, port, credentials and
+priority of each, read a line at a time, and the console transport each device last
+answered on so the transport that failed is not tried first again.
+
+An inventory is either CSV with a header row or JSON lines, one object per device, with
+the fields ip, transport (ctp, ssh, or empty to try CTP and then SSH), port, username,
+password and priority. Missing fields and empty CSV fields fall back to the command line
+settings. Lines starting with # are ignored.
+
+Copyright © 2017 by Stephen Genusa. Distributed under the license in LICENSE.txt
+"""
+
+from __future__ import print_function
+import collections
+import csv
+import itertools
+import json
+import os
+import threading
+from time import time
+
+TRANSPORT_STATE_FILENAME = "transports.json"
+TRANSPORTS = ("ctp", "ssh")
+
+InventoryDevice = collections.namedtuple("InventoryDevice", ["ip_address", "transport", "port", "username",
+                                                             "password", "priority"])
+
+
+def inventory_device(entry, location):
+    """
+    The InventoryDevice of one CSV row or JSON object. Raises ValueError naming the
+    location in the file for an entry without an IP address, with an unknown transport or
+    with a port or priority that is not a number.
+    """
+    fields = {}
+    for key, value in entry.items():
+        if key is None or value is None:
+            continue
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        fields[key.strip().lower()] = value if isinstance(value, str) else str(value)
+    ip_address = fields.get("ip", "").strip()
+    if not ip_address:
+        raise ValueError("{0} has no ip".format(location))
+    transport = fields.get("transport", "").strip().lower()
+    if transport == "auto":
+        transport = ""
+    if transport and transport not in TRANSPORTS:
+        raise ValueError("{0} has unknown transport {1}".format(location, transport))
+    numbers = {}
+    for field in ("port", "priority"):
+        try:
+            numbers[field] = int(fields.get(field) or 0)
+        except ValueError:
+            raise ValueError("{0} has {1} {2}, which is not a number".format(location, field, fields[field]))
+    return InventoryDevice(ip_address, transport, numbers["port"], fields.get("username") or None,
+                           fields.get("password"), numbers["priority"])
+
+
+def read_inventory(filename):
+    """
+    Yield the devices of an inventory file one at a time, in file order
+    """
+    with open(filename, "r") as inventory_file:
+        lines = (line for line in inventory_file if line.strip() and not line.lstrip().startswith("#"))
+        first_line = next(lines, None)
+        if first_line is None:
+            return
+        lines = itertools.chain([first_line], lines)
+        if first_line.lstrip().startswith("{"):
+            for line_number, line in enumerate(lines, 1):
+                location = "{0} line {1}".format(filename, line_number)
+                try:
+                    entry = json.loads(line)
+                except ValueError as error:
+                    raise ValueError("{0} is not a JSON object: {1}".format(location, error))
+                yield inventory_device(entry, location)
+        else:
+            for line_number, row in enumerate(csv.DictReader(lines), 2):
+                # An empty CSV field cannot be told apart from a missing one, so both mean the default
+                yield inventory_device(dict((key, value) for key, value in row.items() if value),
+                                       "{0} line {1}".format(filename, line_number))
+
+
+def prioritized_batches(devices, batch_size):
+    """
+    Yield lists of up to batch_size devices, each list highest priority first and otherwise
+    in file order. Only one batch is held at a time.
+    """
+    while True:
+        batch = list(itertools.islice(devices, batch_size))
+        if not batch:
+            return
+        yield sorted(batch, key=lambda device: -device.priority)
+
+
+class TransportState(object):
+    """
+    The transport and port each device last answered on, saved as JSON between runs and
+    shared by every device session of a run
+    """
+
+    def __init__(self, filename):
+        """
+        initialize internal properties
+        """
+        self.filename = filename
+        self.lock = threading.Lock()
+        # ip address -> {"transport", "port", "verified"}
+        self.devices = {}
+        self.changed = False
+
+
+    def load(self):
+        """
+        Read the transports recorded by earlier runs, if any
+        """
+        if not self.filename or not os.path.isfile(self.filename):
+            return
+        with open(self.filename, "r") as state_file:
+            saved = json.load(state_file)
+        for ip_address, device in saved.get("devices", {}).items():
+            if device.get("transport") in TRANSPORTS:
+                self.devices[ip_address.encode("latin-1")] = dict(device, transport=str(device["transport"]))
+
+
+    def transport(self, ip_address):
+        """
+        (transport, port) the device last answered on, or None
+        """
+        with self.lock:
+            device = self.devices.get(ip_address)
+            return (device["transport"], device["port"]) if device else None
+
+
+    def record(self, ip_address, transport, port):
+        """
+        Record the transport a device answered on
+        """
+        with self.lock:
+            device = self.devices.get(ip_address)
+            if device and device["transport"] == transport and device["port"] == port:
+                return
+            self.devices[ip_address] = {"transport": transport, "port": port, "verified": time()}
+            self.changed = True
+
+
+    def save(self):
+        """
+        Write the state if it changed, replacing the file in one step
+        """
+        with self.lock:
+            if not self.filename or not self.changed:
+                return
+            temporary_filename = self.filename + ".tmp"
+            with open(temporary_filename, "w") as state_file:
+                json.dump({"devices": self.devices}, state_file, indent=1, sort_keys=True)
+            if os.name == "nt" and os.path.isfile(self.filename):
+                # rename() does not replace an existing file on Windows
+                os.remove(self.filename)
+            os.rename(temporary_filename, self.filename)
+            self.changed = False
@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Instrumentation of documentation runs: a JSONL trace with a line per console command and
+per phase, and live throughput metrics per device (commands per second, latency
+percentiles, progress and ETA of the current phase) that are printed periodically and can
+be written to a Prometheus text file for the node_exporter textfile collector.
+
+Copyright © 2017 by Stephen Genusa. Distributed under the license in LICENSE.txt
+"""
+
+from __future__ import print_function
+import collections
+import functools
+import json
+import os
+import sys
+import threading
+from time import time
+#
+from crestron_console import LATENCY_WINDOW, percentile
+
+# How often the Prometheus text file is rewritten when status lines are not printed
+PROMETHEUS_INTERVAL = 10.0
+
+
+def traced_phase(method):
+    """
+    Decorator for the phase methods of a documenter: the call is run through the
+    documenter's run_phase() so it can be traced and timed
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        """
+        Run the phase through run_phase()
+        """
+        return self.run_phase(method.__name__, method, *args, **kwargs)
+    return wrapper
+
+
+def format_duration(seconds):
+    """
+    h:mm:ss for a number of seconds
+    """
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{0}:{1:02}:{2:02}".format(hours, minutes, seconds)
+
+
+class CommandTracer(object):
+    """
+    Appends one JSON object per line to a trace file, shared by every device session of a run
+    """
+
+    def __init__(self, filename):
+        """
+        Open the trace file for appending, line buffered so a crashed run keeps its trace
+        """
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.trace_file = open(filename, "a", 1)
+
+
+    def write(self, record):
+        """
+        Add a record. Console text is written as latin-1 so any byte sequence survives.
+        """
+        record["time"] = round(time(), 6)
+        for key in ("command", "console_prompt"):
+            if key in record:
+                record[key] = record[key].decode("latin-1")
+        line = json.dumps(record, sort_keys=True) + "\n"
+        with self.lock:
+            self.trace_file.write(line)
+
+
+    def close(self):
+        """
+        Close the trace file
+        """
+        with self.lock:
+            self.trace_file.close()
+
+
+class DeviceMetrics(object):
+    """
+    Running totals of one device
+    """
+    # pylint: disable=too-few-public-methods,too-many-instance-attributes
+
+    def __init__(self, ip_address):
+        """
+        initialize internal properties
+        """
+        self.ip_address = ip_address
+        self.console_prompt = ""
+        self.started = time()
+        self.updated = self.started
+        self.commands = 0
+        self.bytes_read = 0
+        self.nudges = 0
+        self.timeouts = 0
+        self.retries = 0
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.phase = ""
+        # The phase whose progress is known, which a nested phase like a reconnect interrupts
+        self.progress_phase = ""
+        self.phase_started = self.started
+        self.done = 0
+        self.total = 0
+        self.finished = False
+
+
+    def rate(self, now):
+        """
+        Commands per second since the device was first seen
+        """
+        return self.commands / max(now - self.started, 0.001)
+
+
+    def eta(self, now):
+        """
+        Seconds until the current phase completes at its rate so far, or None if unknown
+        """
+        if self.progress_phase != self.phase or not self.total or not self.done or self.done >= self.total:
+            return None
+        return (now - self.phase_started) / self.done * (self.total - self.done)
+
+
+    def latency_percentiles(self):
+        """
+        (p50, p95) of the recent command latencies in seconds, or None
+        """
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return percentile(latencies, 0.5), percentile(latencies, 0.95)
+
+
+class LiveMetrics(object):
+    """
+    Throughput and latency of every device of a run. A reporter thread prints a status line
+    per active device every interval seconds, if interval is not 0, and rewrites the
+    Prometheus text file.
+    """
+
+    def __init__(self, interval=0.0, prometheus_filename=""):
+        """
+        initialize internal properties
+        """
+        self.interval = interval
+        self.prometheus_filename = prometheus_filename
+        self.devices = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+
+    def device(self, ip_address):
+        """
+        The DeviceMetrics of a device, created on first use. Call with the lock held.
+        """
+        metrics = self.devices.get(ip_address)
+        if metrics is None:
+            metrics = self.devices[ip_address] = DeviceMetrics(ip_address)
+        return metrics
+
+
+    def record_command(self, ip_address, console_prompt, phase, latency, bytes_read, nudges=0, timed_out=False,
+                       retry=False, commands=1):
+        """
+        Count commands answered by a device. latency is None for pipelined queries, whose
+        individual response times are not known.
+        """
+        # pylint: disable=too-many-arguments
+        with self.lock:
+            metrics = self.device(ip_address)
+            metrics.console_prompt = console_prompt
+            metrics.phase = phase
+            metrics.finished = False
+            metrics.updated = time()
+            metrics.commands += commands
+            metrics.bytes_read += bytes_read
+            metrics.nudges += nudges
+            metrics.timeouts += timed_out
+            metrics.retries += retry
+            if latency is not None:
+                metrics.latencies.append(latency)
+
+
+    def progress(self, ip_address, phase, done, total):
+        """
+        Record how far a device has got through the work of a phase
+        """
+        with self.lock:
+            metrics = self.device(ip_address)
+            metrics.phase = phase
+            if metrics.progress_phase != phase:
+                metrics.progress_phase = phase
+                metrics.phase_started = time()
+            metrics.done = done
+            metrics.total = total
+
+
+    def finish(self, ip_address):
+        """
+        The device is done; it is left out of the status lines from now on
+        """
+        with self.lock:
+            self.device(ip_address).finished = True
+
+
+    def status_lines(self):
+        """
+        A line per active device and a total line
+        """
+        now = time()
+        lines = []
+        with self.lock:
+            devices = list(self.devices.values())
+            for metrics in devices:
+                if metrics.finished:
+                    continue
+                line = "{0} {1} {2}: {3} commands, {4:.1f}/s".format(metrics.ip_address, metrics.console_prompt,
+                                                                      metrics.phase, metrics.commands,
+                                                                      metrics.rate(now))
+                percentiles = metrics.latency_percentiles()
+                if percentiles:
+                    line += ", p50 {0:.1f} ms, p95 {1:.1f} ms".format(percentiles[0] * 1000, percentiles[1] * 1000)
+                if metrics.total and metrics.progress_phase == metrics.phase:
+                    line += ", {0}/{1}".format(metrics.done, metrics.total)
+                    eta = metrics.eta(now)
+                    if eta is not None:
+                        line += " ETA " + format_duration(eta)
+                lines.append(line)
+            commands = sum(metrics.commands for metrics in devices)
+        if devices:
+            started = min(metrics.started for metrics in devices)
+            lines.append("Total: {0} of {1} devices active, {2} commands, {3:.1f}/s".format(
+                len(lines), len(devices), commands, commands / max(now - started, 0.001)))
+        return lines
+
+
+    def prometheus_text(self):
+        """
+        The metrics in the Prometheus text exposition format
+        """
+        now = time()
+        counters = (("crestron_commands_total", "Console commands answered", "commands"),
+                    ("crestron_bytes_read_total", "Bytes of console output read", "bytes_read"),
+                    ("crestron_command_nudges_total", "CRs sent to consoles that went quiet", "nudges"),
+                    ("crestron_command_timeouts_total", "Commands that timed out", "timeouts"),
+                    ("crestron_command_retries_total", "Commands sent again after a reconnect", "retries"))
+        with self.lock:
+            devices = [(metrics, 'device="{0}",prompt="{1}"'.format(
+                metrics.ip_address, metrics.console_prompt.replace("\\", "\\\\").replace('"', '\\"')))
+                       for metrics in self.devices.values()]
+            lines = []
+            for name, description, attribute in counters:
+                lines.extend(["# HELP {0} {1}".format(name, description), "# TYPE {0} counter".format(name)])
+                lines.extend("{0}{{{1}}} {2}".format(name, labels, getattr(metrics, attribute))
+                             for metrics, labels in devices)
+            lines.extend(["# HELP crestron_commands_per_second Commands answered per second",
+                          "# TYPE crestron_commands_per_second gauge"])
+            lines.extend("crestron_commands_per_second{{{0}}} {1:.3f}".format(labels, metrics.rate(now))
+                         for metrics, labels in devices)
+            lines.extend(["# HELP crestron_command_latency_seconds Recent console command latency",
+                          "# TYPE crestron_command_latency_seconds summary"])
+            for metrics, labels in devices:
+                percentiles = metrics.latency_percentiles()
+                if percentiles:
+                    lines.append('crestron_command_latency_seconds{{{0},quantile="0.5"}} {1:.6f}'.format(
+                        labels, percentiles[0]))
+                    lines.append('crestron_command_latency_seconds{{{0},quantile="0.95"}} {1:.6f}'.format(
+                        labels, percentiles[1]))
+            lines.extend(["# HELP crestron_phase_progress_ratio Share of the current phase completed",
+                          "# TYPE crestron_phase_progress_ratio gauge"])
+            lines.extend('crestron_phase_progress_ratio{{{0},phase="{1}"}} {2:.4f}'.format(
+                labels, metrics.progress_phase, float(metrics.done) / metrics.total)
+                         for metrics, labels in devices if metrics.total)
+            lines.extend(["# HELP crestron_phase_eta_seconds Estimated seconds until the current phase completes",
+                          "# TYPE crestron_phase_eta_seconds gauge"])
+            lines.extend('crestron_phase_eta_seconds{{{0},phase="{1}"}} {2:.1f}'.format(
+                labels, metrics.phase, metrics.eta(now))
+                         for metrics, labels in devices if metrics.eta(now) is not None)
+        return "\n".join(lines) + "\n"
+
+
+    def write_prometheus_file(self):
+        """
+        Replace the Prometheus text file in one step so the collector never reads half of it
+        """
+        if not self.prometheus_filename:
+            return
+        temporary_filename = self.prometheus_filename + ".tmp"
+        with open(temporary_filename, "w") as prometheus_file:
+            prometheus_file.write(self.prometheus_text())
+        if os.name == "nt" and os.path.isfile(self.prometheus_filename):
+            # rename() does not replace an existing file on Windows
+            os.remove(self.prometheus_filename)
+        os.rename(temporary_filename, self.prometheus_filename)
+
+
+    def start(self):
+        """
+        Start the reporter thread
+        """
+        period = self.interval if self.interval > 0 else PROMETHEUS_INTERVAL if self.prometheus_filename else 0
+        if period > 0 and self.thread is None:
+            self.thread = threading.Thread(target=self.reporter, args=(period,))
+            self.thread.daemon = True
+            self.thread.start()
+
+
+    def reporter(self, period):
+        """
+        Print the status lines, if enabled, and rewrite the Prometheus text file every period
+        seconds
+        """
+        while not self.stop_event.wait(period):
+            lines = self.status_lines() if self.interval > 0 else []
+            if lines:
+                print("\n" + "\n".join(lines))
+                sys.stdout.flush()
+            self.write_prometheus_file()
+
+
+    def stop(self):
+        """
+        Stop the reporter thread and write the final Prometheus text file
+        """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.write_prometheus_file()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Parsers for the console output of Crestron devices. The patterns are compiled once and each
+response is parsed in a single pass; the help listing of a large device runs to 40 KB and
+is parsed for every device documented.
+
+Copyright © 2017 by Stephen Genusa. Distributed under the license in LICENSE.txt
+"""
+
+from __future__ import print_function
+import re
+import string
+import textwrap
+
+HELP_WRAP_WIDTH = 150
+NO_HELP_TEXT = "No help available for this command."
+NO_HELP_MESSAGES = ("Authentication is not on. Command not allowed.",
+                    "ERROR: Command Blocked from this console type.")
+LINE_BREAKS = ("\r", "\n")
+
+CONSOLE_PROMPT_AT_END = re.compile(r"[\n\r]([\w-]{3,30})>$")
+CONSOLE_PROMPT = re.compile(r"[\n\r]([\w-]{3,30})>")
+FIRMWARE_VERSION = re.compile(r"[\r\n]{1,2}([\w\[\]\.\ \(\),#@-]{20,90})[\r\n]{1,2}")
+# The serial number and MAC address differ between otherwise identical units
+FIRMWARE_UNIT_DETAILS = re.compile(r",?\s*#[0-9A-Fa-f]+|\s*@E-[0-9A-Fa-f]+")
+# Some consoles end lines with a bare CR; a CR LF pair already ends in the LF lines are split at
+BARE_CARRIAGE_RETURN = re.compile(r"\r(?!\n)")
+HELP_REJECTED = re.compile("BAD COMM|INCOMPLETE COMM", re.I)
+# A line of up to 200 characters of a "help all" listing: the command, the access level
+#   it requires and its short help
+HELP_LISTING_LINE = re.compile(r"\n(?=[^\n]{1,200}\n)[^\n]*?(\w{2,25})\ *"
+                               r"(?:Programmer|Operator|Administrator|User\ or\ Connect)?\ *(.{1,120})")
+# textwrap turns every whitespace character into a space
+WHITESPACE_TO_SPACE = string.maketrans("\t\n\x0b\x0c\r", " " * 5)
+
+
+def find_console_prompt(data, at_end=False):
+    """
+    The console prompt, without its ">", in the output of a device or None
+    """
+    if at_end:
+        found = CONSOLE_PROMPT_AT_END.search(data.rstrip())
+    else:
+        found = CONSOLE_PROMPT.search(data)
+    return found.group(1) if found else None
+
+
+def parse_firmware_version(data, terminator):
+    """
+    The firmware version in the output of "ver" or "" if there is none
+    """
+    found = FIRMWARE_VERSION.search(data.replace(terminator, ""))
+    return found.group().strip() if found else ""
+
+
+def firmware_key(firmwareversion):
+    """
+    The firmware version without the details that are unique to a unit
+    """
+    return FIRMWARE_UNIT_DETAILS.sub("", firmwareversion).strip()
+
+
+def parse_help_listing(data, help_command, terminator):
+    """
+    The (command, short help) pairs of a "help all" or "hidhelp all" listing in listing order.
+    Lines are split at LF, a bare CR is taken as a line break too.
+    """
+    data = data.replace(help_command, "").replace(terminator, "")
+    if "\r" in data:
+        data = BARE_CARRIAGE_RETURN.sub("\n", data)
+    if "Bad" in data or "Incomplete Command" in data:
+        return []
+    return [(command, short_help.strip()) for command, short_help in HELP_LISTING_LINE.findall(data)]
+
+
+def help_body(data, terminator):
+    """
+    The output from the first line break up to the last prompt that starts a line, which
+    must be at least 5 characters long. This is the text the pattern
+    [\\r\\n]{1,2}(.{5,})[\\r\\n]{1,2}PROMPT> matches, located without backtracking over the output.
+    """
+    carriage_return = data.find("\r")
+    line_feed = data.find("\n")
+    start = min(carriage_return, line_feed) if carriage_return >= 0 and line_feed >= 0 else \
+            max(carriage_return, line_feed)
+    end = data.rfind(terminator)
+    while end > 0 and data[end - 1] not in LINE_BREAKS:
+        end = data.rfind(terminator, 0, end + len(terminator) - 1)
+    if start < 0 or end <= 0:
+        return ""
+    end -= 1
+    if data[start + 1:start + 2] in LINE_BREAKS and end - start - 2 >= 5:
+        return data[start + 2:end]
+    if end - start - 1 >= 5:
+        return data[start + 1:end]
+    return ""
+
+
+def wrap_help_line(line):
+    """
+    textwrap.fill(line, HELP_WRAP_WIDTH), without the cost of textwrap for the lines that
+    already fit
+    """
+    if len(line) <= HELP_WRAP_WIDTH and "\t" not in line:
+        return line.translate(WHITESPACE_TO_SPACE).rstrip(" ")
+    return textwrap.fill(line, HELP_WRAP_WIDTH)
+
+
+def parse_command_help(command, data, terminator):
+    """
+    The help text for a command from the output of "command ?", HTML escaped and wrapped
+    at HELP_WRAP_WIDTH. "" if the console does not know the command.
+    """
+    if HELP_REJECTED.search(data):
+        return ""
+    if not data or any(message in data for message in NO_HELP_MESSAGES):
+        return NO_HELP_TEXT
+    help_text = help_body(data, terminator)
+    if help_text:
+        help_text = help_text.replace(terminator, "")
+        if ">" in help_text or "<" in help_text:
+            help_text = help_text.replace(">", "&gt;").replace("<", "&lt;")
+        message = command + " ?"
+        if help_text.find(message, 1, 30) > -1:
+            help_text = help_text[len(message) + 2:]
+    return "\n".join([wrap_help_line(line) for line in help_text.split("\n")]) + "\n"
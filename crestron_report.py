@@ -0,0 +1,431 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Render device documentation from a command model (a DeviceSnapshot) as HTML, JSON or Markdown.
+Rows are streamed to disk one command at a time and nothing here talks to the device, so a
+saved snapshot can be re-rendered in any format without reconnecting:
+
+    python crestron_report.py CP3.snapshot.json -f html,json,md
+
+Copyright © 2017 by Stephen Genusa. Distributed under the license in LICENSE.txt
+"""
+
+from __future__ import print_function
+import argparse
+import cgi
+import json
+import os
+#
+from crestron_snapshot import DeviceSnapshot
+
+FLEET_INDEX_NAME = "fleet_index"
+SPECIAL_COMMAND_COLOR = "#0000FF"
+UNPUBLISHED_COMMAND_COLOR = "#8B0000"
+# class name -> (HTML colour, name used in JSON and Markdown)
+COMMAND_CLASSES = {"pub": ("#000000", "published"),
+                   "hid": (SPECIAL_COMMAND_COLOR, "hidden"),
+                   "unpub": (UNPUBLISHED_COMMAND_COLOR, "unpublished")}
+
+HTML_HEADER = """<!DOCTYPE HTML>
+<html>
+<head>
+  <title>{title}</title>
+  <meta name="utility_author" content="Stephen Genusa">
+  <meta http-equiv="Content-Type" content="text/html; charset=UTF-8">
+  <style type="text/css">
+      table {{ page-break-inside:auto }}
+      tr    {{ page-break-inside:avoid; page-break-after:auto }}
+      thead {{ display:table-header-group }}
+      tfoot {{ display:table-footer-group }}
+      fwver {{ font-size:12px }}
+  </style>
+</head>
+<body>
+<font face='arial'>
+<h1>{title}</h1>
+<blockquote>
+<p style="font-size:12px">{firmwareversion}</p>
+<p>{published} normal commands found.&nbsp;"""
+HTML_HIDDEN_COUNT = """<font color="{color}">{hidden}</font> hidden commands available.&nbsp;"""
+HTML_UNPUBLISHED_COUNT = """<font color="{color}">{unpublished} unpublished commands available.</font>"""
+HTML_TABLE = """</p>
+</blockquote>
+<table border="1" cellpadding="5" cellspacing="5" style="border-collapse:collapse;" width="100%">
+"""
+HTML_ROW = """<tr class="{class_name}" bgcolor="#C0C0C0">
+  <th width="20%"><font color="{color}">{command}</font></th>
+  <th align="left"><font color="{color}">&nbsp;{short_help}</font></th>
+</tr>
+<tr>
+  <td colspan="2">
+<pre>{long_help}</pre>
+</td>
+</tr>
+"""
+HTML_TIMED_OUT = """<p>Timed out waiting for the console prompt after {commands}. Their output may be incomplete.</p>
+"""
+HTML_FOOTER = """</table>
+{notes}</font>
+</body>
+</html>"""
+
+FLEET_INDEX_HEADER = """<!DOCTYPE HTML>
+<html>
+<head>
+  <title>Crestron fleet index</title>
+  <meta http-equiv="Content-Type" content="text/html; charset=UTF-8">
+</head>
+<body>
+<font face='arial'>
+<h1>Crestron fleet index</h1>
+<p>{devices} devices, {models} distinct model/firmware combinations documented.</p>
+<table border="1" cellpadding="5" cellspacing="5" style="border-collapse:collapse;" width="100%">
+<tr bgcolor="#C0C0C0"><th>IP address</th><th>Host name</th><th>Console prompt</th><th>Firmware</th><th>Status</th><th>Documentation</th></tr>
+"""
+FLEET_INDEX_ROW = """<tr><td>{ip_address}</td><td>{hostname}</td><td>{console_prompt}</td><td>{firmwareversion}</td><td>{status}</td><td>{report}</td></tr>
+"""
+FLEET_INDEX_FOOTER = """</table>
+</font>
+</body>
+</html>"""
+
+MARKDOWN_HEADER = """# {title}
+
+{firmwareversion}
+
+{counts}
+"""
+MARKDOWN_TIMED_OUT = """
+## Timed out
+
+Timed out waiting for the console prompt after {commands}. Their output may be incomplete.
+"""
+MARKDOWN_ROW = """
+## {command}
+
+*{kind}* {short_help}
+
+```
+{long_help}
+```
+"""
+
+
+def console_text(text):
+    """
+    Unicode for console text, which is not guaranteed to be valid UTF-8
+    """
+    return text.decode("utf-8", "replace")
+
+
+def plain_text(text):
+    """
+    Help text is kept HTML escaped in the command model (as it is in the help cache); undo
+    that for formats other than HTML
+    """
+    return text.replace("&lt;", "<").replace("&gt;", ">")
+
+
+class ReportWriter(object):
+    """
+    Streams the documentation of a command model to a file: a header, one row per command
+    in alphabetical order and a footer
+    """
+    extension = ""
+
+    def __init__(self, model):
+        """
+        initialize internal properties
+        """
+        self.model = model
+        self.published_set = set(model.published)
+        self.unpublished_set = set(model.unpublished)
+        self.hidden_count = len(model.hidden) - len(model.published) if model.hidden else 0
+
+
+    def class_name(self, command):
+        """
+        pub, hid or unpub
+        """
+        if command in self.unpublished_set:
+            return "unpub"
+        if command in self.published_set:
+            return "pub"
+        return "hid"
+
+
+    def rows(self):
+        """
+        (command, class name, short help, long help) for every command
+        """
+        for command in sorted(set(self.model.published) | set(self.model.hidden) | self.unpublished_set):
+            details = self.model.commands.get(command, {})
+            yield command, self.class_name(command), details.get("short_help", ""), details.get("long_help", "")
+
+
+    def write(self, filename):
+        """
+        Write the report
+        """
+        with open(filename, "w") as report_file:
+            self.write_header(report_file)
+            for row in self.rows():
+                self.write_row(report_file, *row)
+            self.write_footer(report_file)
+
+
+    def write_header(self, report_file):
+        """
+        Write everything ahead of the first command
+        """
+        pass
+
+
+    def write_row(self, report_file, command, class_name, short_help, long_help):
+        """
+        Write one command
+        """
+        # pylint: disable=too-many-arguments
+        pass
+
+
+    def write_footer(self, report_file):
+        """
+        Write everything after the last command
+        """
+        pass
+
+
+class HtmlReportWriter(ReportWriter):
+    """
+    The HTML command reference
+    """
+    extension = ".html"
+
+    def write_header(self, report_file):
+        """
+        Page heading, firmware version and command counts
+        """
+        report_file.write(HTML_HEADER.format(title="Commandset for the " + self.model.console_prompt,
+                                             firmwareversion=self.model.firmwareversion,
+                                             published=len(self.model.published)))
+        if self.model.hidden:
+            report_file.write(HTML_HIDDEN_COUNT.format(color=SPECIAL_COMMAND_COLOR, hidden=self.hidden_count))
+        if self.model.unpublished:
+            report_file.write(HTML_UNPUBLISHED_COUNT.format(color=UNPUBLISHED_COMMAND_COLOR,
+                                                            unpublished=len(self.model.unpublished)))
+        report_file.write(HTML_TABLE)
+
+
+    def write_row(self, report_file, command, class_name, short_help, long_help):
+        """
+        A heading row with the command and its short help followed by the long help
+        """
+        # pylint: disable=too-many-arguments
+        report_file.write(HTML_ROW.format(class_name=class_name, color=COMMAND_CLASSES[class_name][0],
+                                          command=command, short_help=short_help, long_help=long_help))
+
+
+    def write_footer(self, report_file):
+        """
+        Close the table, note any commands that timed out and close the page
+        """
+        notes = ""
+        if self.model.timed_out:
+            notes = HTML_TIMED_OUT.format(commands=cgi.escape(", ".join(self.model.timed_out)))
+        report_file.write(HTML_FOOTER.format(notes=notes))
+
+
+class JsonReportWriter(ReportWriter):
+    """
+    The command reference as a JSON document
+    """
+    extension = ".json"
+
+    def __init__(self, model):
+        """
+        initialize internal properties
+        """
+        ReportWriter.__init__(self, model)
+        self.first_row = True
+
+
+    def write_header(self, report_file):
+        """
+        Device details and command counts, then open the command array
+        """
+        report_file.write('{{"console_prompt": {0}, "firmwareversion": {1}, '
+                          '"counts": {{"published": {2}, "hidden": {3}, "unpublished": {4}}}, '
+                          '"commands": ['.format(self.encode(self.model.console_prompt),
+                                                 self.encode(self.model.firmwareversion),
+                                                 len(self.model.published), self.hidden_count,
+                                                 len(self.model.unpublished)))
+
+
+    def write_row(self, report_file, command, class_name, short_help, long_help):
+        """
+        One command object
+        """
+        # pylint: disable=too-many-arguments
+        report_file.write('{0}\n {{"command": {1}, "class": "{2}", "short_help": {3}, "long_help": {4}}}'.format(
+            "" if self.first_row else ",", self.encode(command), COMMAND_CLASSES[class_name][1],
+            self.encode(plain_text(short_help)), self.encode(plain_text(long_help))))
+        self.first_row = False
+
+
+    def write_footer(self, report_file):
+        """
+        Close the command array, list the commands that timed out and close the document
+        """
+        report_file.write('\n], "timed_out": [{0}]}}\n'.format(", ".join(self.encode(command)
+                                                                        for command in self.model.timed_out)))
+
+
+    @staticmethod
+    def encode(text):
+        """
+        JSON string for console text, which is not guaranteed to be valid UTF-8
+        """
+        return json.dumps(console_text(text))
+
+
+class MarkdownReportWriter(ReportWriter):
+    """
+    The command reference as Markdown
+    """
+    extension = ".md"
+
+    def write_header(self, report_file):
+        """
+        Heading, firmware version and command counts
+        """
+        counts = "{0} normal commands found.".format(len(self.model.published))
+        if self.model.hidden:
+            counts += " {0} hidden commands available.".format(self.hidden_count)
+        if self.model.unpublished:
+            counts += " {0} unpublished commands available.".format(len(self.model.unpublished))
+        report_file.write(MARKDOWN_HEADER.format(title="Commandset for the " + self.model.console_prompt,
+                                                 firmwareversion=self.model.firmwareversion, counts=counts))
+
+
+    def write_row(self, report_file, command, class_name, short_help, long_help):
+        """
+        A section per command with the long help as a code block
+        """
+        # pylint: disable=too-many-arguments
+        report_file.write(MARKDOWN_ROW.format(command=command, kind=COMMAND_CLASSES[class_name][1],
+                                              short_help=plain_text(short_help),
+                                              long_help=plain_text(long_help).strip("\r\n")))
+
+
+    def write_footer(self, report_file):
+        """
+        A section listing the commands that timed out, if any did
+        """
+        if self.model.timed_out:
+            report_file.write(MARKDOWN_TIMED_OUT.format(commands=", ".join("`{0}`".format(command)
+                                                                           for command in self.model.timed_out)))
+
+
+REPORT_WRITERS = {"html": HtmlReportWriter, "json": JsonReportWriter, "md": MarkdownReportWriter}
+
+
+def parse_report_formats(formats):
+    """
+    Split a comma separated list of report formats, rejecting unknown ones and an empty list
+    """
+    format_list = [report_format.strip().lower() for report_format in formats.split(",") if report_format.strip()]
+    for report_format in format_list:
+        if report_format not in REPORT_WRITERS:
+            raise ValueError("Unknown report format {0}, choose from {1}".format(
+                report_format, ", ".join(sorted(REPORT_WRITERS))))
+    if not format_list:
+        raise ValueError("No report format given, choose from {0}".format(", ".join(sorted(REPORT_WRITERS))))
+    return format_list
+
+
+def report_formats_argument(formats):
+    """
+    argparse type for a comma separated list of report formats, so a bad list is reported
+    as a usage error
+    """
+    try:
+        return parse_report_formats(formats)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+
+
+def report_filename(console_prompt, report_format, directory=""):
+    """
+    The file a report of the given format is written to
+    """
+    return os.path.join(directory, console_prompt + REPORT_WRITERS[report_format].extension)
+
+
+def write_reports(model, formats, directory=""):
+    """
+    Write the model in each format and return the file names
+    """
+    filenames = []
+    for report_format in formats:
+        filename = report_filename(model.console_prompt, report_format, directory)
+        REPORT_WRITERS[report_format](model).write(filename)
+        filenames.append(filename)
+    return filenames
+
+
+def write_fleet_index(results, directory=""):
+    """
+    Write fleet_index.json and fleet_index.html mapping every device of a run to the
+    documentation of its model and firmware. Returns the file names.
+    """
+    models = []
+    for result in results:
+        if result.status in ("documented", "skipped"):
+            models.append({"console_prompt": console_text(result.console_prompt),
+                           "firmwareversion": console_text(result.firmwareversion),
+                           "report": result.htmldocfilename,
+                           "devices": [result.ip_address] + [member.ip_address for member in results
+                                                             if member.representative == result.ip_address]})
+    devices = [{"ip_address": result.ip_address,
+                "hostname": console_text(result.hostname),
+                "console_prompt": console_text(result.console_prompt),
+                "firmwareversion": console_text(result.firmwareversion),
+                "status": result.status,
+                "transport": result.transport,
+                "representative": result.representative,
+                "report": result.htmldocfilename,
+                "latency": result.latency} for result in results]
+    json_filename = os.path.join(directory, FLEET_INDEX_NAME + ".json")
+    with open(json_filename, "w") as index_file:
+        json.dump({"models": models, "devices": devices}, index_file, indent=1, sort_keys=True)
+    html_filename = os.path.join(directory, FLEET_INDEX_NAME + ".html")
+    with open(html_filename, "w") as index_file:
+        index_file.write(FLEET_INDEX_HEADER.format(devices=len(devices), models=len(models)))
+        for device in devices:
+            status = device["status"]
+            if device["representative"]:
+                status += " of " + device["representative"]
+            report = '<a href="{0}">{0}</a>'.format(device["report"]) if device["report"] else ""
+            index_file.write(FLEET_INDEX_ROW.format(ip_address=device["ip_address"], status=status, report=report,
+                                                    hostname=cgi.escape(device["hostname"]),
+                                                    console_prompt=cgi.escape(device["console_prompt"]),
+                                                    firmwareversion=cgi.escape(device["firmwareversion"])).
+                             encode("utf-8"))
+        index_file.write(FLEET_INDEX_FOOTER)
+    return [json_filename, html_filename]
+
+
+if __name__ == "__main__":
+    # pylint: disable-msg=C0103
+    parser = argparse.ArgumentParser(description="Render Crestron command documentation from a snapshot")
+    parser.add_argument("snapshots", nargs="+", help="<prompt>.snapshot.json files")
+    parser.add_argument("-f", "--formats", default="html", type=report_formats_argument,
+                        help="Comma separated formats: html, json, md")
+    parser.add_argument("-o", "--outputdir", default="", help="Directory to write the reports to.")
+    parser_args = parser.parse_args()
+    for snapshot_filename in parser_args.snapshots:
+        for written in write_reports(DeviceSnapshot.load(snapshot_filename), parser_args.formats,
+                                     parser_args.outputdir):
+            print("Wrote", written)
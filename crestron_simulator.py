@@ -0,0 +1,520 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Offline stand-in for a Crestron console. Replays recorded console transcripts over CTP
+(and optionally SSH) so the documenter can be exercised and timed without a real device,
+and records transcripts from real devices.
+
+Copyright © 2017 by Stephen Genusa. Distributed under the license in LICENSE.txt
+"""
+
+from __future__ import print_function
+import argparse
+import bisect
+import json
+import random
+import socket
+import SocketServer
+import threading
+from time import sleep, time
+#
+import paramiko
+#
+from BuildCrestronCommandReference import CrestronDeviceDocumenter, build_argument_parser, CTP_PORT, SSH_PORT
+from crestron_console import BUFF_SIZE
+
+NEW_LINE = "\r\n"
+DEFAULT_UNKNOWN_RESPONSE = NEW_LINE + "Bad or Incomplete Command" + NEW_LINE
+TOO_MANY_SESSIONS = NEW_LINE + "ERROR: Maximum number of console sessions reached" + NEW_LINE
+UNKNOWN_PROBE_COMMAND = "ZZQXNOTACOMMAND ?"
+
+
+def normalize_command_line(line):
+    """
+    Upper case a console line and collapse runs of spaces so it can be used as a response key
+    """
+    return " ".join(line.upper().split())
+
+
+class DeviceTranscript(object):
+    """
+    The recorded console responses of one device: the text the console prints in reply to
+    a command line, up to but not including the prompt that follows it
+    """
+
+    def __init__(self, console_prompt, responses=None, unknown_response=DEFAULT_UNKNOWN_RESPONSE):
+        """
+        initialize internal properties
+        """
+        self.console_prompt = console_prompt
+        self.banner = ""
+        self.responses = {}
+        self.unknown_response = unknown_response
+        # Commands whose firmware ignores the "?" and executes the command instead:
+        #   command -> {"output": text, "prompt": bool, "disconnect": bool}
+        self.executes = {}
+        self.resolve_abbreviations = True
+        self.known_commands = None
+        for command_line, response in (responses or {}).items():
+            self.add_response(command_line, response)
+
+
+    def add_response(self, command_line, response):
+        """
+        Record the console output for a command line
+        """
+        self.responses[normalize_command_line(command_line)] = response
+        self.known_commands = None
+
+
+    def respond(self, line):
+        """
+        Return (output, prompt follows, disconnect) for a line typed at the console
+        """
+        key = normalize_command_line(line)
+        if not key:
+            return self.responses.get("", NEW_LINE), True, False
+        command = key[:-1].strip() if key.endswith("?") else key
+        if self.resolve_abbreviations and command not in self.executes and key not in self.responses:
+            command = self.resolve_abbreviation(command)
+            if key.endswith("?"):
+                key = command + " ?"
+        if command in self.executes:
+            behaviour = self.executes[command]
+            return behaviour.get("output", ""), behaviour.get("prompt", True), behaviour.get("disconnect", False)
+        if key in self.responses:
+            response = self.responses[key]
+            if key != normalize_command_line(line) and response.upper().startswith(key):
+                # Echo the abbreviation that was typed rather than the recorded command
+                response = line.strip() + response[len(key):]
+            return response, True, False
+        # The console echoes the line before rejecting it
+        return line.strip() + self.unknown_response, True, False
+
+
+    def resolve_abbreviation(self, command):
+        """
+        Return the recorded command the console would run for an abbreviation, or the
+        abbreviation itself if it is not a unique prefix of a recorded command
+        """
+        if self.known_commands is None:
+            self.known_commands = sorted(set(key[:-2] for key in self.responses if key.endswith(" ?")) |
+                                         set(self.executes))
+        index = bisect.bisect_left(self.known_commands, command)
+        matches = self.known_commands[index:index + 2]
+        if not matches or not matches[0].startswith(command) or matches[0] == command:
+            return command
+        if len(matches) == 2 and matches[1].startswith(command):
+            return command
+        return matches[0]
+
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load a transcript saved with save()
+        """
+        with open(filename, "r") as transcript_file:
+            saved = json.load(transcript_file)
+        # Console output is stored as latin-1 so any byte sequence survives the round trip
+        decode = lambda text: text.encode("latin-1")
+        transcript = cls(decode(saved["console_prompt"]))
+        transcript.banner = decode(saved.get("banner", ""))
+        transcript.unknown_response = decode(saved.get("unknown_response", DEFAULT_UNKNOWN_RESPONSE))
+        if transcript.unknown_response.startswith(UNKNOWN_PROBE_COMMAND):
+            transcript.unknown_response = transcript.unknown_response[len(UNKNOWN_PROBE_COMMAND):]
+        transcript.resolve_abbreviations = saved.get("resolve_abbreviations", True)
+        for command_line, response in saved.get("responses", {}).items():
+            transcript.add_response(decode(command_line), decode(response))
+        for command, behaviour in saved.get("executes", {}).items():
+            behaviour = dict(behaviour)
+            behaviour["output"] = decode(behaviour.get("output", ""))
+            transcript.executes[normalize_command_line(decode(command))] = behaviour
+        return transcript
+
+
+    def save(self, filename):
+        """
+        Save the transcript as JSON
+        """
+        encode = lambda text: text.decode("latin-1")
+        executes = {}
+        for command, behaviour in self.executes.items():
+            behaviour = dict(behaviour)
+            behaviour["output"] = encode(behaviour.get("output", ""))
+            executes[encode(command)] = behaviour
+        saved = {"console_prompt": encode(self.console_prompt),
+                 "banner": encode(self.banner),
+                 "unknown_response": encode(self.unknown_response),
+                 "resolve_abbreviations": self.resolve_abbreviations,
+                 "responses": dict((encode(key), encode(value)) for key, value in self.responses.items()),
+                 "executes": executes}
+        with open(filename, "w") as transcript_file:
+            json.dump(saved, transcript_file, indent=1, sort_keys=True)
+
+
+class SimulatedConsole(object):
+    """
+    Plays a transcript back over a socket or SSH channel with configurable timing
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, transcript, latency=0.0, jitter=0.0, chunk_size=0, chunk_delay=0.0, max_sessions=0, rtt=0.0):
+        """
+        latency/jitter: seconds added before each response
+        rtt: network round trip, each response is sent no sooner than this long after its line arrived
+        chunk_size/chunk_delay: split responses into chunks of this many bytes sent this far apart
+        max_sessions: refuse connections beyond this many concurrent sessions, 0 for no limit
+        """
+        # pylint: disable=too-many-arguments
+        self.transcript = transcript
+        self.latency = latency
+        self.jitter = jitter
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.max_sessions = max_sessions
+        self.rtt = rtt
+        self.active_sessions = 0
+        self.lock = threading.Lock()
+        self.commands_received = 0
+
+
+    def open_session(self):
+        """
+        Claim a session slot, returning False if the console is already at its session limit
+        """
+        with self.lock:
+            if self.max_sessions and self.active_sessions >= self.max_sessions:
+                return False
+            self.active_sessions += 1
+            return True
+
+
+    def close_session(self):
+        """
+        Release a session slot
+        """
+        with self.lock:
+            self.active_sessions -= 1
+
+
+    def send(self, channel, text):
+        """
+        Send text to the client, fragmented if configured
+        """
+        if not self.chunk_size:
+            channel.sendall(text)
+            return
+        for index in range(0, len(text), self.chunk_size):
+            channel.sendall(text[index:index + self.chunk_size])
+            if self.chunk_delay:
+                sleep(self.chunk_delay)
+
+
+    def serve_session(self, channel):
+        """
+        Answer console lines on an open channel until the client disconnects
+        """
+        if not self.open_session():
+            self.send(channel, TOO_MANY_SESSIONS)
+            return
+        try:
+            if self.transcript.banner:
+                self.send(channel, self.transcript.banner + self.transcript.console_prompt + ">")
+            pending = ""
+            while True:
+                data = channel.recv(BUFF_SIZE)
+                if not data:
+                    return
+                arrived = time()
+                pending += data.replace("\n", "")
+                while "\r" in pending:
+                    line, pending = pending.split("\r", 1)
+                    with self.lock:
+                        self.commands_received += 1
+                    output, prompt_follows, disconnect = self.transcript.respond(line)
+                    if self.latency or self.jitter:
+                        sleep(self.latency + random.uniform(0, self.jitter))
+                    if self.rtt:
+                        # Lines that arrived together travel back together
+                        sleep(max(0.0, arrived + self.rtt - time()))
+                    if prompt_follows:
+                        output += self.transcript.console_prompt + ">"
+                    self.send(channel, output)
+                    if disconnect:
+                        return
+        except (socket.error, EOFError):
+            pass
+        finally:
+            self.close_session()
+
+
+class CTPRequestHandler(SocketServer.BaseRequestHandler):
+    """
+    Serve one CTP connection
+    """
+
+    def handle(self):
+        """
+        Hand the connection to the simulated console
+        """
+        # Responses to consecutive lines would otherwise wait on the client's delayed ACK
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.console.serve_session(self.request)
+
+
+class SimulatedCTPServer(SocketServer.ThreadingTCPServer):
+    """
+    Threaded TCP server answering CTP connections from a SimulatedConsole
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, console, host, port=CTP_PORT):
+        """
+        Bind to host:port
+        """
+        SocketServer.ThreadingTCPServer.__init__(self, (host, port), CTPRequestHandler)
+        self.console = console
+
+
+class SimulatedSSHInterface(paramiko.ServerInterface):
+    """
+    Accept any credentials and an interactive shell
+    """
+
+    def __init__(self):
+        """
+        initialize internal properties
+        """
+        self.shell_requested = threading.Event()
+
+
+    def check_channel_request(self, kind, chanid):
+        """
+        Allow session channels only
+        """
+        return paramiko.OPEN_SUCCEEDED if kind == "session" else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+
+    def get_allowed_auths(self, username):
+        """
+        Password authentication like a Crestron console
+        """
+        return "password"
+
+
+    def check_auth_password(self, username, password):
+        """
+        Any user name and password is accepted
+        """
+        return paramiko.AUTH_SUCCESSFUL
+
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        """
+        Accept the pseudo terminal the documenter requests
+        """
+        # pylint: disable=too-many-arguments
+        return True
+
+
+    def check_channel_shell_request(self, channel):
+        """
+        Accept the interactive shell and let the session start
+        """
+        self.shell_requested.set()
+        return True
+
+
+class SimulatedSSHServer(object):
+    """
+    Minimal SSH server answering interactive shells from a SimulatedConsole
+    """
+
+    def __init__(self, console, host, port=SSH_PORT):
+        """
+        Bind to host:port with a throwaway host key
+        """
+        self.console = console
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(20)
+
+
+    def serve_forever(self):
+        """
+        Accept SSH connections until the listener is closed
+        """
+        while True:
+            try:
+                client, _unused = self.listener.accept()
+            except socket.error:
+                return
+            thread = threading.Thread(target=self.serve_connection, args=(client,))
+            thread.daemon = True
+            thread.start()
+
+
+    def serve_connection(self, client):
+        """
+        Run the SSH handshake and serve the shell channel
+        """
+        transport = paramiko.Transport(client)
+        transport.add_server_key(self.host_key)
+        interface = SimulatedSSHInterface()
+        try:
+            transport.start_server(server=interface)
+            channel = transport.accept(20)
+            if channel is not None:
+                interface.shell_requested.wait(10)
+                self.console.serve_session(channel)
+        except (paramiko.SSHException, socket.error, EOFError):
+            pass
+        finally:
+            transport.close()
+
+
+    def shutdown(self):
+        """
+        Stop accepting connections
+        """
+        self.listener.close()
+
+
+def start_simulator(console, host, ctp_port=CTP_PORT, ssh_port=None):
+    """
+    Serve a simulated console in background threads, returning the servers
+    """
+    servers = [SimulatedCTPServer(console, host, ctp_port)]
+    if ssh_port:
+        servers.append(SimulatedSSHServer(console, host, ssh_port))
+    for server in servers:
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+    return servers
+
+
+class TranscriptRecorder(CrestronDeviceDocumenter):
+    """
+    Documenter that records every console response it receives into a DeviceTranscript
+    """
+
+    def __init__(self, args, shared=None):
+        """
+        initialize internal properties
+        """
+        CrestronDeviceDocumenter.__init__(self, args, shared)
+        self.transcript = None
+
+
+    def send_command_wait_prompt(self, command):
+        """
+        Send the command and keep the console output between the prompts
+        """
+        data = CrestronDeviceDocumenter.send_command_wait_prompt(self, command)
+        terminator = self.console_prompt + ">"
+        # The leading CR of every command is answered with a prompt of its own
+        if terminator in data:
+            empty_line_response, response = data.split(terminator, 1)
+            self.transcript.responses.setdefault("", empty_line_response)
+        else:
+            response = data
+        if response.rstrip().endswith(terminator):
+            self.transcript.add_response(command, response[:response.rindex(terminator)])
+        else:
+            # The firmware ran the command instead of answering and never returned a prompt
+            self.transcript.executes[normalize_command_line(command.rstrip("? "))] = \
+                {"output": response, "prompt": False}
+        return data
+
+
+    def capture(self, ip_address):
+        """
+        Record the prompt, ver, help listings and the long help of every command of a device
+        """
+        self.device_ip_address = ip_address
+        self.initialize_run_variables()
+        self.load_do_not_execute_command_list()
+        if not self.open_device_connection():
+            return None
+        try:
+            if not self.get_console_prompt():
+                return None
+            self.transcript = DeviceTranscript(self.console_prompt)
+            self.get_firmware_version()
+            self.get_published_command_list()
+            self.get_hidden_command_list()
+            if self.possible_commands_filename:
+                self.test_for_unpublished_commands()
+            commands = set(self.pub_command_list + self.hidden_command_list + self.unpublished_command_list)
+            for index, command in enumerate(sorted(commands)):
+                self.get_command_help(command)
+                self.log("(" + str(index) + ")" + command + " ", end="")
+            self.send_command_wait_prompt(UNKNOWN_PROBE_COMMAND)
+            unknown_response = self.transcript.responses.pop(UNKNOWN_PROBE_COMMAND)
+            if unknown_response.startswith(UNKNOWN_PROBE_COMMAND):
+                unknown_response = unknown_response[len(UNKNOWN_PROBE_COMMAND):]
+            self.transcript.unknown_response = unknown_response
+            return self.transcript
+        finally:
+            self.close_device_connection()
+
+
+if __name__ == "__main__":
+    # pylint: disable-msg=C0103
+    parser = argparse.ArgumentParser(description="Crestron console simulator and transcript recorder")
+    subparsers = parser.add_subparsers(dest="mode")
+    serve_parser = subparsers.add_parser("serve", help="Replay transcripts as simulated devices.")
+    serve_parser.add_argument("devices", nargs="+",
+                              help="transcript.json@ip pairs, e.g. CP3.json@127.0.0.2")
+    serve_parser.add_argument("--ctpport", default=CTP_PORT, type=int, help="CTP port to listen on.")
+    serve_parser.add_argument("--sshport", default=0, type=int, help="Also serve SSH on this port.")
+    serve_parser.add_argument("--latency", default=0.0, type=float, help="Seconds before every response.")
+    serve_parser.add_argument("--rtt", default=0.0, type=float, help="Simulated network round trip in seconds.")
+    serve_parser.add_argument("--jitter", default=0.0, type=float, help="Random extra seconds before every response.")
+    serve_parser.add_argument("--chunksize", default=0, type=int, help="Fragment responses into chunks of this many bytes.")
+    serve_parser.add_argument("--chunkdelay", default=0.0, type=float, help="Seconds between response chunks.")
+    serve_parser.add_argument("--maxsessions", default=0, type=int,
+                              help="Refuse connections beyond this many concurrent sessions per device.")
+    capture_parser = subparsers.add_parser("capture", help="Record a transcript from a real device.")
+    capture_parser.add_argument("-ip", "--iptocheck", required=True, help="The Crestron IP address to record.")
+    capture_parser.add_argument("-o", "--output", default="", help="Transcript file. Defaults to <prompt>.json")
+    capture_parser.add_argument("-fssh", "--forcessh", action="store_true", help="Force use of SSH rather than CTP 41795")
+    capture_parser.add_argument("-uid", "--username", default="crestron", type=str, help="Authentication user name.")
+    capture_parser.add_argument("-pwd", "--password", default="", type=str, help="Authentication password.")
+    capture_parser.add_argument("-atc", "--addtestcommands", default='',
+                                help="Filename containing additional commands to test for and record")
+    parser_args = parser.parse_args()
+
+    if parser_args.mode == "serve":
+        all_servers = []
+        for device in parser_args.devices:
+            transcript_filename, host = device.rsplit("@", 1)
+            simulated_console = SimulatedConsole(DeviceTranscript.load(transcript_filename), parser_args.latency,
+                                                 parser_args.jitter, parser_args.chunksize, parser_args.chunkdelay,
+                                                 parser_args.maxsessions, parser_args.rtt)
+            all_servers.extend(start_simulator(simulated_console, host, parser_args.ctpport, parser_args.sshport))
+            print("Simulating {0} on {1}".format(simulated_console.transcript.console_prompt, host))
+        try:
+            while True:
+                sleep(1)
+        except KeyboardInterrupt:
+            for running_server in all_servers:
+                running_server.shutdown()
+    else:
+        # Options the documenter expects that do not apply to a capture keep their defaults
+        for option, default in vars(build_argument_parser().parse_args([])).items():
+            if not hasattr(parser_args, option):
+                setattr(parser_args, option, default)
+        parser_args.helpcache = ""
+        recorder = TranscriptRecorder(parser_args)
+        recorded = recorder.capture(parser_args.iptocheck)
+        if recorded:
+            output_filename = parser_args.output or recorded.console_prompt + ".json"
+            recorded.save(output_filename)
+            print("\nSaved transcript of {0} commands to {1}".format(len(recorded.responses), output_filename))
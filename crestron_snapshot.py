@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Machine readable snapshot of a documented device: its command lists, help text, firmware
+version and the commands whose output was cut short by a timeout. Snapshots of consecutive
+runs are compared to re-document a device incrementally and to keep a changelog of the
+commands added and removed between firmware versions.
+
+Copyright © 2017 by Stephen Genusa. Distributed under the license in LICENSE.txt
+"""
+
+from __future__ import print_function
+import hashlib
+import json
+import os
+from time import localtime, strftime, time
+
+SNAPSHOT_SUFFIX = ".snapshot.json"
+CHANGELOG_SUFFIX = ".changelog.txt"
+COMMAND_GROUPS = ("published", "hidden", "unpublished")
+
+
+def help_hash(help_text):
+    """
+    Short fingerprint of a command's help text
+    """
+    return hashlib.sha1(help_text).hexdigest()[:16]
+
+
+class DeviceSnapshot(object):
+    """
+    The command lists and help text of one documentation run of a device model
+    """
+
+    def __init__(self, console_prompt):
+        """
+        initialize internal properties
+        """
+        self.console_prompt = console_prompt
+        self.firmwareversion = ""
+        self.firmware_key = ""
+        self.created = time()
+        self.published = []
+        self.hidden = []
+        self.unpublished = []
+        # command -> {"short_help": text, "long_help": text, "hash": help_hash(long_help)}
+        self.commands = {}
+        # Console lines as typed ("help all", "command ?") whose output may be incomplete
+        self.timed_out = []
+
+
+    @classmethod
+    def from_documenter(cls, documenter):
+        """
+        Snapshot the results of a documenter that has just written its documentation
+        """
+        snapshot = cls(documenter.console_prompt)
+        snapshot.firmwareversion = documenter.firmwareversion
+        snapshot.firmware_key = documenter.firmware_key
+        snapshot.published = list(documenter.pub_command_list)
+        snapshot.hidden = list(documenter.hidden_command_list)
+        snapshot.unpublished = list(documenter.unpublished_command_list)
+        for command in snapshot.published + snapshot.hidden + snapshot.unpublished:
+            short_help = documenter.help_dict.get(command, "")
+            if command in documenter.do_not_execute_command_list:
+                # Commands that must not be run carry "short help|long help" from donotexec.upc
+                short_help, _unused, long_help = short_help.partition("|")
+            else:
+                long_help = documenter.help_store.get(command, "")
+            snapshot.commands[command] = {"short_help": short_help, "long_help": long_help,
+                                          "hash": help_hash(long_help)}
+        # Candidates of the unpublished command search that timed out are not documented
+        for command in documenter.timed_out_commands:
+            if command not in snapshot.timed_out and \
+               (not command.endswith(" ?") or command[:-len(" ?")] in snapshot.commands):
+                snapshot.timed_out.append(command)
+        return snapshot
+
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load a snapshot saved with save()
+        """
+        with open(filename, "r") as snapshot_file:
+            saved = json.load(snapshot_file)
+        # Console output is stored as latin-1 so any byte sequence survives the round trip
+        decode = lambda text: text.encode("latin-1")
+        snapshot = cls(decode(saved["console_prompt"]))
+        snapshot.firmwareversion = decode(saved.get("firmwareversion", ""))
+        snapshot.firmware_key = decode(saved.get("firmware_key", ""))
+        snapshot.created = saved.get("created", 0)
+        for group in COMMAND_GROUPS:
+            setattr(snapshot, group, [decode(command) for command in saved.get(group, [])])
+        for command, details in saved.get("commands", {}).items():
+            snapshot.commands[decode(command)] = dict((key, decode(value)) for key, value in details.items())
+        snapshot.timed_out = [decode(command) for command in saved.get("timed_out", [])]
+        return snapshot
+
+
+    def save(self, filename):
+        """
+        Save the snapshot as JSON
+        """
+        encode = lambda text: text.decode("latin-1")
+        saved = {"console_prompt": encode(self.console_prompt),
+                 "firmwareversion": encode(self.firmwareversion),
+                 "firmware_key": encode(self.firmware_key),
+                 "created": self.created,
+                 "timed_out": [encode(command) for command in self.timed_out],
+                 "commands": dict((encode(command), dict((key, encode(value)) for key, value in details.items()))
+                                  for command, details in self.commands.items())}
+        for group in COMMAND_GROUPS:
+            saved[group] = [encode(command) for command in getattr(self, group)]
+        with open(filename, "w") as snapshot_file:
+            json.dump(saved, snapshot_file, indent=1, sort_keys=True)
+
+
+    def reusable_help(self, command, short_help):
+        """
+        The long help recorded for a command whose listing is unchanged and whose help did
+        not time out, otherwise None
+        """
+        details = self.commands.get(command)
+        if details is None or details["short_help"] != short_help or command + " ?" in self.timed_out:
+            return None
+        return details["long_help"]
+
+
+    def changes_since(self, previous):
+        """
+        Commands added to and removed from each group and commands whose help text changed
+        since the previous snapshot
+        """
+        changes = {"firmware": None, "added": {}, "removed": {}, "help_changed": []}
+        if previous.firmwareversion != self.firmwareversion:
+            changes["firmware"] = (previous.firmwareversion, self.firmwareversion)
+        for group in COMMAND_GROUPS:
+            old_commands = set(getattr(previous, group))
+            new_commands = set(getattr(self, group))
+            changes["added"][group] = sorted(new_commands - old_commands)
+            changes["removed"][group] = sorted(old_commands - new_commands)
+        for command in sorted(set(self.commands) & set(previous.commands)):
+            if self.commands[command]["hash"] != previous.commands[command]["hash"]:
+                changes["help_changed"].append(command)
+        return changes
+
+
+def has_changes(changes):
+    """
+    True if a changes_since() result records any difference
+    """
+    return bool(changes["firmware"] or changes["help_changed"] or
+                any(changes["added"].values()) or any(changes["removed"].values()))
+
+
+def format_changelog(console_prompt, changes):
+    """
+    The changelog entry for one run as a list of lines
+    """
+    lines = ["{0} {1}".format(strftime("%Y-%m-%d %H:%M", localtime()), console_prompt)]
+    if changes["firmware"]:
+        lines.append("  Firmware changed from {0} to {1}".format(*changes["firmware"]))
+    for heading, key in (("Added", "added"), ("Removed", "removed")):
+        for group in COMMAND_GROUPS:
+            if changes[key][group]:
+                lines.append("  {0} {1} commands: {2}".format(heading, group, ", ".join(changes[key][group])))
+    if changes["help_changed"]:
+        lines.append("  Help text changed: " + ", ".join(changes["help_changed"]))
+    if not has_changes(changes):
+        lines.append("  No changes")
+    return lines
+
+
+def append_changelog(filename, console_prompt, changes):
+    """
+    Add the changelog entry for a run to the device's changelog file, newest last
+    """
+    lines = format_changelog(console_prompt, changes)
+    with open(filename, "a") as changelog_file:
+        if os.path.getsize(filename):
+            changelog_file.write("\n")
+        changelog_file.write("\n".join(lines) + "\n")
+    return lines
@@ -0,0 +1,646 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Non-blocking console sessions multiplexed with select() so a single thread can drive the CTP
+and SSH consoles of hundreds of devices at once. Each session finds the console prompt and
+then runs its queued commands, including the CR nudges and the command timeout adapted to the
+device's response times. CrestronDeviceDocumenter drives its own console session through the
+synchronous wrappers of ConsoleReactor, so there is one implementation of the console protocol.
+
+Copyright © 2017 by Stephen Genusa. Distributed under the license in LICENSE.txt
+"""
+
+from __future__ import print_function
+import errno
+import select
+import socket
+import threading
+from time import sleep, time
+
+import paramiko
+
+from crestron_console import BUFF_SIZE, MAX_NUDGE_INTERVAL, LatencyTracker, PromptScanner, backoff_delay, \
+    drain_input, exchange_pipelined, read_until_quiet
+from crestron_parser import find_console_prompt
+
+CR = "\r"
+# Non-blocking connect() in progress; 10035 is WSAEWOULDBLOCK
+CONNECT_IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY, 10035)
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, 10035)
+# Seconds of silence that end the banner some consoles print on connect
+BANNER_QUIET = 0.3
+# How often sessions still connecting over SSH are checked
+SSH_CONNECT_POLL = 0.05
+
+
+class PendingCommand(object):
+    """
+    A command queued on a ConsoleSession and, once done, its response
+    """
+
+    def __init__(self, command):
+        """
+        initialize internal properties
+        """
+        self.command = command
+        self.response = None
+        self.timed_out = False
+        self.done = False
+        # Of the last attempt, for tracing
+        self.elapsed = 0.0
+        self.bytes_read = 0
+        self.nudges = 0
+
+
+class ConsoleSession(object):
+    """
+    One console session driven by a ConsoleReactor. The session connects, finds the console
+    prompt and runs its queued commands one at a time, each complete once the prompt follows it.
+    A session that is lost is reconnected up to max_reconnects times, waiting reconnect_delay
+    seconds doubling up to max_reconnect_delay between attempts, and the command that was
+    running is sent again. A shared LatencyTracker can be passed in as latency.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, ip_address, port, use_ssh=False, username="", password="", connect_timeout=5.0,
+                 command_timeout=30.0, nudge_interval=1.0, max_prompt_attempts=3, max_reconnects=0,
+                 terminal_width=512, latency=None, reconnect_delay=0.0, max_reconnect_delay=60.0, no_delay=False):
+        """
+        initialize internal properties
+        """
+        # pylint: disable=too-many-arguments,too-many-locals
+        self.ip_address = ip_address
+        self.port = port
+        self.use_ssh = use_ssh
+        self.username = username
+        self.password = password
+        self.connect_timeout = connect_timeout
+        self.latency = latency or LatencyTracker(nudge_interval, command_timeout)
+        self.max_prompt_attempts = max_prompt_attempts
+        self.reconnects_left = max_reconnects
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.reconnect_attempt = 0
+        # Pipelined queries are small writes sent before the previous one is acknowledged
+        self.no_delay = no_delay
+        self.terminal_width = terminal_width
+        # Close the session once every queued command has been answered
+        self.close_when_idle = True
+        self.state = "new"
+        self.connected = False
+        self.console_prompt = ""
+        self.error = ""
+        self.started = 0.0
+        self.finished = 0.0
+        self.round_trips = 0
+        self.bytes_read = 0
+        self.queue = []
+        self.current = None
+        self.channel = None
+        self.ssh_client = None
+        self.ssh_thread = None
+        self.ssh_error = ""
+        self.outgoing = ""
+        self.received = ""
+        self.scanner = None
+        self.message = ""
+        self.deadline = 0.0
+        self.quiet_deadline = 0.0
+        self.last_data_time = 0.0
+        # Silence before the running command is nudged, doubled after each nudge
+        self.nudge_interval = nudge_interval
+        self.prompt_attempts = 0
+
+
+    @property
+    def closed(self):
+        """
+        True once the session has finished or failed
+        """
+        return self.state == "closed"
+
+
+    def fileno(self):
+        """
+        The descriptor select() waits on
+        """
+        return self.channel.fileno()
+
+
+    def send_command(self, command):
+        """
+        Queue a command and return the PendingCommand that receives its response
+        """
+        pending = PendingCommand(command)
+        self.queue.append(pending)
+        return pending
+
+
+    def start(self, now):
+        """
+        Begin connecting to the device
+        """
+        if not self.started:
+            self.started = now
+        self.received = ""
+        self.outgoing = ""
+        self.deadline = now + self.connect_timeout
+        self.state = "connecting"
+        if self.use_ssh:
+            self.ssh_error = ""
+            self.ssh_thread = threading.Thread(target=self.connect_ssh)
+            self.ssh_thread.daemon = True
+            self.ssh_thread.start()
+            return
+        self.channel = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.channel.setblocking(0)
+        if self.no_delay:
+            self.channel.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        err = self.channel.connect_ex((self.ip_address, self.port))
+        if err == 0:
+            self.on_connected(now)
+        elif err not in CONNECT_IN_PROGRESS:
+            self.connect_failed("Unable to connect: " + errno.errorcode.get(err, str(err)))
+
+
+    def connect_ssh(self):
+        """
+        Open the SSH shell; paramiko connects in blocking mode so this runs in its own thread
+        """
+        try:
+            client = paramiko.client.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            client.load_system_host_keys()
+            client.connect(self.ip_address, port=self.port, username=self.username, password=self.password,
+                           timeout=self.connect_timeout)
+            self.channel = client.invoke_shell(width=self.terminal_width)
+            self.ssh_client = client
+        except Exception as error:  # pylint: disable=broad-except
+            self.ssh_error = str(error) or error.__class__.__name__
+
+
+    def on_connected(self, now):
+        """
+        Wait for the banner and prompt some consoles print without being asked
+        """
+        self.connected = True
+        self.state = "banner"
+        self.quiet_deadline = now + BANNER_QUIET
+        self.deadline = now + self.latency.nudge_interval
+        self.prompt_attempts = 0
+
+
+    def wants_read(self):
+        """
+        True if select() should wait for output from the device
+        """
+        return self.state in ("banner", "prompting", "ready", "command")
+
+
+    def wants_write(self):
+        """
+        True if select() should wait until the device can be written to
+        """
+        return (self.state == "connecting" and not self.use_ssh) or bool(self.outgoing)
+
+
+    def next_deadline(self):
+        """
+        The time by which handle_timers must next run
+        """
+        if self.state == "connecting" and self.use_ssh:
+            return time() + SSH_CONNECT_POLL
+        if self.state == "waiting":
+            return self.deadline
+        if self.state == "banner":
+            return min(self.quiet_deadline, self.deadline)
+        if self.state == "command":
+            return min(self.deadline, self.last_data_time + self.nudge_interval)
+        if self.state in ("connecting", "prompting"):
+            return self.deadline
+        return time() + 1.0
+
+
+    def write(self, data):
+        """
+        Queue output for the device
+        """
+        self.outgoing += data
+        self.handle_write()
+
+
+    def handle_write(self):
+        """
+        Complete a connect or send queued output
+        """
+        if self.state == "connecting":
+            err = self.channel.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                self.connect_failed("Unable to connect: " + errno.errorcode.get(err, str(err)))
+            else:
+                self.on_connected(time())
+            return
+        try:
+            if self.use_ssh:
+                self.channel.sendall(self.outgoing)
+                self.outgoing = ""
+            else:
+                sent = self.channel.send(self.outgoing)
+                self.outgoing = self.outgoing[sent:]
+        except socket.error as error:
+            if error.args and error.args[0] in WOULD_BLOCK:
+                return
+            self.lost("Connection lost: {0}".format(error))
+        except (EOFError, paramiko.SSHException) as error:
+            self.lost("Connection lost: {0}".format(error))
+
+
+    def handle_read(self):
+        """
+        Read what the device sent and advance the session
+        """
+        try:
+            chunk = self.channel.recv(BUFF_SIZE)
+        except socket.error as error:
+            if error.args and error.args[0] in WOULD_BLOCK:
+                return
+            self.lost("Connection lost: {0}".format(error))
+            return
+        except (EOFError, paramiko.SSHException) as error:
+            self.lost("Connection lost: {0}".format(error))
+            return
+        if not chunk:
+            self.lost("Connection closed by device")
+            return
+        self.bytes_read += len(chunk)
+        now = time()
+        if self.state == "banner":
+            self.received += chunk
+            self.quiet_deadline = now + BANNER_QUIET
+        elif self.state == "prompting":
+            self.received += chunk
+            console_prompt = find_console_prompt(self.received)
+            if console_prompt:
+                self.on_prompt(console_prompt)
+        elif self.state == "command":
+            self.last_data_time = now
+            if self.scanner.feed(chunk):
+                self.finish_command(False)
+        # Output between commands is discarded like drain_input does
+
+
+    def handle_timers(self, now):
+        """
+        Act on the deadlines of the current state
+        """
+        if self.state == "connecting":
+            if self.use_ssh and not self.ssh_thread.is_alive():
+                if self.ssh_client:
+                    self.on_connected(now)
+                else:
+                    self.connect_failed("Unable to connect: " + self.ssh_error)
+            elif not self.use_ssh and now >= self.deadline:
+                self.connect_failed("Unable to connect: timed out")
+        elif self.state == "waiting":
+            if now >= self.deadline:
+                self.start(now)
+        elif self.state == "banner":
+            if now >= self.quiet_deadline or now >= self.deadline:
+                console_prompt = find_console_prompt(self.received, at_end=True)
+                if console_prompt:
+                    self.on_prompt(console_prompt)
+                else:
+                    self.state = "prompting"
+                    self.nudge_for_prompt(now)
+        elif self.state == "prompting":
+            if now >= self.deadline:
+                if self.prompt_attempts >= self.max_prompt_attempts:
+                    self.connect_failed("Console prompt not found on device.")
+                else:
+                    self.nudge_for_prompt(now)
+        elif self.state == "command":
+            if now >= self.deadline:
+                # A console that has not even echoed the command or answered a nudge is gone
+                if not self.scanner.bytes_read:
+                    self.latency.record_timeout()
+                    self.lost("Console stopped responding after {0}".format(self.current.command))
+                else:
+                    self.finish_command(True)
+            elif now >= self.last_data_time + self.nudge_interval:
+                # Some consoles do not print a prompt for an empty line
+                if self.scanner.ends_with_prompt():
+                    self.finish_command(False)
+                else:
+                    self.write(CR)
+                    self.scanner.expected_prompts += 1
+                    self.scanner.nudges += 1
+                    self.last_data_time = now
+                    self.nudge_interval = min(MAX_NUDGE_INTERVAL, self.nudge_interval * 2)
+
+
+    def nudge_for_prompt(self, now):
+        """
+        Send a CR to make the console print its prompt, waiting longer after each one
+        """
+        self.deadline = now + backoff_delay(self.latency.nudge_interval, self.prompt_attempts, MAX_NUDGE_INTERVAL)
+        self.prompt_attempts += 1
+        self.round_trips += 1
+        self.write(CR)
+
+
+    def on_prompt(self, console_prompt):
+        """
+        The console prompt is known; a reconnected session must find the same one
+        """
+        if self.console_prompt and console_prompt != self.console_prompt:
+            self.fail("Console prompt changed from {0} to {1}".format(self.console_prompt, console_prompt))
+            return
+        self.console_prompt = console_prompt
+        self.received = ""
+        self.state = "ready"
+        self.reconnect_attempt = 0
+        self.next_command()
+
+
+    def next_command(self):
+        """
+        Send the next queued command, or close the session when there is none left
+        """
+        if self.current is None and self.queue:
+            self.current = self.queue.pop(0)
+        if self.current is None:
+            if self.close_when_idle:
+                self.close()
+            return
+        now = time()
+        self.state = "command"
+        self.message = CR + self.current.command + CR
+        # The console answers each CR with a prompt
+        self.scanner = PromptScanner(self.console_prompt + ">", self.message.count(CR))
+        self.deadline = now + self.latency.command_timeout
+        self.nudge_interval = self.latency.nudge_interval
+        self.last_data_time = now
+        self.round_trips += 1
+        self.write(self.message)
+
+
+    def finish_command(self, timed_out):
+        """
+        Hand the response to the current command and move on to the next one
+        """
+        if timed_out:
+            self.latency.record_timeout()
+        else:
+            self.latency.record(self.scanner)
+        pending = self.current
+        self.current = None
+        pending.response = self.scanner.data().replace(self.message, "")
+        pending.timed_out = timed_out
+        pending.elapsed = time() - self.scanner.started
+        pending.bytes_read = self.scanner.bytes_read
+        pending.nudges = self.scanner.nudges
+        pending.done = True
+        self.scanner = None
+        self.state = "ready"
+        self.next_command()
+
+
+    def lost(self, reason):
+        """
+        The session died; reconnect if allowed and send the current command again
+        """
+        self.close_channel()
+        if self.reconnects_left > 0 and self.connected:
+            self.reconnects_left -= 1
+            delay = backoff_delay(self.reconnect_delay, self.reconnect_attempt, self.max_reconnect_delay) \
+                if self.reconnect_delay else 0.0
+            self.reconnect_attempt += 1
+            if delay:
+                # Give a rebooting device time to come back
+                self.state = "waiting"
+                self.deadline = time() + delay
+            else:
+                self.start(time())
+        else:
+            self.fail(reason)
+
+
+    def connect_failed(self, reason):
+        """
+        A connection attempt or the search for the prompt failed; a session that was connected
+        before keeps trying while it has reconnects left
+        """
+        if self.connected and self.reconnects_left > 0:
+            self.lost(reason)
+        else:
+            self.fail(reason)
+
+
+    def fail(self, reason):
+        """
+        Give up on the session, completing every command still queued without a response
+        """
+        self.error = reason
+        for pending in ([self.current] if self.current else []) + self.queue:
+            pending.done = True
+        self.current = None
+        self.queue = []
+        self.close()
+
+
+    def discard_input(self):
+        """
+        Drop output still pending from an earlier command of a synchronous session
+        """
+        drain_input(self.channel)
+
+
+    def exchange_pipelined(self, lines, terminator, window, quiet, timeout):
+        """
+        Send lines back to back between the commands of a synchronous session and split the
+        output at the prompts, as crestron_console.exchange_pipelined does. The channel blocks
+        meanwhile.
+        """
+        # pylint: disable=too-many-arguments
+        self.discard_input()
+        self.set_blocking(True)
+        try:
+            segments, bytes_read = exchange_pipelined(self.channel, lines, terminator, window, quiet, timeout)
+        finally:
+            self.set_blocking(False)
+        self.bytes_read += bytes_read
+        return segments, bytes_read
+
+
+    def read_until_quiet(self, quiet, max_wait):
+        """
+        Read whatever the device sends between commands until it has been silent for quiet seconds
+        """
+        data = read_until_quiet(self.channel, quiet, max_wait)
+        self.bytes_read += len(data)
+        return data
+
+
+    def set_blocking(self, blocking):
+        """
+        Switch a CTP socket between blocking, with the connect timeout, and non-blocking mode;
+        SSH channels always block
+        """
+        if not self.use_ssh:
+            self.channel.settimeout(self.connect_timeout if blocking else 0.0)
+
+
+    def close(self):
+        """
+        Close the session
+        """
+        self.close_channel()
+        self.state = "closed"
+        self.finished = time()
+
+
+    def close_channel(self):
+        """
+        Close the socket or SSH channel
+        """
+        try:
+            if self.channel is not None:
+                self.channel.close()
+            if self.ssh_client is not None:
+                self.ssh_client.close()
+        except (socket.error, EOFError, paramiko.SSHException):
+            pass
+        self.channel = None
+        self.ssh_client = None
+
+
+class ConsoleReactor(object):
+    """
+    select() loop over any number of ConsoleSessions
+    """
+
+    def __init__(self):
+        """
+        initialize internal properties
+        """
+        self.sessions = []
+
+
+    def add(self, session):
+        """
+        Start a session and drive it from now on
+        """
+        session.start(time())
+        self.sessions.append(session)
+
+
+    def poll(self, max_wait):
+        """
+        Wait up to max_wait seconds for the sessions to become readable or writable and
+        advance every session once
+        """
+        readers = [session for session in self.sessions if session.wants_read()]
+        writers = [session for session in self.sessions if session.wants_write()]
+        now = time()
+        wait = max(0.0, min([max_wait] + [session.next_deadline() - now for session in self.sessions]))
+        readable, writable = [], []
+        if readers or writers:
+            readable, writable, _unused = select.select(readers, writers, [], wait)
+        else:
+            # Only sessions connecting over SSH; select() rejects empty lists on Windows
+            sleep(wait)
+        for session in writable:
+            if not session.closed:
+                session.handle_write()
+        for session in readable:
+            if not session.closed and session.wants_read():
+                session.handle_read()
+        now = time()
+        for session in self.sessions:
+            if not session.closed:
+                session.handle_timers(now)
+        self.sessions = [session for session in self.sessions if not session.closed]
+
+
+    def run(self, until=None, timeout=None):
+        """
+        Drive the sessions until until() is true, every session has closed or timeout seconds
+        have passed
+        """
+        deadline = time() + timeout if timeout is not None else None
+        while self.sessions and not (until and until()):
+            if deadline is not None and time() >= deadline:
+                return
+            self.poll(1.0 if deadline is None else max(0.0, deadline - time()))
+
+
+    def run_sessions(self, sessions, max_active):
+        """
+        Drive sessions to completion, with at most max_active of them open at once
+        """
+        waiting = list(sessions)
+        waiting.reverse()
+        while waiting or self.sessions:
+            while waiting and len(self.sessions) < max_active:
+                self.add(waiting.pop())
+            self.poll(1.0)
+
+
+    def open(self, session):
+        """
+        Synchronous wrapper: connect a session that is kept open for commands. Returns True
+        once it is connected; it then looks for the console prompt when driven again.
+        """
+        session.close_when_idle = False
+        self.add(session)
+        self.run(lambda: session.state not in ("new", "connecting", "waiting"))
+        return session.connected and not session.closed
+
+
+    def wait_for_prompt(self, session):
+        """
+        Synchronous wrapper: drive a session until it has found its console prompt. Returns
+        True if it is ready for commands.
+        """
+        self.run(lambda: session.state in ("ready", "closed"))
+        return session.state == "ready"
+
+
+    def reconnect(self, session, attempts):
+        """
+        Synchronous wrapper: connect a session whose connection died again, trying up to
+        attempts times with the session's reconnect delay, and wait until it has found the
+        same console prompt. Returns True if it is ready for commands.
+        """
+        session.close_channel()
+        session.current = None
+        session.queue = []
+        session.error = ""
+        session.reconnect_attempt = 0
+        session.reconnects_left = attempts - 1
+        if session not in self.sessions:
+            self.sessions.append(session)
+        session.start(time())
+        ready = self.wait_for_prompt(session)
+        session.reconnects_left = 0
+        return ready
+
+
+    def command(self, session, command):
+        """
+        Synchronous wrapper: run one command on a session and return the PendingCommand.
+        The session is kept open for further commands. Output left over from an earlier
+        command is discarded first.
+        """
+        session.close_when_idle = False
+        pending = session.send_command(command)
+        if session.state == "new":
+            self.add(session)
+        elif session.state == "ready":
+            session.discard_input()
+            if session not in self.sessions:
+                self.sessions.append(session)
+            session.next_command()
+        self.run(lambda: pending.done)
+        return pending
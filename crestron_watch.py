@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+State of the watch mode: the console prompt and firmware version each device had when it was
+last documented and when it is due to be polled again. A device is only documented again
+when a poll finds a different prompt or firmware version.
+
+Copyright © 2017 by Stephen Genusa. Distributed under the license in LICENSE.txt
+"""
+
+from __future__ import print_function
+import json
+import os
+import random
+from time import time
+
+WATCH_STATE_FILENAME = "watch_state.json"
+
+
+class WatchState(object):
+    """
+    The devices being watched, saved as JSON between runs
+    """
+
+    def __init__(self, filename):
+        """
+        initialize internal properties
+        """
+        self.filename = filename
+        # ip address -> {"console_prompt", "firmwareversion", "documented", "last_seen", "next_poll", "status"}
+        self.devices = {}
+
+
+    def load(self):
+        """
+        Read the state saved by an earlier run, if there is one
+        """
+        if not os.path.isfile(self.filename):
+            return
+        with open(self.filename, "r") as state_file:
+            saved = json.load(state_file)
+        # Console output is stored as latin-1 so any byte sequence survives the round trip
+        for ip_address, device in saved.get("devices", {}).items():
+            for key in ("console_prompt", "firmwareversion"):
+                device[key] = device.get(key, u"").encode("latin-1")
+            self.devices[ip_address.encode("latin-1")] = device
+
+
+    def save(self):
+        """
+        Write the state, replacing the file in one step so an interrupted run leaves the old one
+        """
+        encode = lambda text: text.decode("latin-1")
+        saved = {"devices": dict((ip_address, dict(device, console_prompt=encode(device["console_prompt"]),
+                                                   firmwareversion=encode(device["firmwareversion"])))
+                                 for ip_address, device in self.devices.items())}
+        temporary_filename = self.filename + ".tmp"
+        with open(temporary_filename, "w") as state_file:
+            json.dump(saved, state_file, indent=1, sort_keys=True)
+        if os.name == "nt" and os.path.isfile(self.filename):
+            # rename() does not replace an existing file on Windows
+            os.remove(self.filename)
+        os.rename(temporary_filename, self.filename)
+
+
+    def device(self, ip_address):
+        """
+        The state of a device, added with nothing documented and due for a poll
+        """
+        if ip_address not in self.devices:
+            self.devices[ip_address] = {"console_prompt": "", "firmwareversion": "", "documented": 0,
+                                        "last_seen": 0, "next_poll": 0, "status": "new"}
+        return self.devices[ip_address]
+
+
+    def due(self, ip_addresses, now):
+        """
+        The devices whose next poll is due
+        """
+        return [ip_address for ip_address in ip_addresses if self.device(ip_address)["next_poll"] <= now]
+
+
+    def next_poll(self):
+        """
+        The time the next device is due, or None if no device is watched
+        """
+        return min([device["next_poll"] for device in self.devices.values()] or [None])
+
+
+    def changed(self, result):
+        """
+        True if a device answered with a prompt or firmware version other than the ones it
+        was last documented with
+        """
+        device = self.device(result.ip_address)
+        return not device["documented"] or device["console_prompt"] != result.console_prompt or \
+            device["firmwareversion"] != result.firmwareversion
+
+
+    def polled(self, result, interval, jitter):
+        """
+        Record the outcome of a poll and schedule the next one interval seconds away, give or
+        take jitter (a fraction of the interval) so the polls of many devices spread out
+        """
+        device = self.device(result.ip_address)
+        now = time()
+        device["status"] = result.status
+        if result.status == "connected":
+            device["last_seen"] = now
+        device["next_poll"] = now + interval * random.uniform(1 - jitter, 1 + jitter)
+
+
+    def documented(self, result):
+        """
+        Record the prompt and firmware version a device has been documented with
+        """
+        device = self.device(result.ip_address)
+        device["console_prompt"] = result.console_prompt
+        device["firmwareversion"] = result.firmwareversion
+        device["documented"] = time()
+        device["status"] = result.status
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Tests of the console output parsers against recorded console transcripts. The transcripts
+in test_transcripts are in the format crestron_simulator.py records; each test rebuilds the
+output the documenter reads for a command: the prompt the console prints for the leading CR,
+the response and the prompt that follows it.
+
+python -m unittest test_crestron_parser
+
+Copyright © 2017 by Stephen Genusa. Distributed under the license in LICENSE.txt
+"""
+
+from __future__ import print_function
+import os
+import unittest
+
+from crestron_parser import HELP_WRAP_WIDTH, NO_HELP_TEXT, find_console_prompt, firmware_key, help_body, \
+    parse_command_help, parse_firmware_version, parse_help_listing
+from crestron_simulator import DeviceTranscript
+
+TRANSCRIPT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_transcripts")
+
+
+class RecordedConsoleTestCase(unittest.TestCase):
+    """
+    Parses the console output of a CP3 recorded to test_transcripts/CP3.json
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.transcript = DeviceTranscript.load(os.path.join(TRANSCRIPT_DIRECTORY, "CP3.json"))
+        cls.terminator = cls.transcript.console_prompt + ">"
+
+
+    def console_output(self, command):
+        """
+        The output the documenter reads for a command, as the transport hands it over
+        """
+        data = self.transcript.respond("")[0] + self.terminator
+        return data + self.transcript.respond(command)[0] + self.terminator
+
+
+    def test_find_console_prompt(self):
+        data = self.console_output("")
+        self.assertEqual(find_console_prompt(data), "CP3")
+        self.assertEqual(find_console_prompt(data, at_end=True), "CP3")
+        self.assertEqual(find_console_prompt(data + "ver\r\n", at_end=True), None)
+
+
+    def test_parse_firmware_version(self):
+        firmwareversion = parse_firmware_version(self.console_output("ver"), self.terminator)
+        self.assertEqual(firmwareversion,
+                         "CP3 Cntrl Eng [v1.601.3935.27032 (Sep 26 2019), #00C4D2A8] @E-00107f9ed3b1")
+        self.assertEqual(firmware_key(firmwareversion), "CP3 Cntrl Eng [v1.601.3935.27032 (Sep 26 2019)]")
+        self.assertEqual(parse_firmware_version(self.console_output(""), self.terminator), "")
+
+
+    def test_parse_help_listing(self):
+        published = parse_help_listing(self.console_output("help all"), "help all", self.terminator)
+        self.assertEqual(published, [("ADDMaster", "Adds an entry to the IP table"),
+                                     ("BAUDrate", "Set the baud rate of a COM port"),
+                                     ("ERRlog", "Display or clear the error log"),
+                                     ("IPConfig", "Display the network settings"),
+                                     ("VERsion", "Display the firmware version")])
+        hidden = parse_help_listing(self.console_output("hidhelp all"), "hidhelp all", self.terminator)
+        self.assertEqual(hidden, [("DUMPINFO", "Dump internal state"), ("TESTRAM", "Test the RAM")])
+
+
+    def test_parse_help_listing_cr_line_endings(self):
+        data = self.console_output("help all").replace("\r\n", "\r")
+        published = parse_help_listing(data, "help all", self.terminator)
+        self.assertEqual([command for command, _ in published], ["ADDMaster", "BAUDrate", "ERRlog", "IPConfig",
+                                                                 "VERsion"])
+        self.assertEqual(published[1], ("BAUDrate", "Set the baud rate of a COM port"))
+
+
+    def test_parse_help_listing_rejected(self):
+        data = self.console_output("userhelp all")
+        self.assertEqual(parse_help_listing(data, "userhelp all", self.terminator), [])
+
+
+    def test_help_body(self):
+        body = help_body(self.console_output("BAUDRATE ?"), self.terminator)
+        self.assertEqual(body, "\r\nCP3>BAUDRATE ?\r\nBAUDrate [port_number] [baud_rate]\r\n"
+                               "\tport_number - COM port, A to F\r\n\r")
+        self.assertEqual(help_body("CP3>", self.terminator), "")
+
+
+    def test_parse_command_help(self):
+        help_text = parse_command_help("ADDMASTER", self.console_output("ADDMASTER ?"), self.terminator)
+        self.assertEqual(help_text, "\nADDMaster IP_ID IP_ADDRESS/SITENAME [DEVID] [ROUTEID]\n"
+                                    "    IP_ID - IP ID in hex\n"
+                                    "    IP_ADDRESS/SITENAME - &lt;address or name&gt; of the master\n\n")
+        help_text = parse_command_help("BAUDRATE", self.console_output("BAUDRATE ?"), self.terminator)
+        self.assertEqual(help_text, "\nBAUDrate [port_number] [baud_rate]\n        port_number - COM port, A to F\n\n")
+
+
+    def test_parse_command_help_wraps_long_lines(self):
+        help_text = parse_command_help("ERRLOG", self.console_output("ERRLOG ?"), self.terminator)
+        lines = help_text.split("\n")
+        self.assertEqual(len(lines), 5)
+        self.assertTrue(all(len(line) <= HELP_WRAP_WIDTH for line in lines))
+        self.assertEqual(" ".join(lines[1:3]),
+                         "ERRlog [CLEAR] - " + " ".join(["Displays the entries of the error log"] * 5))
+
+
+    def test_parse_command_help_without_help(self):
+        self.assertEqual(parse_command_help("TESTRAM", self.console_output("TESTRAM ?"), self.terminator), "\n\n")
+        self.assertEqual(parse_command_help("DUMPINFO", self.console_output("DUMPINFO ?"), self.terminator),
+                         NO_HELP_TEXT)
+
+
+    def test_parse_command_help_unknown_command(self):
+        self.assertEqual(parse_command_help("ADDM", self.console_output("ADDMX ?"), self.terminator), "")
+
+
+if __name__ == "__main__":
+    unittest.main()